@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -89,26 +90,146 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(os.path.dirname(__file__), "../media")
+# Resized images missing on MEDIA_ROOT are rendered on their first request
+# under this path, see uploader.views.ImageVariantView.
+MEDIA_URL = '/media/'
 if not os.path.exists(MEDIA_ROOT):
     os.makedirs(MEDIA_ROOT)
 
+# Local state of the workers and the commands, eg; the CDN sync manifest.
+STATE_ROOT = os.path.join(os.path.dirname(__file__), "../var")
+if not os.path.exists(STATE_ROOT):
+    os.makedirs(STATE_ROOT)
+
 #
 # We will create these many variants of one single image uploaded by a user.
 #
 # Format:-
-#   ('label', (width, height), cache_it)
+#   ('label', (width, height), resize_mode)
 #
 # We can use this for CSS style class definitions.
-# The Third flag is reserved for future usage, Caching certain type of images
-# right after the resize operation.
+# The resize mode is one of 'fit', 'cover', 'smart' or 'stretch', see
+# uploader.imaging. The older boolean flag maps to 'cover' for True and 'fit'
+# for False.
 #
 IMAGE_VARIANTS = [
-    ('thumbnail', (20, 40), True),
-    ('small', (40, 30), True),
-    ('medium', (100, 60), False),
-    ('large', (200, 100), False)
+    ('thumbnail', (20, 40), 'smart'),
+    ('small', (40, 30), 'cover'),
+    ('medium', (100, 60), 'fit'),
+    ('large', (200, 100), 'fit')
 ]
 
+#
+# Images of a day are spread over sub directories of the day's directory by
+# the hash of the file name, so no directory grows too big to list.
+# IMAGE_DIR_SHARD_LEVELS levels of IMAGE_DIR_SHARD_WIDTH hex digits each, eg;
+# 1 level of 2 digits gives 256 directories a day,
+# images/2014/12/06/3f/<name>. 0 keeps all of them in the day's directory.
+# `relocate_images` command moves the files stored with another layout.
+#
+IMAGE_DIR_SHARD_LEVELS = 1
+IMAGE_DIR_SHARD_WIDTH = 2
+
+#
+# Labels of the IMAGE_VARIANTS which are not generated at upload, but
+# rendered when they are requested first time via /media/<image path>.
+#
+ON_DEMAND_IMAGE_VARIANTS = ()
+
+#
+# Encoding of the resized images. Each profile sets the JPEG quality, the
+# progressive and optimize flags, whether the EXIF and ICC metadata of the
+# original are dropped, and whether a WebP sibling is saved next to the
+# variant, eg; <name>-thumbnail.jpg and <name>-thumbnail.webp.
+#
+# Variants keep the format of the original image, WebP siblings are skipped
+# if Pillow is built without WebP support.
+#
+IMAGE_ENCODING_PROFILES = {
+    'default': {
+        'quality': 85,
+        'progressive': True,
+        'optimize': True,
+        'strip_metadata': True,
+        'webp': True,
+        'webp_quality': 80,
+    },
+    'thumbnail': {
+        'quality': 75,
+        'progressive': False,
+        'optimize': True,
+        'strip_metadata': True,
+        'webp': True,
+        'webp_quality': 70,
+    },
+}
+
+# Profile of each IMAGE_VARIANTS label, 'default' if not listed.
+IMAGE_VARIANT_PROFILES = {
+    'thumbnail': 'thumbnail',
+    'small': 'thumbnail',
+}
+
+#
+# Uploads are streamed straight into the image directory, computing the
+# content digest used for deduplication and the image header details while
+# the upload is being received.
+#
+FILE_UPLOAD_HANDLERS = (
+    'uploader.handlers.StreamingUploadHandler',
+)
+
+# Streamed uploads are moved in place, not copied, so set the permission
+# explicitly instead of keeping the temporary file's 0600.
+FILE_UPLOAD_PERMISSIONS = 0o644
+
+#
+# Budgets of the uploaded images, checked from the image header while the
+# upload is being received. Files out of these are rejected before anything
+# is written to the disk, None to disable a check.
+#
+UPLOAD_MAX_BYTES = 50 * 2 ** 20
+UPLOAD_MAX_PIXELS = 50 * 10 ** 6
+UPLOAD_ALLOWED_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+# Address space limit, in bytes, of each resize worker process, the celery
+# workers and the resize pool ones. None to not limit it.
+RESIZE_WORKER_MAX_MEMORY = None
+
+#
+# Concurrent connections per process, when serving on gevent with
+# image_uploader/wsgi_gevent.py.
+#
+GEVENT_MAX_CONNECTIONS = 2000
+
+#
+# Maximum number of images accepted on one batch upload request.
+#
+BATCH_UPLOAD_MAX_FILES = 500
+
+#
+# Page sizes of the image listing API.
+#
+IMAGE_LIST_PAGE_SIZE = 50
+IMAGE_LIST_MAX_PAGE_SIZE = 200
+
+#
+# Deleted images are reaped in batches of these many rows, their files and
+# CDN copies removed with bulk deletes. See uploader.cleanup.
+#
+IMAGE_REAP_BATCH_SIZE = 500
+
+#
+# Number of worker processes used to resize the uploads done with
+# async_operation=false. The variants of an image are split over the workers,
+# each group decoding the original on its own. The pool is created on first
+# use and reused across requests.
+#
+# None - One process per CPU core.
+# 0    - Disable the pool, resize inline on the request thread.
+#
+RESIZE_POOL_PROCESSES = None
+
 
 #
 # Handle Python logging.
@@ -117,6 +238,19 @@ LOG_ROOT = os.path.join(os.path.dirname(__file__), "../logs")
 if not os.path.exists(LOG_ROOT):
     os.makedirs(LOG_ROOT)
 
+#
+# Image operation logs, written by the `ship_logs` task in batches. The file
+# is rotated at IMAGE_LOG_MAX_BYTES, keeping IMAGE_LOG_BACKUP_COUNT old ones.
+#
+IMAGE_LOG_FILE = os.path.join(LOG_ROOT, "image_resize.log")
+IMAGE_LOG_MAX_BYTES = 50 * 2 ** 20
+IMAGE_LOG_BACKUP_COUNT = 5
+
+# Workers ship their buffered log records once these many are buffered, or
+# these many seconds after the first one.
+LOG_SHIP_BATCH_SIZE = 200
+LOG_SHIP_INTERVAL = 5
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -141,7 +275,7 @@ LOGGING = {
         'file_img_op_logger': {
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
-            'filename': os.path.join(LOG_ROOT, "image_resize.log"),
+            'filename': IMAGE_LOG_FILE,
         },
         'file': {
             'level': 'DEBUG',
@@ -167,9 +301,15 @@ LOGGING = {
 #
 # Celery queue settings.
 #
-# resize_image     - Jobs are placed here for resize operation.
-# logger           - Log the image details or uploaded img details.
-# cdn_sync         - Then place it on a queue to sync with CDN.
+# resize_image          - Jobs are placed here for resize operation.
+# resize_image_large    - Resize of the images over RESIZE_LARGE_PIXELS or
+#                         RESIZE_LARGE_BYTES.
+# resize_image_priority - Resize of the single image uploads, a user is
+#                         waiting for those.
+# resize_image_backfill - Variants of the existing images, rendered by the
+#                         `backfill_variants` command.
+# logger                - Log the image details or uploaded img details.
+# cdn_sync              - Then place it on a queue to sync with CDN.
 #
 # NOTE: All using the default Exchange of type  direct.
 #
@@ -181,14 +321,118 @@ CELERY_QUEUES = {
     "resize_image": {
         "routing_key": "resize_image"
     },
+    "resize_image_large": {
+        "routing_key": "resize_image_large"
+    },
+    "resize_image_priority": {
+        "routing_key": "resize_image_priority"
+    },
+    "resize_image_backfill": {
+        "routing_key": "resize_image_backfill"
+    },
     "cdn_sync": {
         "routing_key": "cdn_sync"
     }
 }
 
+# Uploads over either limit go to the resize_image_large queue.
+RESIZE_LARGE_PIXELS = 16 * 10 ** 6
+RESIZE_LARGE_BYTES = 10 * 2 ** 20
+
+#
+# Resize worker lanes, started with `python manage.py resize_worker <lane>`.
+# Large images are taken one at a time, so a few giants never hold back the
+# small ones prefetched behind them. The backfill lane keeps the re-rendering
+# of the existing images off the upload lanes.
+#
+RESIZE_WORKER_LANES = {
+    'small': {
+        'queues': ['resize_image_priority', 'resize_image'],
+        'concurrency': 8,
+        'prefetch_multiplier': 4,
+    },
+    'large': {
+        'queues': ['resize_image_large'],
+        'concurrency': 2,
+        'prefetch_multiplier': 1,
+        'fair': True,
+    },
+    'backfill': {
+        'queues': ['resize_image_backfill'],
+        'concurrency': 2,
+        'prefetch_multiplier': 1,
+        'fair': True,
+    },
+}
+
+#
+# Progress of the `backfill_variants` command, it continues from here when
+# run again with the same IMAGE_VARIANTS.
+#
+VARIANT_BACKFILL_CHECKPOINT = os.path.join(STATE_ROOT,
+                                           "variant_backfill.json")
+
 CELERYD_HIJACK_ROOT_LOGGER = False
 
 
+#
+# Auth tokens issued by the AuthView.
+#
+# AUTH_TOKEN_MODE                - 'session', a session key validated against
+#                                  the session store, or 'signed', a stateless
+#                                  HMAC signed token validated without any DB
+#                                  read.
+# AUTH_TOKEN_MAX_AGE             - Lifetime of the signed tokens in sec.
+# AUTH_TOKEN_REVOCATION_REFRESH  - How often in sec each process reloads the
+#                                  revoked signed tokens, on a background
+#                                  thread.
+#
+AUTH_TOKEN_MODE = 'session'
+AUTH_TOKEN_MAX_AGE = 60 * 60 * 24 * 14
+AUTH_TOKEN_REVOCATION_REFRESH = 60
+
+#
+# Auth token validation cache.
+#
+# AUTH_TOKEN_CACHE_SIZE       - Max tokens kept in the per process LRU cache.
+# AUTH_TOKEN_CACHE_TTL        - Max seconds a validated token is trusted
+#                               without checking the session store again.
+# AUTH_TOKEN_LOCAL_CACHE_TTL  - Max seconds of the above a token is trusted
+#                               from the per process cache alone. A logout
+#                               clears the cache of its own process and the
+#                               shared one, the other processes keep
+#                               accepting the token for up to these many
+#                               seconds.
+# AUTH_TOKEN_SHARED_CACHE     - Optional alias from CACHES shared by all the
+#                               processes, eg; memcached.
+#
+AUTH_TOKEN_CACHE_SIZE = 10000
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_LOCAL_CACHE_TTL = 5
+AUTH_TOKEN_SHARED_CACHE = None
+
+#
+# Storage of the original images, see uploader.storage for the backends.
+#
+# OBJECT_STORAGE_BUCKET   - Bucket of the object store backends.
+# OBJECT_STORAGE_URL      - Base URL of the originals on the object store,
+#                           MEDIA_URL if None.
+# STORAGE_READ_CACHE      - Workers read the originals on a FileSystemStorage
+#                           (eg; a network mount) through the local cache too.
+# STORAGE_CACHE_DIR       - Local read-through cache of the workers.
+# STORAGE_CACHE_MAX_BYTES - Least recently used files are removed over this.
+# TIERED_STORAGE_HOT_DAYS - Local copies older than this are evicted by the
+#                           evict_cold_files command.
+#
+DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+OBJECT_STORAGE_BUCKET = "image-uploader-originals"
+OBJECT_STORAGE_URL = None
+STORAGE_READ_CACHE = False
+STORAGE_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                 "image-uploader-cache")
+STORAGE_CACHE_MAX_BYTES = 10 * 2 ** 30
+TIERED_STORAGE_HOT_DAYS = 7
+
 #
 # AWS S3 Access details.
 #
@@ -197,6 +441,32 @@ AWS_SECRET_ACCESS_KEY = '<your-secret-access-kye>'
 AWS_REGION_NAME = 'us-east-1'
 S3_IMAGE_BUCKET_NAME = "sync_images"
 
+# Point these to a local S3 compatible server for testing, eg;
+# S3_HOST = 'localhost', S3_PORT = 5000, S3_IS_SECURE = False and
+# S3_CALLING_FORMAT = 'boto.s3.connection.OrdinaryCallingFormat'
+S3_HOST = None
+S3_PORT = None
+S3_IS_SECURE = True
+S3_CALLING_FORMAT = None
+
+# Concurrent uploads per worker process. Files bigger than the threshold are
+# sent as multipart uploads, parts of the given size (min 5MB) in parallel.
+S3_UPLOAD_THREADS = 4
+S3_MULTIPART_THRESHOLD = 8 * 2 ** 20
+S3_MULTIPART_CHUNK_SIZE = 8 * 2 ** 20
+
+#
+# Local manifest of the files synced to the CDN, see uploader.manifest.
+#
+CDN_SYNC_MANIFEST = os.path.join(STATE_ROOT, "cdn_manifest.sqlite3")
+
+#
+# Upload the resized images to the CDN from the resize task itself, instead
+# of queuing a cdn_sync task. Enable it when the resize workers also have the
+# S3 credentials, saves one broker message per upload.
+#
+CDN_SYNC_IN_RESIZE_TASK = False
+
 #
 # The CDN task retry settings.
 #
@@ -1,11 +1,27 @@
+import re
+
+from django.conf import settings
 from django.conf.urls import patterns, include, url
 from django.contrib import admin
-from uploader.views import UploaderView, AuthView, CatchAllView
+from django.utils.six.moves.urllib.parse import urlparse
+from uploader.views import (UploaderView, BatchUploaderView, AuthView,
+                            LogoutView, ImageListView, ImageVariantView,
+                            CatchAllView)
+
+# Image URLs handed out by the APIs are under MEDIA_URL, the on-demand
+# renders are served from the same path.
+MEDIA_PREFIX = re.escape(urlparse(settings.MEDIA_URL).path.lstrip('/'))
 
 urlpatterns = patterns(
     '',
     url(r'^admin/', include(admin.site.urls)),
     url(r'^authenticate/', AuthView.as_view(), name="authenticate"),
+    url(r'^logout/', LogoutView.as_view(), name="logout"),
+    url(r'^upload/batch/', BatchUploaderView.as_view(),
+        name="batch_upload_images"),
     url(r'^upload/', UploaderView.as_view(), name="upload_image"),
+    url(r'^images/$', ImageListView.as_view(), name="list_images"),
+    url(r'^' + MEDIA_PREFIX + r'(?P<path>images/[0-9a-f/]+/[^/]+)$',
+        ImageVariantView.as_view(), name="image_variant"),
     # TODO: url(r'^.*$/', CatchAllView.as_view(), name="catch_all")
 )
@@ -0,0 +1,40 @@
+"""
+WSGI config for serving image_uploader on gevent.
+
+One process handles many concurrent uploads, each one waiting on a slow
+client only holds a greenlet instead of a worker thread. The upload body is
+read in chunks as it arrives, the broker calls yield on the socket, and the
+disk writes of the uploads go to gevent's thread pool.
+
+Needs gevent, `pip install gevent`. Run it with gunicorn,
+
+    $ gunicorn -k gevent --worker-connections 2000 \
+        image_uploader.wsgi_gevent:application
+
+or with the gevent server directly,
+
+    $ python -m image_uploader.wsgi_gevent 0.0.0.0:8000
+
+NOTE: Database calls still block, use a gevent friendly driver (eg;
+psycopg2 with psycogreen) for the database of such deployments.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "image_uploader.settings")
+
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+
+
+if __name__ == '__main__':
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from django.conf import settings
+
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else
+                     "127.0.0.1:8000").rpartition(":")
+    WSGIServer((host or "127.0.0.1", int(port)), application,
+               spawn=Pool(settings.GEVENT_MAX_CONNECTIONS)).serve_forever()
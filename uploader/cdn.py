@@ -0,0 +1,210 @@
+"""
+@date: 18/Oct/2026
+
+S3 client used by the CDN sync tasks.
+
+Connections are kept per worker process and thread, so boto reuses its HTTP
+connections across the tasks, and the bucket is created only once per
+process. Files are uploaded concurrently on a small thread pool, large ones
+as multipart uploads with their parts sent in parallel.
+
+Set S3_HOST, S3_PORT, S3_IS_SECURE and S3_CALLING_FORMAT to point it to a
+local S3 compatible stand-in.
+"""
+import os
+import re
+import math
+import threading
+from multiprocessing.pool import ThreadPool
+
+from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+
+from django.conf import settings
+
+# Used to extract Year, Month, day from the file name, so we can create S3 key
+# properly.
+# yyyy/mm/dd/, the shard directories if any, and the file name.
+FILE_PATH_PARSER = re.compile(
+    '^.*?/([0-9]{4})/([0-9]{2})/([0-9]{2})/((?:[0-9a-f]+/)*[^/]+)$')
+
+# Most keys S3 takes on one multi-object delete.
+S3_DELETE_BATCH_SIZE = 1000
+
+_local = threading.local()
+_lock = threading.Lock()
+_bucket_created = set()
+_upload_pool = None
+_pid = None
+
+
+def get_s3_key_name(path):
+    """
+    S3 key name of a locally stored image.
+
+    format: yyyy/mm/dd/[<shard>/...]<file-name>
+    """
+    return "/".join(FILE_PATH_PARSER.findall(path)[0])
+
+
+def get_connection():
+    """
+    S3 connection of the current process and thread.
+    """
+    _reset_after_fork()
+
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        kwargs = {
+            'aws_access_key_id': settings.AWS_ACCESS_KEY_ID,
+            'aws_secret_access_key': settings.AWS_SECRET_ACCESS_KEY,
+            'is_secure': getattr(settings, 'S3_IS_SECURE', True),
+            'port': getattr(settings, 'S3_PORT', None),
+        }
+        if getattr(settings, 'S3_HOST', None):
+            kwargs['host'] = settings.S3_HOST
+        if getattr(settings, 'S3_CALLING_FORMAT', None):
+            kwargs['calling_format'] = settings.S3_CALLING_FORMAT
+
+        conn = _local.conn = S3Connection(**kwargs)
+    return conn
+
+
+def get_bucket(bucket_name=None):
+    """
+    Bucket handle on the connection of the current thread. The bucket is
+    created only on the first call on the process.
+    """
+    bucket_name = bucket_name or settings.S3_IMAGE_BUCKET_NAME
+    conn = get_connection()
+
+    buckets = getattr(_local, 'buckets', None)
+    if buckets is None:
+        buckets = _local.buckets = {}
+
+    if bucket_name not in buckets:
+        with _lock:
+            if bucket_name not in _bucket_created:
+                conn.create_bucket(bucket_name)
+                _bucket_created.add(bucket_name)
+        buckets[bucket_name] = conn.get_bucket(bucket_name, validate=False)
+    return buckets[bucket_name]
+
+
+def upload_files(paths, on_uploaded=None):
+    """
+    Upload the local files to the image bucket, files bigger than
+    `settings.S3_MULTIPART_THRESHOLD` as multipart uploads.
+
+    A failed upload doesn't stop the others. The first error, boto errors as
+    they are, is raised once all the files are tried.
+
+    :param paths: Absolute paths of the files.
+    :param on_uploaded: Optional callable, called with the path of each file
+                        right after its upload.
+    """
+    threshold = settings.S3_MULTIPART_THRESHOLD
+    small, large = [], []
+    for path in paths:
+        (large if os.path.getsize(path) > threshold else small).append(path)
+
+    def _upload_file(path):
+        # Returned, the pool's map would give up on the first raised one.
+        try:
+            upload_file(path)
+        except Exception as ex:
+            return ex
+        on_uploaded and on_uploaded(path)
+
+    pool = _get_upload_pool()
+    errors = [ex for ex in pool.map(_upload_file, small) if ex] \
+        if small else []
+
+    for path in large:
+        try:
+            upload_multipart(path, pool)
+        except Exception as ex:
+            errors.append(ex)
+            continue
+        on_uploaded and on_uploaded(path)
+
+    if errors:
+        raise errors[0]
+
+
+def delete_keys(keys, bucket=None):
+    """
+    Delete the keys with S3 multi-object deletes, up to
+    `S3_DELETE_BATCH_SIZE` keys per request. Keys which are not there count
+    as deleted.
+
+    :param bucket: Image bucket by default.
+    :return: List of the keys failed to delete.
+    """
+    bucket = bucket or get_bucket()
+    failed = []
+    for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        result = bucket.delete_keys(keys[start:start + S3_DELETE_BATCH_SIZE],
+                                    quiet=True)
+        failed.extend(error.key for error in result.errors)
+    return failed
+
+
+def upload_file(path):
+    key = get_bucket().new_key(get_s3_key_name(path))
+    key.set_contents_from_filename(path)
+
+
+def upload_multipart(path, pool=None):
+    """
+    Upload a large file as a multipart upload, parts are sent in parallel on
+    the `pool`.
+    """
+    pool = pool or _get_upload_pool()
+    size = os.path.getsize(path)
+    chunk_size = settings.S3_MULTIPART_CHUNK_SIZE
+    parts = int(math.ceil(size / float(chunk_size)))
+
+    mp = get_bucket().initiate_multipart_upload(get_s3_key_name(path))
+    try:
+        pool.map(_upload_part, [
+            (mp.key_name, mp.id, path, part, part * chunk_size,
+             min(chunk_size, size - part * chunk_size))
+            for part in range(parts)])
+        mp.complete_upload()
+    except Exception:
+        mp.cancel_upload()
+        raise
+
+
+def _upload_part(args):
+    key_name, upload_id, path, part, offset, size = args
+
+    # Bind the upload to the bucket handle of this thread.
+    mp = MultiPartUpload(get_bucket())
+    mp.key_name, mp.id = key_name, upload_id
+
+    with open(path, 'rb') as fp:
+        fp.seek(offset)
+        mp.upload_part_from_file(fp, part + 1, size=size)
+
+
+def _get_upload_pool():
+    global _upload_pool
+
+    _reset_after_fork()
+    with _lock:
+        if _upload_pool is None:
+            _upload_pool = ThreadPool(settings.S3_UPLOAD_THREADS)
+    return _upload_pool
+
+
+def _reset_after_fork():
+    # Connections and threads don't survive a fork, start over on the child.
+    global _local, _upload_pool, _pid
+
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _local = threading.local()
+        _upload_pool = None
+        _bucket_created.clear()
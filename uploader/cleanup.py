@@ -0,0 +1,105 @@
+"""
+@date: 18/Oct/2026
+
+Removal of the deleted images.
+
+The delete API only marks the rows as deleted. The reaper,
+`reap_deleted_images` task or command, removes them in batches later along
+with their files; the originals from the storage, the resized images and
+their siblings from the local disk, and the CDN copies of all with S3
+multi-object deletes. Files shared by the deduplicated uploads stay as long
+as a live row points to them.
+"""
+import os
+import errno
+import logging
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .cdn import get_s3_key_name, delete_keys
+from .imaging import get_sibling_paths
+from .manifest import get_manifest
+from .models import Image, get_media_path, get_resized_image_paths
+
+logger = logging.getLogger(__name__)
+
+
+def get_variant_files(image_name):
+    """
+    Local paths of all the resized images of the original `image_name`,
+    siblings included, whether they are rendered or not.
+    """
+    paths = []
+    for label, variant in get_resized_image_paths(image_name).items():
+        paths.append(variant['path'])
+        paths.extend(get_sibling_paths(label, variant['path']))
+    return paths
+
+
+def remove_image_files(image_names, storage=None, cdn=True):
+    """
+    Remove the originals `image_names` from the storage, their resized
+    images from the local disk, and the CDN copies of all of them.
+
+    :param cdn: False to leave the CDN copies, and their manifest entries.
+    :raises IOError: If some of them couldn't be deleted from the CDN or the
+                     storage. Safe to call again with the same names.
+    """
+    storage = storage or default_storage
+
+    paths = []
+    for name in image_names:
+        paths.extend(get_variant_files(name))
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    failed = []
+    if cdn:
+        # Originals are synced to the CDN along with their resized images.
+        originals = [get_media_path(name) for name in image_names]
+        failed = delete_keys([get_s3_key_name(path)
+                              for path in originals + paths])
+        get_manifest().forget(originals + paths)
+
+    if hasattr(storage, 'delete_many'):
+        failed.extend(storage.delete_many(image_names))
+    else:
+        for name in image_names:
+            storage.delete(name)
+
+    if failed:
+        raise IOError("Failed to delete {} files, eg; {}".format(
+            len(failed), failed[0]))
+
+
+def reap_deleted_images(batch_size=None):
+    """
+    Remove one batch of the deleted images, the oldest first.
+
+    :return: Number of rows removed.
+    """
+    batch_size = batch_size or settings.IMAGE_REAP_BATCH_SIZE
+
+    rows = list(Image.all_objects.filter(deleted_at__isnull=False).order_by(
+        'id').values_list('id', 'image')[:batch_size])
+    if not rows:
+        return 0
+
+    names = set(name for _, name in rows)
+    # Deduplicated uploads which are still live keep the files.
+    names -= set(Image.objects.filter(image__in=names).values_list(
+        'image', flat=True))
+
+    # Rows stay if the files aren't removed, the next run tries again.
+    remove_image_files(sorted(names))
+    Image.all_objects.filter(id__in=[pk for pk, _ in rows]).delete()
+
+    logger.info("Reaped {} deleted images, {} files".format(len(rows),
+                                                           len(names)))
+    return len(rows)
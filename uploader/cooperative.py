@@ -0,0 +1,34 @@
+"""
+@date: 18/Oct/2026
+
+Helpers for serving the app on gevent, see `image_uploader/wsgi_gevent.py`.
+
+With the standard library monkey patched, network I/O of a request (reading
+the upload body, talking to the broker) yields to the other requests. Disk
+I/O doesn't, so the blocking calls are pushed to gevent's thread pool with
+:func:`run_blocking`. Without gevent they are simply called.
+"""
+import socket
+
+try:
+    import gevent
+    import gevent.socket
+except ImportError:
+    gevent = None
+
+
+def is_cooperative():
+    """
+    Whether the process is serving on gevent, with sockets monkey patched.
+    """
+    return gevent is not None and socket.socket is gevent.socket.socket
+
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Call `func`, on gevent's thread pool if the process is serving on gevent,
+    so the other requests keep going meanwhile.
+    """
+    if is_cooperative():
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
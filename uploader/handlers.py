@@ -0,0 +1,217 @@
+"""
+@date: 18/Oct/2026
+
+Custom upload handlers.
+"""
+import os
+import time
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from PIL import ImageFile
+
+from .models import UPLOAD_DIR_FORMAT
+from .imaging import (read_image_meta, check_image_budget, bomb_rejection,
+                      ImageRejected, DECOMPRESSION_BOMB_ERRORS)
+from .cooperative import run_blocking
+
+
+def file_digest(f):
+    """
+    Content digest of an uploaded or stored file, used as the deduplication
+    key of :class:`~uploader.models.Image`.
+    """
+    digest = hashlib.sha256()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StreamedUploadedFile(TemporaryUploadedFile):
+    """
+    An uploaded file written straight into today's image directory under a
+    hidden staging name. Saving it through the storage only renames it to
+    its final name, the content is never copied again.
+
+    Besides the usual attributes it carries the details collected while the
+    upload was streamed in.
+
+    digest       - SHA-256 hex digest of the content.
+    image_meta   - Map of width, height, format and orientation, see
+                   :func:`~uploader.imaging.read_image_meta`. None if the
+                   upload isn't an image.
+    """
+
+    def __init__(self, name, content_type, size, charset,
+                 content_type_extra=None):
+        directory = os.path.join(settings.MEDIA_ROOT,
+                                 time.strftime(UPLOAD_DIR_FORMAT))
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by a concurrent upload.
+                if not os.path.isdir(directory):
+                    raise
+
+        file = tempfile.NamedTemporaryFile(prefix='.', suffix='.upload',
+                                           dir=directory)
+
+        # Skip TemporaryUploadedFile.__init__, it creates the file on
+        # FILE_UPLOAD_TEMP_DIR.
+        super(TemporaryUploadedFile, self).__init__(
+            file, name, content_type, size, charset, content_type_extra)
+
+        self.digest = None
+        self.image_meta = None
+
+    @property
+    def image_format(self):
+        return self.image_meta and self.image_meta['format']
+
+    @property
+    def image_size(self):
+        return self.image_meta and (self.image_meta['width'],
+                                    self.image_meta['height'])
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """
+    Stream the uploaded files chunk by chunk into
+    :class:`StreamedUploadedFile`, computing the size, content digest and
+    image header details on the fly. Memory usage is bounded by the chunk
+    size, whatever the size of the upload. When serving on gevent the disk
+    writes are done on its thread pool.
+
+    The first chunks are held in memory until the image header is parsed.
+    Files out of the budgets, see
+    :func:`~uploader.imaging.check_image_budget`, are skipped before anything
+    is written to the disk. Their errors are kept on `rejected`, and on the
+    `rejected_uploads` attribute of the request.
+    """
+    # The image header should be found within these many bytes.
+    HEADER_SNIFF_LIMIT = 256 * 2 ** 10
+
+    def __init__(self, request=None):
+        super(StreamingUploadHandler, self).__init__(request)
+        self.rejected = []
+        if request is not None:
+            request.rejected_uploads = self.rejected
+
+    def new_file(self, *args, **kwargs):
+        super(StreamingUploadHandler, self).new_file(*args, **kwargs)
+        # Set only once the file is accepted.
+        if hasattr(self, 'file'):
+            del self.file
+        self.header_chunks = []
+        self.image_meta = None
+        self.received = 0
+        self.digest = hashlib.sha256()
+        self.parser = ImageFile.Parser()
+        self.sniffed = 0
+
+        # Size is known upfront only if the client sent it.
+        self._check_size(self.content_length or 0)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        self._check_size(self.received)
+
+        self.digest.update(raw_data)
+
+        if hasattr(self, 'file'):
+            run_blocking(self.file.write, raw_data)
+        else:
+            self.header_chunks.append(raw_data)
+            self._sniff_header(raw_data)
+
+            if self.image_meta is not None:
+                try:
+                    self._accept()
+                except ImageRejected as ex:
+                    self._reject(ex)
+            elif self.parser is None:
+                # Header not found, or not an image we can parse.
+                self._reject(ImageRejected('invalid_image',
+                                           "File is not a valid image."))
+
+        # Chunk consumed, nothing to pass to the next handler.
+        return None
+
+    def file_complete(self, file_size):
+        if not hasattr(self, 'file'):
+            # Whole file is smaller than the header we need.
+            try:
+                if self.image_meta is None:
+                    raise ImageRejected('invalid_image',
+                                        "File is not a valid image.")
+                self._accept()
+            except ImageRejected as ex:
+                self._record(ex)
+                return None
+
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.digest = self.digest.hexdigest()
+        self.file.image_meta = self.image_meta
+        self.parser = None
+
+        return self.file
+
+    def _accept(self):
+        check_image_budget(self.image_meta)
+
+        self.file = run_blocking(StreamedUploadedFile, self.file_name,
+                                 self.content_type, 0, self.charset,
+                                 self.content_type_extra)
+        run_blocking(self.file.write, b"".join(self.header_chunks))
+        self.header_chunks = None
+
+    def _check_size(self, size):
+        max_bytes = getattr(settings, 'UPLOAD_MAX_BYTES', None)
+        if max_bytes and size > max_bytes:
+            self._reject(ImageRejected(
+                'too_large', "File is over {} bytes.".format(max_bytes),
+                limit=max_bytes))
+
+    def _reject(self, ex):
+        self._record(ex)
+        if hasattr(self, 'file'):
+            # Removes the partly written file.
+            self.file.close()
+            del self.file
+        raise SkipFile(ex.message)
+
+    def _record(self, ex):
+        error = ex.as_dict()
+        error['name'] = self.file_name
+        self.rejected.append(error)
+
+    def _sniff_header(self, raw_data):
+        if self.parser is None:
+            return
+
+        try:
+            self.parser.feed(raw_data[:self.HEADER_SNIFF_LIMIT - self.sniffed])
+        except IOError:
+            # Not an image we can parse.
+            self.parser = None
+            return
+        except DECOMPRESSION_BOMB_ERRORS:
+            # Header claims far more pixels than Pillow agrees to open.
+            self.parser = None
+            self._reject(bomb_rejection())
+
+        self.sniffed += len(raw_data)
+        image = self.parser.image
+
+        # Stop feeding once the header is parsed, the parser would start
+        # decoding the image data otherwise.
+        if image is not None:
+            self.image_meta = read_image_meta(image)
+            self.parser = None
+        elif self.sniffed >= self.HEADER_SNIFF_LIMIT:
+            self.parser = None
@@ -0,0 +1,612 @@
+"""
+@date: 18/Oct/2026
+
+Image resize engine used by the resize tasks.
+
+The original image is decoded only once. For JPEG sources we ask the decoder
+to use draft mode, so the DCT-domain downscaling gives us an image just big
+enough for the largest variant instead of the full resolution bitmap. Rest of
+the variants are then generated as a cascade from largest to smallest, each
+one derived from the smallest already generated image which can still cover
+it.
+
+Each variant is resized as per its mode, the third element of its
+`settings.IMAGE_VARIANTS` entry.
+
+fit     - Scaled down to fit within the box, aspect ratio kept.
+cover   - Scaled to cover the box and center cropped to it.
+smart   - Same as cover, but the crop window is slid to the most detailed
+          part of the image.
+stretch - Resized to the exact box, aspect ratio not kept.
+
+Only the full frame images, the prepared source and the `fit` variants, feed
+the cascade.
+
+Variants are encoded as per their profile in
+`settings.IMAGE_ENCODING_PROFILES`, optionally with a WebP sibling.
+"""
+import os
+import zlib
+import math
+import resource
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+
+from PIL import Image, ImageFilter, ImageStat
+from django.conf import settings
+from django.core.files import locks
+from django.utils.encoding import force_bytes
+
+# Resampling filter used on every step of the cascade. The source is already
+# close to the target size after draft decoding, so the better filter is cheap.
+RESAMPLE = Image.ANTIALIAS
+
+RESIZE_MODES = ('fit', 'cover', 'smart', 'stretch')
+
+# Resampling filter of each mode. Cropped modes are used for the thumbnail
+# grade variants, they take the faster bilinear filter, see `_resize`.
+MODE_RESAMPLE = {
+    'fit': RESAMPLE,
+    'stretch': RESAMPLE,
+    'cover': Image.BILINEAR,
+    'smart': Image.BILINEAR,
+}
+
+# Longest side of the edge map used to place the smart crop window.
+SMART_CROP_SAMPLE = 64
+
+# EXIF tag of the image orientation.
+EXIF_ORIENTATION = 0x0112
+
+# Process pool used by the synchronous resize path, created on first use and
+# kept warm between the requests.
+_resize_pool = None
+_resize_pool_lock = threading.Lock()
+
+# On demand renders of the same variant are serialized with a lock file. The
+# lock files are striped over a fixed number of stripes, so they never need
+# any cleanup.
+RENDER_LOCK_STRIPES = 1024
+
+# Raised by Pillow on opening an image over twice its `Image.MAX_IMAGE_PIXELS`,
+# the warning only if the warnings are turned into errors. Older Pillow
+# releases have neither.
+DECOMPRESSION_BOMB_ERRORS = tuple(
+    getattr(Image, name) for name in ('DecompressionBombError',
+                                      'DecompressionBombWarning')
+    if hasattr(Image, name))
+
+# Used when the variant has no profile, or the profiles are not configured.
+DEFAULT_ENCODING_PROFILE = {
+    'quality': 75,
+    'progressive': False,
+    'optimize': False,
+    'strip_metadata': True,
+    'webp': False,
+    'webp_quality': 80,
+}
+
+
+class ImageRejected(Exception):
+    """
+    Upload or stored image which is out of the budgets of this deployment,
+    see `settings.UPLOAD_MAX_BYTES`, `settings.UPLOAD_MAX_PIXELS` and
+    `settings.UPLOAD_ALLOWED_FORMATS`.
+    """
+
+    def __init__(self, code, message, **details):
+        super(ImageRejected, self).__init__(code, message)
+        self.code = code
+        self.message = message
+        self.details = details
+
+    def __reduce__(self):
+        # Raised on the resize pool workers too, pickled back to the caller.
+        return self.__class__, (self.code, self.message), self.__dict__
+
+    def __str__(self):
+        return self.message
+
+    def as_dict(self):
+        error = dict(self.details)
+        error.update(code=self.code, message=self.message)
+        return error
+
+
+def check_image_budget(meta, byte_size=None):
+    """
+    Check an image against the budgets, only its header details are needed.
+
+    :param meta: Details of the image, see :func:`read_image_meta`. None if
+                 it isn't an image we can parse.
+    :param byte_size: Size of the file, if known.
+    :raises ImageRejected: On the first budget it doesn't fit.
+    """
+    max_bytes = getattr(settings, 'UPLOAD_MAX_BYTES', None)
+    if max_bytes and byte_size is not None and byte_size > max_bytes:
+        raise ImageRejected(
+            'too_large', "File is over {} bytes.".format(max_bytes),
+            limit=max_bytes)
+
+    if meta is None:
+        raise ImageRejected('invalid_image', "File is not a valid image.")
+
+    formats = getattr(settings, 'UPLOAD_ALLOWED_FORMATS', None)
+    if formats and meta['format'] not in formats:
+        raise ImageRejected(
+            'format_not_allowed',
+            "Image format {} is not allowed.".format(meta['format']),
+            allowed=list(formats))
+
+    max_pixels = getattr(settings, 'UPLOAD_MAX_PIXELS', None)
+    if max_pixels and meta['width'] * meta['height'] > max_pixels:
+        raise ImageRejected(
+            'too_many_pixels',
+            "Image is over {} pixels.".format(max_pixels),
+            limit=max_pixels, width=meta['width'], height=meta['height'])
+
+
+def bomb_rejection():
+    """
+    :return: The `too_many_pixels` rejection of a decompression bomb error
+             raised by Pillow, so it is reported as any other image over the
+             pixel budget.
+    """
+    max_pixels = getattr(settings, 'UPLOAD_MAX_PIXELS', None) or \
+        Image.MAX_IMAGE_PIXELS
+    return ImageRejected('too_many_pixels',
+                         "Image is over {} pixels.".format(max_pixels),
+                         limit=max_pixels)
+
+
+def open_image(fp):
+    """
+    Same as `PIL.Image.open`, only the header is parsed.
+
+    :raises ImageRejected: If Pillow refuses it as a decompression bomb.
+    """
+    try:
+        return Image.open(fp)
+    except DECOMPRESSION_BOMB_ERRORS as ex:
+        raise bomb_rejection()
+
+
+def read_image_meta(img):
+    """
+    Details of an opened image, only its header needs to be parsed.
+
+    :param img: PIL image.
+    :return: Map of width, height, format and orientation. Orientation is the
+             EXIF orientation tag, None when not present.
+    :rtype: dict
+    """
+    orientation = None
+    if hasattr(img, '_getexif'):
+        try:
+            orientation = (img._getexif() or {}).get(EXIF_ORIENTATION)
+        except Exception:
+            # Broken EXIF data shouldn't fail the upload.
+            pass
+
+    return {
+        'width': img.size[0],
+        'height': img.size[1],
+        'format': img.format,
+        'orientation': orientation
+    }
+
+
+def get_resize_mode(label):
+    """
+    Resize mode of the variant `label`. The legacy boolean flags map to
+    `cover` for True and `fit` for False.
+    """
+    for variant in settings.IMAGE_VARIANTS:
+        if variant[0] == label:
+            mode = variant[2] if len(variant) > 2 else 'fit'
+            if mode is True:
+                return 'cover'
+            if mode in RESIZE_MODES:
+                return mode
+            return 'fit'
+    return 'fit'
+
+
+def get_frame_size(img_size, size, mode):
+    """
+    Size the whole image has to be scaled to, before any cropping, for a
+    variant of `size` in `mode`.
+    """
+    scales = (size[0] / float(img_size[0]), size[1] / float(img_size[1]))
+    scale = min(scales) if mode == 'fit' else max(scales)
+    if mode == 'fit':
+        # Never upscaled.
+        scale = min(scale, 1.0)
+    return (max(1, int(math.ceil(img_size[0] * scale))),
+            max(1, int(math.ceil(img_size[1] * scale))))
+
+
+def open_for_variants(path, sizes):
+    """
+    Open the image at `path` and decode it at the smallest scale which can
+    still produce all the given sizes.
+
+    :param path: Absolute path of the original image.
+    :param sizes: List of (width, height) tuples.
+    :return: Loaded PIL image.
+    :raises ImageRejected: If the image is out of the budgets, checked
+                           before anything is decoded.
+    """
+    img = open_image(path)
+    check_image_budget(read_image_meta(img), os.path.getsize(path))
+
+    if sizes:
+        # Bounding box of all the variants, draft mode never goes below it.
+        img.draft(img.mode, (max(s[0] for s in sizes),
+                             max(s[1] for s in sizes)))
+    img.load()
+    return img
+
+
+def generate_variants(path, targets, resample=None):
+    """
+    Generate the resized images of the original image at `path`.
+
+    :param path: Absolute path of the original image.
+    :param targets: List of (label, (width, height)) tuples. The label
+                    decides the resize mode, see :func:`get_resize_mode`.
+    :param resample: PIL resampling filter, by default chosen per mode.
+
+    :return: Generator of (label, PIL image), ordered from the largest
+             variant to the smallest one.
+    """
+    targets = [(key, tuple(size), get_resize_mode(key))
+               for key, size in targets]
+    if not targets:
+        return
+
+    # Sizes are compared in the scale of the original image.
+    original_size = open_image(path).size
+    frames = dict((key, get_frame_size(original_size, size, mode))
+                  for key, size, mode in targets)
+    targets.sort(key=lambda t: frames[t[0]][0] * frames[t[0]][1],
+                 reverse=True)
+
+    source = open_for_variants(path, list(frames.values()))
+    ratio = source.size[0] / float(original_size[0])
+
+    # Full frame images, which can be the source of the next smaller ones.
+    generated = []
+
+    for key, size, mode in targets:
+        frame = (frames[key][0] * ratio, frames[key][1] * ratio)
+        base = source
+        for img in generated:
+            if img.size[0] >= frame[0] and img.size[1] >= frame[1]:
+                # Latest one which covers the target is the smallest one.
+                base = img
+
+        resized = _resize_variant(base, size, mode,
+                                  resample or MODE_RESAMPLE[mode])
+        if mode == 'fit':
+            generated.append(resized)
+        yield key, resized
+
+
+def get_variant_size(img_size, size, mode):
+    """
+    Size of the variant of `size` in `mode`, made from an image of
+    `img_size`. Only the 'fit' ones keep the aspect ratio of the image.
+    """
+    if mode != 'fit':
+        return tuple(size)
+    scale = min(size[0] / float(img_size[0]),
+                size[1] / float(img_size[1]), 1.0)
+    return (max(1, int(round(img_size[0] * scale))),
+            max(1, int(round(img_size[1] * scale))))
+
+
+def _resize_variant(img, size, mode, resample):
+    if mode == 'fit':
+        return _resize(img, get_variant_size(img.size, size, mode), resample)
+
+    if mode in ('cover', 'smart'):
+        # Largest window of the target's aspect ratio.
+        crop = (min(img.size[0], img.size[1] * size[0] / float(size[1])),
+                min(img.size[1], img.size[0] * size[1] / float(size[0])))
+        crop = (max(1, int(round(crop[0]))), max(1, int(round(crop[1]))))
+
+        if mode == 'smart':
+            left, top = _smart_crop_offset(img, crop)
+        else:
+            left = (img.size[0] - crop[0]) // 2
+            top = (img.size[1] - crop[1]) // 2
+        if crop != img.size:
+            img = img.crop((left, top, left + crop[0], top + crop[1]))
+
+    return _resize(img, size, resample)
+
+
+def _resize(img, size, resample):
+    if img.size == tuple(size):
+        return img.copy()
+    # Pillow 2.x bilinear filter doesn't antialias, it is good only while
+    # the image is reduced at most by half.
+    if resample != RESAMPLE and (img.size[0] > 2 * size[0] or
+                                 img.size[1] > 2 * size[1]):
+        resample = RESAMPLE
+    return img.resize(tuple(size), resample)
+
+
+def _smart_crop_offset(img, crop):
+    """
+    Offset of the `crop` sized window with the most edges, the window slides
+    only along the axis the image is cropped on.
+    """
+    horizontal = crop[0] < img.size[0]
+    if not horizontal and crop[1] >= img.size[1]:
+        return 0, 0
+
+    scale = min(1.0, SMART_CROP_SAMPLE / float(max(img.size)))
+    sample_size = (max(3, int(img.size[0] * scale)),
+                   max(3, int(img.size[1] * scale)))
+    edges = img.resize(sample_size, Image.NEAREST).convert('L').filter(
+        ImageFilter.FIND_EDGES)
+    # The filter leaves the border pixels as they are, skip them.
+    edges = edges.crop((1, 1, sample_size[0] - 1, sample_size[1] - 1))
+
+    steps = edges.size[0] if horizontal else edges.size[1]
+    energy = [0]
+    for i in range(steps):
+        box = (i, 0, i + 1, edges.size[1]) if horizontal else \
+            (0, i, edges.size[0], i + 1)
+        energy.append(energy[-1] + ImageStat.Stat(edges.crop(box)).sum[0])
+
+    full, window = (img.size[0], crop[0]) if horizontal else \
+        (img.size[1], crop[1])
+    span = max(1, int(round(window * steps / float(full))))
+    best = max(range(steps - span + 1),
+               key=lambda i: energy[i + span] - energy[i])
+
+    offset = min(full - window, int(round(best * full / float(steps))))
+    return (offset, 0) if horizontal else (0, offset)
+
+
+def get_encoding_profile(label):
+    """
+    Encoding profile of the variant `label`, see
+    `settings.IMAGE_ENCODING_PROFILES`.
+    """
+    profiles = getattr(settings, 'IMAGE_ENCODING_PROFILES', {})
+    name = getattr(settings, 'IMAGE_VARIANT_PROFILES', {}).get(
+        label, 'default')
+
+    profile = dict(DEFAULT_ENCODING_PROFILE)
+    profile.update(profiles.get(name) or profiles.get('default') or {})
+    return profile
+
+
+def webp_supported():
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def get_webp_path(path):
+    return os.path.splitext(path)[0] + '.webp'
+
+
+def get_sibling_paths(label, path):
+    """
+    Paths of the extra files saved along with the variant `label` at `path`.
+    """
+    if path.lower().endswith('.webp') or \
+       not get_encoding_profile(label)['webp'] or not webp_supported():
+        return []
+    return [get_webp_path(path)]
+
+
+def save_variant(img, path, label):
+    """
+    Encode a resized image as per the profile of the variant `label`. The
+    format is decided by the extension of `path`.
+
+    :return: List of the saved paths, the variant and its siblings.
+    """
+    profile = get_encoding_profile(label)
+
+    Image.init()
+    fmt = Image.EXTENSION.get(os.path.splitext(path)[1].lower())
+
+    _encode(img, path, fmt, profile)
+    saved = [path]
+
+    for sibling in get_sibling_paths(label, path):
+        _encode(img, sibling, 'WEBP', profile)
+        saved.append(sibling)
+
+    return saved
+
+
+def _encode(img, path, fmt, profile):
+    params = {}
+    if not profile['strip_metadata']:
+        for key in ('exif', 'icc_profile'):
+            if img.info.get(key):
+                params[key] = img.info[key]
+
+    if fmt == 'JPEG':
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        params.update(quality=profile['quality'],
+                      progressive=profile['progressive'],
+                      optimize=profile['optimize'])
+    elif fmt == 'WEBP':
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or
+                              img.mode in ('LA', 'PA') else 'RGB')
+        params['quality'] = profile['webp_quality']
+    elif fmt == 'PNG':
+        params['optimize'] = profile['optimize']
+
+    img.save(path, fmt, **params)
+
+
+def save_variants(path, targets):
+    """
+    Generate and save the resized images of the original image at `path`.
+
+    :param path: Absolute path of the original image.
+    :param targets: List of (label, (width, height), destination_path)
+                    tuples.
+    :return: List of labels, in the order they got saved.
+    """
+    destinations = dict((key, dest) for key, _, dest in targets)
+    saved = []
+
+    for key, img in generate_variants(
+            path, [(key, size) for key, size, _ in targets]):
+        save_variant(img, destinations[key], key)
+        saved.append(key)
+
+    return saved
+
+
+def limit_memory():
+    """
+    Cap the address space of this process to
+    `settings.RESIZE_WORKER_MAX_MEMORY`, so a pathological image fails its
+    own decode with a MemoryError instead of exhausting the node.
+    """
+    max_memory = getattr(settings, 'RESIZE_WORKER_MAX_MEMORY', None)
+    if max_memory:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+def _save_variants(args):
+    # Entry point on the pool workers, one group of variants per call, see
+    # `split_targets`.
+    path, targets = args
+    return save_variants(path, targets)
+
+
+def split_targets(targets, groups):
+    """
+    Split the targets of :func:`save_variants` into up to `groups` cascades,
+    contiguous runs from the largest variant to the smallest. Each one is
+    saved on its own, decoding the original at the draft scale of its own
+    largest variant.
+
+    :return: List of the non-empty target lists, largest variants first.
+    """
+    targets = sorted(targets, key=lambda t: t[1][0] * t[1][1], reverse=True)
+    groups = max(1, min(groups, len(targets)))
+
+    split, start = [], 0
+    for i in range(groups):
+        end = start + len(targets) // groups + \
+            (1 if i < len(targets) % groups else 0)
+        split.append(targets[start:end])
+        start = end
+    return split
+
+
+def get_resize_pool():
+    """
+    Return the shared resize process pool, or None if it is disabled by
+    `settings.RESIZE_POOL_PROCESSES`. Its workers run under the same memory
+    cap as the resize task workers.
+    """
+    global _resize_pool
+
+    processes = getattr(settings, 'RESIZE_POOL_PROCESSES', None)
+    if processes == 0:
+        return None
+
+    if _resize_pool is None:
+        # Concurrent first requests would each create, and leak, a pool.
+        with _resize_pool_lock:
+            if _resize_pool is None:
+                _resize_pool = multiprocessing.Pool(processes,
+                                                    initializer=limit_memory)
+    return _resize_pool
+
+
+def save_variants_in_pool(path, targets):
+    """
+    Same as :func:`save_variants`, but run on the workers of the resize pool.
+    The variants are split into one cascade per worker, see
+    :func:`split_targets`, and saved in parallel off the request thread.
+
+    Falls back to :func:`save_variants` when the pool is disabled.
+    """
+    pool = get_resize_pool()
+    if pool is None:
+        return save_variants(path, targets)
+
+    processes = getattr(settings, 'RESIZE_POOL_PROCESSES', None) or \
+        multiprocessing.cpu_count()
+    results = pool.map_async(_save_variants, [
+        (path, group) for group in split_targets(targets, processes)]).get()
+    return [key for saved in results for key in saved]
+
+
+def render_variant(path, size, dest_path, label):
+    """
+    Render a single variant on demand. Concurrent renders of the same variant,
+    from any thread or process on this node, are coalesced to one.
+
+    :param path: Absolute path of the original image.
+    :param size: (width, height) of the variant.
+    :param dest_path: Where to save the variant.
+    :param label: Label of the variant, decides its encoding.
+    :return: List of the files rendered by this call, the variant and its
+             siblings. Empty if it was already there.
+    """
+    with _render_lock(dest_path):
+        if os.path.exists(dest_path):
+            return []
+
+        # Keep the extension, PIL decides the format from it.
+        directory, name = os.path.split(dest_path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.render-',
+                                        suffix='-' + name, dir=directory)
+        os.close(fd)
+
+        renames = list(zip(
+            [tmp_path] + get_sibling_paths(label, tmp_path),
+            [dest_path] + get_sibling_paths(label, dest_path)))
+        try:
+            save_variants(path, [(label, size, tmp_path)])
+            # Readers see either no file or the complete one. The variant
+            # goes last, its presence marks the whole render as done.
+            for src, dest in reversed(renames):
+                os.chmod(src, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+                os.rename(src, dest)
+        except Exception:
+            for src, _ in renames:
+                if os.path.exists(src):
+                    os.remove(src)
+            raise
+        return [dest for _, dest in renames]
+
+
+@contextlib.contextmanager
+def _render_lock(dest_path):
+    directory = os.path.join(tempfile.gettempdir(), 'uploader-render-locks')
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    stripe = (zlib.crc32(force_bytes(dest_path)) & 0xffffffff) % \
+        RENDER_LOCK_STRIPES
+    with open(os.path.join(directory, '%04d.lock' % stripe), 'a') as f:
+        locks.lock(f, locks.LOCK_EX)
+        try:
+            yield
+        finally:
+            locks.unlock(f)
@@ -0,0 +1,159 @@
+"""
+@date: 18/Oct/2026
+
+Buffered shipping of the image operation logs.
+
+The workers don't send a broker message per log line. Records are buffered
+per process and shipped to the `ship_logs` aggregator task in batches, once
+`settings.LOG_SHIP_BATCH_SIZE` records are buffered or
+`settings.LOG_SHIP_INTERVAL` seconds after the first buffered one, whichever
+comes first. Left over records are shipped when the process exits.
+
+The aggregator writes each batch to `settings.IMAGE_LOG_FILE` with one
+buffered append, rotating the file at `settings.IMAGE_LOG_MAX_BYTES`.
+"""
+import os
+import time
+import atexit
+import threading
+
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.core.files import locks
+
+_shipper = None
+_shipper_pid = None
+
+
+def get_shipper():
+    """
+    Log shipper of the current process.
+    """
+    global _shipper, _shipper_pid
+
+    if _shipper is None or _shipper_pid != os.getpid():
+        # Imported here, tasks module uses this one.
+        from .tasks import ship_logs
+
+        _shipper = LogShipper(ship_logs.delay,
+                              settings.LOG_SHIP_BATCH_SIZE,
+                              settings.LOG_SHIP_INTERVAL)
+        _shipper_pid = os.getpid()
+    return _shipper
+
+
+def ship_log(log_level, messages, async_operation=True):
+    """
+    Log the image operation `messages`. Synchronous operations write them
+    right away, without the broker.
+
+    :param log_level: Logger level. eg; INFO, ERROR, WARNING
+    :param messages: List of messages.
+    """
+    records = [(log_level, msg, time.time()) for msg in messages]
+    if async_operation:
+        get_shipper().add(records)
+    else:
+        append_records(records)
+
+
+def flush():
+    """
+    Ship the buffered records of this process.
+    """
+    if _shipper is not None and _shipper_pid == os.getpid():
+        _shipper.flush()
+
+
+def _flush_on_shutdown(**kwargs):
+    flush()
+
+
+worker_process_shutdown.connect(_flush_on_shutdown)
+atexit.register(flush)
+
+
+class LogShipper(object):
+    """
+    Buffer of log records, shipped in batches by calling `send` with a list
+    of (log_level, message, timestamp) tuples.
+    """
+
+    def __init__(self, send, batch_size, interval):
+        self.send = send
+        self.batch_size = batch_size
+        self.interval = interval
+        self._records = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, records):
+        with self._lock:
+            self._records.extend(records)
+            if len(self._records) < self.batch_size:
+                if self._timer is None and self._records:
+                    self._timer = threading.Timer(self.interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            batch = self._take()
+        self.send(batch)
+
+    def flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self.send(batch)
+
+    def _take(self):
+        # Caller holds the lock.
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._records = self._records, []
+        return batch
+
+
+def append_records(records, path=None, max_bytes=None, backup_count=None):
+    """
+    Write the log records with one buffered append, rotating the file first
+    if they would take it over `max_bytes`. Safe to call from many processes.
+
+    :param records: List of (log_level, message, timestamp) tuples.
+    """
+    path = path or settings.IMAGE_LOG_FILE
+    max_bytes = settings.IMAGE_LOG_MAX_BYTES if max_bytes is None \
+        else max_bytes
+    backup_count = settings.IMAGE_LOG_BACKUP_COUNT if backup_count is None \
+        else backup_count
+
+    data = u"".join(u"{}\n".format(msg) for _, msg, _ in records)
+    if not data:
+        return
+    data = data.encode('utf-8')
+
+    with open(path + ".lock", 'a') as lock_file:
+        locks.lock(lock_file, locks.LOCK_EX)
+        try:
+            if max_bytes and os.path.exists(path) and \
+               os.path.getsize(path) + len(data) > max_bytes:
+                _rotate(path, backup_count)
+
+            with open(path, 'a') as f:
+                f.write(data)
+        finally:
+            locks.unlock(lock_file)
+
+
+def _rotate(path, backup_count):
+    # Same naming as logging.handlers.RotatingFileHandler, path.1 is the
+    # latest one.
+    if backup_count <= 0:
+        os.remove(path)
+        return
+
+    for i in range(backup_count - 1, 0, -1):
+        src = "{}.{}".format(path, i)
+        if os.path.exists(src):
+            os.rename(src, "{}.{}".format(path, i + 1))
+    os.rename(path, path + ".1")
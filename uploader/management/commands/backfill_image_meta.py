@@ -0,0 +1,67 @@
+"""
+@date: 18/Oct/2026
+
+Fill the original image details (dimensions, format, size and orientation)
+of the rows stored before those were captured at upload. Only the first
+HEADER_BYTES of each original are read, with a ranged read on the object
+store, the size comes from the storage.
+
+    $ python manage.py backfill_image_meta --batch-size 500
+"""
+from io import BytesIO
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.core.files.storage import default_storage
+
+from uploader.models import Image
+from uploader.imaging import read_image_meta, open_image, ImageRejected
+from uploader.storage import read_head
+
+# Enough for the header of the formats we take, EXIF blocks included.
+HEADER_BYTES = 256 * 2 ** 10
+
+
+class Command(NoArgsCommand):
+    help = "Backfill the original image details of the older images."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500, help="Rows fetched per query."),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    default=False,
+                    help="Only report the rows to be filled."),
+    )
+
+    def handle_noargs(self, **options):
+        updated, failed, last_id = 0, 0, 0
+
+        while True:
+            # Keyset pagination, the updated rows leave the filter anyway.
+            images = list(Image.objects.filter(
+                width__isnull=True, id__gt=last_id).order_by('id').only(
+                    'id', 'image')[:options['batch_size']])
+            if not images:
+                break
+            last_id = images[-1].id
+
+            for image in images:
+                try:
+                    name = image.image.name
+                    meta = read_image_meta(open_image(BytesIO(
+                        read_head(name, HEADER_BYTES))))
+                    byte_size = default_storage.size(name)
+                except (IOError, OSError, ImageRejected) as ex:
+                    failed += 1
+                    self.stderr.write("Image {}: {}".format(image.id, ex))
+                    continue
+
+                if not options['dry_run']:
+                    Image.objects.filter(pk=image.id).update(
+                        width=meta['width'], height=meta['height'],
+                        format=meta['format'] or '',
+                        orientation=meta['orientation'], byte_size=byte_size)
+                updated += 1
+
+        self.stdout.write("Updated: {}, failed: {}{}".format(
+            updated, failed, " (dry run)" if options['dry_run'] else ""))
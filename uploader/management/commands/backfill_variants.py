@@ -0,0 +1,381 @@
+"""
+@date: 18/Oct/2026
+
+Render the resized images missing or stale as per the current
+IMAGE_VARIANTS, eg; after a variant is added or its size changed.
+
+A variant is missing if it or its sibling isn't there, stale if its size
+doesn't match the configured one. Images are read in keyset chunks by id,
+and the progress is checkpointed on `settings.VARIANT_BACKFILL_CHECKPOINT`
+after every completed task, so an interrupted backfill continues from
+there. Changing IMAGE_VARIANTS starts it over, use --restart to check every
+image again.
+
+By default the variants are rendered from this process. With --async they
+are queued to the `resize_image_backfill` queue, served by the backfill
+resize lane, with at most --max-queued tasks waiting at a time. The AMQP
+brokers report the depth of the queue, on the others the tasks queued by
+this run and not finished yet are counted instead. A queued task counts as
+completed once all its variants are written after it got queued, so the
+checkpoint never passes a task lost with the queue. A task which finished
+without writing all of them, eg; its original is rejected by the budgets or
+gone, is passed over, and its images are recorded as failed on the
+checkpoint. Tasks not finished by the end of the run are checked again by
+the next one.
+
+    $ python manage.py backfill_variants --dry-run
+    $ python manage.py backfill_variants --async --max-queued 20
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from collections import deque
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.conf import settings
+from PIL import Image as PILImage
+
+from image_uploader.celery import app
+from uploader.imaging import (get_sibling_paths, get_resize_mode,
+                              get_variant_size, save_variants)
+from uploader.models import Image, get_resized_image_paths
+from uploader.storage import get_local_path
+from uploader.tasks import render_variants
+
+BACKFILL_QUEUE = "resize_image_backfill"
+
+
+def get_variants_digest():
+    """
+    Digest of the variant configuration, a checkpoint is valid only for the
+    configuration it is made with.
+    """
+    return hashlib.md5(repr((
+        [tuple(v) for v in settings.IMAGE_VARIANTS],
+        getattr(settings, 'IMAGE_VARIANT_PROFILES', None),
+        getattr(settings, 'IMAGE_ENCODING_PROFILES', None)))).hexdigest()
+
+
+def get_queue_depth(queue):
+    """
+    Number of messages waiting on the broker `queue`, None if the broker
+    can't tell. Only the AMQP brokers have the passive declare it is read
+    with.
+    """
+    with app.connection_or_acquire() as conn:
+        if conn.transport.driver_type != 'amqp':
+            return None
+        try:
+            return conn.default_channel.queue_declare(
+                queue=queue, passive=True).message_count
+        except conn.channel_errors:
+            # Not declared yet, nothing sent to it.
+            return 0
+
+
+def is_stale(path, img_size, size, mode):
+    """
+    Whether the variant at `path` is of another size than configured. A
+    pixel off is fine, variants cascade down from the larger ones.
+    """
+    try:
+        variant_size = PILImage.open(path).size
+    except IOError:
+        return True
+    expected = get_variant_size(img_size, size, mode)
+    return abs(variant_size[0] - expected[0]) > 1 or \
+        abs(variant_size[1] - expected[1]) > 1
+
+
+class Command(NoArgsCommand):
+    help = "Render the missing or stale variants of the existing images."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500, help="Rows fetched per query."),
+        make_option('--task-size', dest='task_size', type='int', default=20,
+                    help="Images per render task."),
+        make_option('--async', dest='async_operation', action='store_true',
+                    default=False,
+                    help="Queue the tasks to the backfill resize lane "
+                         "instead of rendering from this process."),
+        make_option('--max-queued', dest='max_queued', type='int',
+                    default=10,
+                    help="Most tasks waiting on the queue at a time, with "
+                         "--async. The backfill lane's concurrency caps the "
+                         "running ones, they are counted too on the non "
+                         "AMQP brokers."),
+        make_option('--delay', dest='delay', type='float', default=0,
+                    help="Seconds to wait after each task."),
+        make_option('--missing-only', dest='check_stale',
+                    action='store_false', default=True,
+                    help="Skip the size check of the existing variants, no "
+                         "file is opened then."),
+        make_option('--restart', dest='restart', action='store_true',
+                    default=False, help="Ignore the checkpoint."),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    default=False,
+                    help="Only estimate the work, nothing is queued."),
+        make_option('--sample', dest='sample', type='int', default=10,
+                    help="Images rendered to a temporary directory, to "
+                         "estimate the render time on a dry run."),
+    )
+
+    def handle_noargs(self, **options):
+        self.options = options
+        self.checkpoint = settings.VARIANT_BACKFILL_CHECKPOINT
+        self.digest = get_variants_digest()
+        self.stats = {'images': 0, 'missing': 0, 'stale': 0, 'pixels': 0,
+                      'bytes': 0}
+        self.samples = []
+        # (jobs, last id, queued at, done path) of the queued tasks, oldest
+        # first.
+        self.queued = deque()
+        # Names of the images of which the variants failed to render.
+        self.failed = []
+
+        last_id = 0 if options['restart'] else self.read_checkpoint()
+        if last_id:
+            self.stdout.write("Continuing after image id {}".format(last_id))
+
+        # Created by the tasks queued by this run once they are over.
+        self.done_dir = tempfile.mkdtemp(
+            prefix='variant_backfill-',
+            dir=os.path.dirname(self.checkpoint))
+        try:
+            self.backfill(last_id)
+        finally:
+            shutil.rmtree(self.done_dir)
+
+        self.report()
+
+    def backfill(self, last_id):
+        options = self.options
+
+        jobs = []
+        while True:
+            rows = list(Image.objects.filter(id__gt=last_id).order_by(
+                'id')[:options['batch_size']])
+            if not rows:
+                break
+
+            # Deduplicated uploads share the variants, checked only on the
+            # first row of the file.
+            names = set(image.image.name for image in rows)
+            seen = set(Image.objects.filter(
+                image__in=names, id__lt=rows[0].id).values_list(
+                    'image', flat=True))
+
+            for image in rows:
+                if image.image.name in seen:
+                    continue
+                seen.add(image.image.name)
+
+                try:
+                    labels = self.get_pending_labels(image)
+                except (IOError, OSError) as ex:
+                    # Original is gone, the dimensions can't be read.
+                    self.stderr.write("Skipped {}: {}".format(
+                        image.image.name, ex))
+                    continue
+                if labels:
+                    jobs.append((image.image.name, labels))
+                    self.count(image)
+
+                if len(jobs) >= options['task_size']:
+                    self.dispatch(jobs, image.id)
+                    jobs = []
+            last_id = rows[-1].id
+
+        if jobs:
+            self.dispatch(jobs, last_id)
+
+        self.advance_checkpoint()
+        if self.queued:
+            self.stdout.write(
+                "{} tasks not completed yet, checkpoint kept before image "
+                "id {}".format(len(self.queued), self.queued[0][1]))
+        else:
+            # The images after it get all the variants at upload, until the
+            # configuration changes.
+            self.write_checkpoint(last_id)
+
+    def get_pending_labels(self, image):
+        """
+        :return: Labels of the variants to render, the missing or stale ones.
+        """
+        on_demand = getattr(settings, 'ON_DEMAND_IMAGE_VARIANTS', ())
+        labels = []
+        for label, variant in get_resized_image_paths(
+                image.image.name).items():
+            if label in on_demand:
+                continue
+
+            path = variant['path']
+            if not all(os.path.exists(p) for p in
+                       [path] + get_sibling_paths(label, path)):
+                self.stats['missing'] += 1
+                labels.append(label)
+            elif self.options['check_stale'] and is_stale(
+                    path, image.dimensions, variant['size'],
+                    get_resize_mode(label)):
+                self.stats['stale'] += 1
+                labels.append(label)
+        return sorted(labels)
+
+    def count(self, image):
+        width, height = image.dimensions
+        self.stats['images'] += 1
+        self.stats['pixels'] += width * height
+        self.stats['bytes'] += image.byte_size or 0
+
+    def dispatch(self, jobs, last_id):
+        """
+        Render the `jobs`, then record everything up to `last_id` as done.
+        """
+        options = self.options
+        if options['dry_run']:
+            if len(self.samples) < options['sample']:
+                self.sample(jobs[:options['sample'] - len(self.samples)])
+            return
+
+        if options['async_operation']:
+            # Throttled by the backlog of the backfill lane.
+            while True:
+                depth = get_queue_depth(BACKFILL_QUEUE)
+                if depth is None:
+                    # Broker can't tell, count the ones in flight instead.
+                    self.advance_checkpoint()
+                    depth = len(self.queued)
+                if depth < options['max_queued']:
+                    break
+                time.sleep(1)
+            done_path = os.path.join(self.done_dir, str(last_id))
+            self.queued.append((jobs, last_id, time.time(), done_path))
+            render_variants.apply_async(
+                (jobs,), kwargs={'done_path': done_path},
+                queue=BACKFILL_QUEUE, routing_key=BACKFILL_QUEUE)
+            self.advance_checkpoint()
+        else:
+            started = time.time()
+            render_variants(jobs, async_operation=False)
+            self.record_failed(self.get_failed(jobs, started))
+            self.write_checkpoint(last_id)
+
+        options['delay'] and time.sleep(options['delay'])
+
+    def advance_checkpoint(self):
+        """
+        Record the queued tasks finished so far, in the order they got
+        queued.
+        """
+        last_id = None
+        while self.queued:
+            jobs, task_last_id, queued_at, done_path = self.queued[0]
+            # Checked first, the variants are all written by then.
+            done = os.path.exists(done_path)
+            failed = self.get_failed(jobs, queued_at)
+            if failed and not done:
+                break
+            self.queued.popleft()
+            self.record_failed(failed)
+            last_id = task_last_id
+        if last_id is not None:
+            self.write_checkpoint(last_id)
+
+    def get_failed(self, jobs, since):
+        """
+        :return: Names of the images of the `jobs` of which not all the
+                 variants are written after `since`.
+        """
+        # Modification times can be truncated to the second.
+        since = int(since)
+        failed = []
+        for image_name, labels in jobs:
+            variants = get_resized_image_paths(image_name)
+            for label in labels:
+                try:
+                    if os.path.getmtime(variants[label]['path']) < since:
+                        break
+                except OSError:
+                    break
+            else:
+                continue
+            failed.append(image_name)
+        return failed
+
+    def record_failed(self, image_names):
+        for image_name in image_names:
+            self.stderr.write("Failed to render {}".format(image_name))
+        self.failed.extend(image_names)
+
+    def sample(self, jobs):
+        """
+        Time rendering the `jobs` into a temporary directory.
+        """
+        out_dir = tempfile.mkdtemp()
+        try:
+            for image_name, labels in jobs:
+                variants = get_resized_image_paths(image_name)
+                targets = [(label, variants[label]['size'], os.path.join(
+                    out_dir, os.path.basename(variants[label]['path'])))
+                    for label in labels]
+
+                start = time.time()
+                try:
+                    original = get_local_path(image_name)
+                    size = PILImage.open(original).size
+                    save_variants(original, targets)
+                except Exception as ex:
+                    self.stderr.write("Can't render {}: {}".format(
+                        image_name, ex))
+                    continue
+                self.samples.append((time.time() - start,
+                                     size[0] * size[1]))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def report(self):
+        stats = self.stats
+        self.stdout.write(
+            "Images: {images}, missing variants: {missing}, stale variants: "
+            "{stale}".format(**stats))
+        self.stdout.write("Originals to decode: {:.1f} Mpx, {:.1f} MB".format(
+            stats['pixels'] / 1e6, stats['bytes'] / 2.0 ** 20))
+        if self.failed:
+            self.stdout.write("Failed images: {}, listed on {}".format(
+                len(self.failed), self.checkpoint))
+
+        seconds = sum(s[0] for s in self.samples)
+        pixels = sum(s[1] for s in self.samples)
+        if self.options['dry_run'] and pixels:
+            self.stdout.write(
+                "Estimated render time: {:.0f} CPU seconds, from {} "
+                "sampled images".format(seconds / pixels * stats['pixels'],
+                                        len(self.samples)))
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return 0
+        if checkpoint.get('variants') != self.digest:
+            # Made for another configuration, everything is to be checked
+            # again.
+            return 0
+        self.failed = checkpoint.get('failed', [])
+        return checkpoint.get('last_id', 0)
+
+    def write_checkpoint(self, last_id):
+        if self.options['dry_run']:
+            return
+        tmp_path = self.checkpoint + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_id': last_id, 'variants': self.digest,
+                       'failed': self.failed}, f)
+        os.rename(tmp_path, self.checkpoint)
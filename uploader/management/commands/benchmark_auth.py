@@ -0,0 +1,74 @@
+"""
+@date: 18/Oct/2026
+
+Measure the auth token validation overhead of the upload API, with and
+without the token cache.
+
+    $ python manage.py benchmark_auth --requests 5000
+"""
+import time
+import uuid
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth import SESSION_KEY
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.module_loading import import_string
+
+from uploader.utils import validate_auth_token, token_cache
+
+
+class _DummyView(object):
+
+    @validate_auth_token
+    def post(self, request):
+        return HttpResponse()
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmark auth token validation of the upload API, uses a "
+            "throwaway user on the configured database.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', dest='requests', type='int', default=2000,
+                    help="Number of validated requests per run."),
+    )
+
+    def handle_noargs(self, **options):
+        user = User.objects.create(username="bench-" + uuid.uuid4().hex[:20])
+        session = import_string(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user.pk
+        session.save()
+
+        try:
+            request = RequestFactory().post(
+                '/upload/', data={'auth_token': session.session_key})
+            view = _DummyView()
+
+            def uncached():
+                token_cache.clear()
+                view.post(request)
+
+            results = []
+            for name, fun in (("uncached", uncached),
+                              ("cached", lambda: view.post(request))):
+                start = time.time()
+                for _ in range(options['requests']):
+                    fun()
+                elapsed = time.time() - start
+                results.append(elapsed)
+                self.stdout.write(
+                    "{:<9} {:.0f} req/s  {:.1f}us per validation".format(
+                        name, options['requests'] / elapsed,
+                        elapsed * 1e6 / options['requests']))
+
+            if results[1]:
+                self.stdout.write("Speedup: {:.1f}x".format(
+                    results[0] / results[1]))
+        finally:
+            token_cache.clear()
+            session.delete()
+            user.delete()
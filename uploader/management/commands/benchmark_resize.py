@@ -0,0 +1,99 @@
+"""
+@date: 18/Oct/2026
+
+Compare the CPU time of the old per-variant resize loop with the single
+decode, cascaded resize engine, and the wall time of the cascade inline with
+the one split over the resize pool. CPU time of the pooled run is spent on the
+pool workers, only its wall time compares.
+
+    $ python manage.py benchmark_resize --size 6000x4000 --iterations 5
+"""
+import os
+import time
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.conf import settings
+from PIL import Image
+
+from uploader.imaging import generate_variants, save_variants_in_pool
+
+FIXTURE_IMAGE = os.path.normpath(os.path.join(
+    os.path.dirname(__file__), "../../fixtures/images/me.jpg"))
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def per_variant_resize(path, targets, out_dir):
+    """ The resize loop used before, full decode and resize per variant. """
+    orginal_img = Image.open(path)
+    for label, size in targets:
+        orginal_img.resize(size).save(
+            os.path.join(out_dir, "old-{}.jpg".format(label)))
+
+
+def cascaded_resize(path, targets, out_dir):
+    for label, img in generate_variants(path, targets):
+        img.save(os.path.join(out_dir, "new-{}.jpg".format(label)))
+
+
+def pooled_resize(path, targets, out_dir):
+    save_variants_in_pool(path, [
+        (label, size, os.path.join(out_dir, "pool-{}.jpg".format(label)))
+        for label, size in targets])
+
+
+class Command(NoArgsCommand):
+    help = "Benchmark the image resize engine against the per-variant loop."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--image', dest='image', default=FIXTURE_IMAGE,
+                    help="Source image to resize."),
+        make_option('--size', dest='size', default=None,
+                    help=("Upscale the source image to WIDTHxHEIGHT JPEG "
+                          "before running, eg; 6000x4000 for a 24MP image.")),
+        make_option('--iterations', dest='iterations', type='int', default=10,
+                    help="Number of runs per implementation."),
+    )
+
+    def handle_noargs(self, **options):
+        out_dir = tempfile.mkdtemp()
+        try:
+            path = options['image']
+            if options['size']:
+                try:
+                    size = tuple(int(d) for d in options['size'].split('x'))
+                except ValueError:
+                    raise CommandError("--size should be WIDTHxHEIGHT")
+                path = os.path.join(out_dir, "source.jpg")
+                Image.open(options['image']).convert('RGB').resize(
+                    size, Image.BILINEAR).save(path, quality=90)
+
+            targets = [(v[0], v[1]) for v in settings.IMAGE_VARIANTS]
+            self.stdout.write("Source: {} {}".format(
+                path, Image.open(path).size))
+
+            results = []
+            for name, fun in (("per-variant", per_variant_resize),
+                              ("cascaded", cascaded_resize),
+                              ("pooled", pooled_resize)):
+                cpu_start, wall_start = _cpu_time(), time.time()
+                for _ in range(options['iterations']):
+                    fun(path, targets, out_dir)
+                cpu = (_cpu_time() - cpu_start) / options['iterations']
+                wall = (time.time() - wall_start) / options['iterations']
+                results.append(cpu)
+                self.stdout.write(
+                    "{:<12} cpu: {:.4f}s  wall: {:.4f}s per image".format(
+                        name, cpu, wall))
+
+            if results[1]:
+                self.stdout.write("Speedup: {:.1f}x".format(
+                    results[0] / results[1]))
+        finally:
+            shutil.rmtree(out_dir)
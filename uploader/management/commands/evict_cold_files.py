@@ -0,0 +1,56 @@
+"""
+@date: 18/Oct/2026
+
+Remove the local copies of the originals older than
+`settings.TIERED_STORAGE_HOT_DAYS`, when stored on the
+:class:`~uploader.storage.TieredStorage`. They stay on the object store and
+are fetched back on their next read.
+
+    $ python manage.py evict_cold_files --days 7
+"""
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.files.storage import default_storage
+from django.conf import settings
+from django.utils import timezone
+
+from uploader.models import Image
+from uploader.storage import TieredStorage
+
+
+class Command(NoArgsCommand):
+    help = "Evict the cold originals from the local disk of a tiered storage."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+                    help="Evict the originals uploaded before these many "
+                         "days, TIERED_STORAGE_HOT_DAYS by default."),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500, help="Rows fetched per query."),
+    )
+
+    def handle_noargs(self, **options):
+        if not isinstance(default_storage, TieredStorage):
+            raise CommandError("DEFAULT_FILE_STORAGE is not a TieredStorage.")
+
+        days = options['days']
+        if days is None:
+            days = settings.TIERED_STORAGE_HOT_DAYS
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+
+        evicted, last_id = 0, 0
+        while True:
+            rows = list(Image.objects.filter(
+                created_at__lt=cutoff, id__gt=last_id).order_by(
+                    'id').values_list('id', 'image')[:options['batch_size']])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            # Deduplicated uploads share the file, it is evicted only once.
+            for _, name in rows:
+                evicted += default_storage.evict(name)
+
+        self.stdout.write("Evicted: {} files".format(evicted))
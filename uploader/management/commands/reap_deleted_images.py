@@ -0,0 +1,34 @@
+"""
+@date: 18/Oct/2026
+
+Remove the deleted images and their files right away, batch by batch. The
+delete API queues the same work as `reap_deleted_images` tasks, run this one
+from cron to pick up what is left behind by failed tasks.
+
+    $ python manage.py reap_deleted_images --batch-size 1000
+"""
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from uploader.cleanup import reap_deleted_images
+
+
+class Command(NoArgsCommand):
+    help = "Remove the deleted images along with their files."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=None,
+                    help="Rows per batch, IMAGE_REAP_BATCH_SIZE by default."),
+    )
+
+    def handle_noargs(self, **options):
+        total = 0
+        while True:
+            reaped = reap_deleted_images(options['batch_size'])
+            if not reaped:
+                break
+            total += reaped
+
+        self.stdout.write("Reaped: {} images".format(total))
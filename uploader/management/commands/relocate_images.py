@@ -0,0 +1,162 @@
+"""
+@date: 18/Oct/2026
+
+Move the images stored with another directory layout to the sharded one of
+`settings.IMAGE_DIR_SHARD_LEVELS`, eg; after the shard levels are changed or
+for the images uploaded before the sharding. The original, its resized
+images and their siblings are moved, and the rows updated. Safe to run
+again if interrupted, moved files are detected.
+
+After each batch the moved files are uploaded to the CDN under their new
+keys, then the old keys and their sync manifest entries are removed. If the
+upload fails the old keys are kept, and the new files are left pending for
+`resync_cdn`.
+
+    $ python manage.py relocate_images --batch-size 500 --dry-run
+"""
+import os
+import posixpath
+from optparse import make_option
+
+import boto
+
+from django.core.management.base import NoArgsCommand
+from django.core.files.storage import default_storage, FileSystemStorage
+
+from uploader.cdn import (FILE_PATH_PARSER, get_s3_key_name, upload_files,
+                         delete_keys)
+from uploader.cleanup import get_variant_files
+from uploader.imaging import get_sibling_paths
+from uploader.manifest import get_manifest
+from uploader.models import (Image, get_shard_path, get_media_path,
+                             get_resized_image_paths)
+from uploader.storage import TieredStorage
+
+
+def get_relocated_name(name):
+    """
+    Storage name of the image `name` on the current layout, None if it isn't
+    under a date directory.
+    """
+    match = FILE_PATH_PARSER.match(name)
+    if match is None:
+        return None
+
+    # Up to the day's directory, eg; images/2014/12/06
+    directory = name[:match.start(4) - 1]
+    return get_shard_path(directory, posixpath.basename(match.group(4)))
+
+
+def _move_local(src, dest):
+    if not os.path.exists(src):
+        return False
+
+    directory = os.path.dirname(dest)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    os.rename(src, dest)
+    return True
+
+
+class Command(NoArgsCommand):
+    help = "Move the stored images to the sharded directory layout."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=500, help="Rows fetched per query."),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    default=False,
+                    help="Only report the images to be moved."),
+    )
+
+    def handle_noargs(self, **options):
+        moved, last_id = 0, 0
+        while True:
+            rows = list(Image.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'image')[:options['batch_size']])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            # Deduplicated uploads share the file, it is moved only once.
+            new_paths, old_paths = [], []
+            for name in sorted(set(name for _, name in rows)):
+                new_name = get_relocated_name(name)
+                if new_name is None or new_name == name:
+                    continue
+
+                moved += 1
+                if options['dry_run']:
+                    self.stdout.write("{} -> {}".format(name, new_name))
+                else:
+                    new_paths.extend(self.relocate(name, new_name))
+                    old_paths.append(get_media_path(name))
+                    old_paths.extend(get_variant_files(name))
+
+            if old_paths:
+                self.sync(new_paths, old_paths)
+
+        self.stdout.write("{}: {} images".format(
+            "To be moved" if options['dry_run'] else "Moved", moved))
+
+    def relocate(self, name, new_name):
+        """
+        :return: Local paths of the moved files, to be synced to the CDN.
+        """
+        self._move_original(name, new_name)
+
+        # Resized images are always on the local MEDIA_ROOT.
+        moved = []
+        new_paths = get_resized_image_paths(new_name)
+        for label, old in get_resized_image_paths(name).items():
+            new = new_paths[label]['path']
+            pairs = zip([old['path']] + get_sibling_paths(label, old['path']),
+                        [new] + get_sibling_paths(label, new))
+            moved.extend(dest for src, dest in pairs if _move_local(src, dest))
+
+        Image.all_objects.filter(image=name).update(image=new_name)
+
+        if os.path.exists(get_media_path(new_name)):
+            moved.append(get_media_path(new_name))
+        if moved:
+            # Pending until uploaded under their new keys.
+            get_manifest().mark_pending(moved)
+        return moved
+
+    def sync(self, new_paths, old_paths):
+        """
+        Upload the moved files, then remove the CDN copies of the old paths.
+        """
+        manifest = get_manifest()
+        try:
+            upload_files(new_paths, on_uploaded=manifest.mark_uploaded)
+        except (boto.exception.AWSConnectionError,
+                boto.exception.BotoClientError,
+                boto.exception.S3ResponseError, IOError) as ex:
+            # Old copies keep serving until the new ones are there.
+            self.stderr.write("CDN sync failed, old keys kept: {}".format(ex))
+            return
+
+        failed = set(delete_keys([get_s3_key_name(p) for p in old_paths]))
+        for key in failed:
+            self.stderr.write("Failed to delete CDN copy: {}".format(key))
+        manifest.forget([p for p in old_paths
+                         if get_s3_key_name(p) not in failed])
+
+    def _move_original(self, name, new_name):
+        storage = default_storage
+        if isinstance(storage, FileSystemStorage) and \
+           not isinstance(storage, TieredStorage):
+            _move_local(storage.path(name), storage.path(new_name))
+            return
+
+        # Already moved by an interrupted run.
+        if not storage.exists(name):
+            return
+
+        with storage.open(name) as f:
+            saved = storage.save(new_name, f)
+        if saved != new_name:
+            storage.delete(saved)
+            raise IOError("{} is taken already.".format(new_name))
+        storage.delete(name)
@@ -0,0 +1,48 @@
+"""
+@date: 18/Oct/2026
+
+Start a celery worker for one of the resize lanes on
+`settings.RESIZE_WORKER_LANES`, with the queues, concurrency and prefetch of
+that lane.
+
+    $ python manage.py resize_worker small
+    $ python manage.py resize_worker large -l info
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from image_uploader.celery import app
+
+
+class Command(BaseCommand):
+    help = "Start a celery worker for a resize lane."
+    args = "<lane>"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--loglevel', dest='loglevel', default='warning',
+                    help="Logging level of the worker."),
+    )
+
+    def handle(self, *args, **options):
+        lanes = settings.RESIZE_WORKER_LANES
+        if len(args) != 1 or args[0] not in lanes:
+            raise CommandError("Give one of the lanes: {}".format(
+                ", ".join(sorted(lanes))))
+
+        lane = lanes[args[0]]
+
+        # Prefetch is a worker wide setting on this celery version.
+        app.conf.CELERYD_PREFETCH_MULTIPLIER = lane['prefetch_multiplier']
+
+        argv = ['worker',
+                '-Q', ",".join(lane['queues']),
+                '-c', str(lane['concurrency']),
+                '-n', "resize-{}@%h".format(args[0]),
+                '-l', options['loglevel']]
+        if lane.get('fair'):
+            # Don't hand a task to a process which is still busy.
+            argv.append('-Ofair')
+
+        app.worker_main(argv)
@@ -0,0 +1,63 @@
+"""
+@date: 18/Oct/2026
+
+Upload every file which is not on the CDN yet, as per the local sync
+manifest. The bucket is never listed.
+
+    $ python manage.py resync_cdn --batch-size 200 --async
+"""
+import os
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from uploader.manifest import get_manifest
+from uploader.tasks import sync_images_to_cdn
+
+
+class Command(NoArgsCommand):
+    help = "Sync all the pending files of the CDN sync manifest."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=100, help="Files per sync task."),
+        make_option('--async', dest='async_operation', action='store_true',
+                    default=False,
+                    help="Queue the batches to the CDN sync workers instead "
+                         "of uploading from this process."),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    default=False,
+                    help="Only report the pending files."),
+    )
+
+    def handle_noargs(self, **options):
+        batch, pending, missing = [], 0, 0
+
+        # Pending files are read in key order, so marking the synced ones on
+        # the way doesn't disturb the iteration.
+        for path in get_manifest().iter_pending():
+            if not os.path.exists(path):
+                missing += 1
+                self.stderr.write("Missing local file: {}".format(path))
+                continue
+
+            pending += 1
+            batch.append(path)
+            if len(batch) >= options['batch_size']:
+                self._sync(batch, options)
+                batch = []
+
+        if batch:
+            self._sync(batch, options)
+
+        self.stdout.write("Pending files: {}, missing locally: {}".format(
+            pending, missing))
+
+    def _sync(self, paths, options):
+        if options['dry_run']:
+            return
+
+        if options['async_operation']:
+            sync_images_to_cdn.delay(paths)
+        else:
+            sync_images_to_cdn(paths)
@@ -0,0 +1,316 @@
+"""
+@date: 18/Oct/2026
+
+Find, and optionally repair, the differences between the image files on
+MEDIA_ROOT, the Image rows and the CDN bucket.
+
+    orphan_local      - Local file without a row, left by a failed upload.
+    missing_original  - Row without its original on the local storage.
+    missing_variant   - Resized image not generated, on-demand ones aside.
+    unsynced          - Local original or resized image not on the CDN.
+    orphan_cdn        - CDN copy without a row.
+
+The directory tree, the table and the bucket listing are each read in sorted
+order and merged, so the memory use is bounded by the largest directory
+whatever the number of files. The Image names are expected in the code point
+order, as on SQLite or a "C" collation on the other databases.
+
+With --repair the orphans are deleted, the missing variants queued for
+resize and the unsynced ones marked pending for `resync_cdn`. Only the
+orphans older than --min-age are deleted, and only the CDN keys in the
+layout of the copies of the images/ tree are looked at.
+
+    $ python manage.py scan_media --repair --min-age 86400
+"""
+import os
+import time
+import heapq
+import calendar
+import posixpath
+from itertools import groupby
+from operator import itemgetter
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.files.storage import default_storage, FileSystemStorage
+from django.db.models import Q
+from django.utils.encoding import force_text
+from django.conf import settings
+from boto.utils import parse_ts
+
+from uploader.cdn import FILE_PATH_PARSER, get_bucket, delete_keys
+from uploader.imaging import get_sibling_paths
+from uploader.manifest import get_manifest
+from uploader.models import (Image, UPLOAD_DIR_FORMAT, get_media_path,
+                             get_resized_image_paths)
+from uploader.storage import TieredStorage
+from uploader.tasks import resize_image_batch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Sources of a file name on the merged stream.
+EXPECTED, LOCAL, CDN = 0, 1, 2
+
+# Kinds of the expected files.
+ORIGINAL, VARIANT = 'original', 'variant'
+
+# Repairs are sent in batches of these many files.
+REPAIR_BATCH_SIZE = 1000
+
+
+def list_dir(path):
+    """
+    :return: List of (name, is_dir) of the directory entries.
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in scandir(path)]
+    return [(name, os.path.isdir(os.path.join(path, name)))
+            for name in os.listdir(path)]
+
+
+def iter_local_files(root, directory):
+    """
+    Names of the files under `directory`, relative to `root`, in sorted
+    order. Only one directory listing per level is held at a time.
+    """
+    path = os.path.join(root, directory)
+    if not os.path.isdir(path):
+        return
+
+    # A directory sorts as its name with the separator, same as the names
+    # of the files in it.
+    entries = sorted((name + "/" if is_dir else name, is_dir)
+                     for name, is_dir in list_dir(path))
+    for name, is_dir in entries:
+        if is_dir:
+            for sub_name in iter_local_files(root, directory + "/" +
+                                             name[:-1]):
+                yield sub_name
+        else:
+            yield directory + "/" + name
+
+
+def iter_image_rows(batch_size):
+    """
+    (name, live) of every stored file, in sorted order, from the Image rows
+    read in keyset chunks. `live` if any of the rows sharing the file is not
+    deleted.
+    """
+    last_name, last_id, current = None, 0, None
+    while True:
+        rows = Image.all_objects.order_by('image', 'id')
+        if last_name is not None:
+            rows = rows.filter(Q(image__gt=last_name) |
+                               Q(image=last_name, id__gt=last_id))
+        rows = list(rows.values_list('image', 'id', 'deleted_at')[
+            :batch_size])
+        if not rows:
+            break
+
+        for name, pk, deleted_at in rows:
+            if current and current[0] == name:
+                current[1] = current[1] or deleted_at is None
+                continue
+            if current:
+                if name < current[0]:
+                    raise CommandError(
+                        "Image names are not sorted by code point, use a "
+                        "binary collation on the image column.")
+                yield tuple(current)
+            current = [name, deleted_at is None]
+
+        last_name, last_id = rows[-1][0], rows[-1][1]
+
+    if current:
+        yield tuple(current)
+
+
+def iter_expected_files(rows, local_originals):
+    """
+    Files expected for the sorted `rows`, in sorted order.
+
+    The files of an image sort after the directory of the image, so do the
+    files of all the images after it. The ones before the current directory
+    are final once it changes, only the files of one directory are held.
+
+    :return: Iterator of (name, EXPECTED, (kind, image name, required
+             locally, required on the CDN))
+    """
+    root = get_media_path("")
+    on_demand = set(getattr(settings, 'ON_DEMAND_IMAGE_VARIANTS', ()))
+
+    pending, directory = [], None
+    for name, live in rows:
+        current = posixpath.dirname(name) + "/"
+        if current != directory:
+            while pending and pending[0][0] < current:
+                yield heapq.heappop(pending)
+            directory = current
+
+        # Synced to the CDN by the resize tasks, wherever it is stored.
+        heapq.heappush(pending, (name, EXPECTED, (
+            ORIGINAL, name, live and local_originals, live)))
+
+        for label, variant in get_resized_image_paths(name).items():
+            # Not generated until requested.
+            required = live and label not in on_demand
+            for path in [variant['path']] + \
+                    get_sibling_paths(label, variant['path']):
+                heapq.heappush(pending, (
+                    force_text(path[len(root) + 1:]), EXPECTED,
+                    (VARIANT, name, required, required)))
+
+    while pending:
+        yield heapq.heappop(pending)
+
+
+def iter_cdn_files(prefix):
+    """
+    Names of the CDN copies as local file names, with their last modified
+    time, in sorted order. Keys out of the layout of the copies, see
+    `uploader.cdn.get_s3_key_name`, are not ours and skipped. The bucket is
+    listed page by page.
+    """
+    for key in get_bucket().list():
+        name = prefix + force_text(key.name)
+        if not FILE_PATH_PARSER.match(name):
+            continue
+        try:
+            modified = calendar.timegm(parse_ts(key.last_modified).timetuple())
+        except (TypeError, ValueError):
+            # Unknown, taken as just modified.
+            modified = time.time()
+        yield name, modified
+
+
+class Command(NoArgsCommand):
+    help = "Report or repair the differences between the image files, " \
+           "the Image rows and the CDN."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--repair', dest='repair', action='store_true',
+                    default=False, help="Repair the differences found."),
+        make_option('--no-cdn', dest='cdn', action='store_false',
+                    default=True, help="Don't list the CDN bucket."),
+        make_option('--min-age', dest='min_age', type='int', default=3600,
+                    help="Seconds since the last change of an orphan, "
+                         "before it is deleted. Younger ones could be of "
+                         "an upload in progress."),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=1000, help="Rows fetched per query."),
+    )
+
+    def handle_noargs(self, **options):
+        self.options = options
+        self.counts = dict((kind, 0) for kind in (
+            'orphan_local', 'missing_original', 'missing_variant',
+            'unsynced', 'orphan_cdn'))
+        self.to_delete, self.to_resize = [], []
+        self.to_sync, self.to_delete_cdn = [], []
+
+        root = get_media_path("")
+        top = UPLOAD_DIR_FORMAT.split("/")[0]
+
+        # Originals are kept on the local disk only by a plain local storage.
+        local_originals = isinstance(default_storage, FileSystemStorage) and \
+            not isinstance(default_storage, TieredStorage)
+
+        streams = [
+            iter_expected_files(iter_image_rows(options['batch_size']),
+                                local_originals),
+            ((name, LOCAL, None) for name in iter_local_files(root, top))]
+        if options['cdn']:
+            # CDN key of images/2014/12/06/<name> is 2014/12/06/<name>.
+            streams.append((name, CDN, modified)
+                           for name, modified in iter_cdn_files(top + "/"))
+
+        for name, entries in groupby(heapq.merge(*streams),
+                                     key=itemgetter(0)):
+            self.compare(name, list(entries))
+        self.flush(force=True)
+
+        for kind in sorted(self.counts):
+            self.stdout.write("{}: {}".format(kind, self.counts[kind]))
+
+    def compare(self, name, entries):
+        sources = set(entry[1] for entry in entries)
+        expected = [entry[2] for entry in entries if entry[1] == EXPECTED]
+        cdn = self.options['cdn']
+
+        if not expected:
+            if LOCAL in sources:
+                self.report('orphan_local', name)
+                path = get_media_path(name)
+                try:
+                    age = time.time() - os.path.getmtime(path)
+                except OSError:
+                    # Removed meanwhile.
+                    age = 0
+                if age >= self.options['min_age']:
+                    self.to_delete.append(path)
+            if CDN in sources:
+                self.report('orphan_cdn', name)
+                modified = [entry[2] for entry in entries
+                            if entry[1] == CDN][0]
+                if time.time() - modified >= self.options['min_age']:
+                    self.to_delete_cdn.append(name.partition("/")[2])
+            self.flush()
+            return
+
+        # Files of the deleted images and the on-demand variants are not
+        # required, neither are the originals on the local disk unless it is
+        # their storage.
+        kind, image_name, local_required, cdn_required = expected[0]
+
+        if LOCAL not in sources:
+            if not local_required:
+                return
+            if kind == ORIGINAL:
+                self.report('missing_original', name)
+            else:
+                self.report('missing_variant', name)
+                if not self.to_resize or self.to_resize[-1] != image_name:
+                    self.to_resize.append(image_name)
+        elif cdn and cdn_required and CDN not in sources:
+            self.report('unsynced', name)
+            self.to_sync.append(get_media_path(name))
+        self.flush()
+
+    def report(self, kind, name):
+        self.counts[kind] += 1
+        self.stdout.write("{} {}".format(kind, name))
+
+    def flush(self, force=False):
+        """
+        Apply the repairs collected so far, once a batch is full.
+        """
+        batches = (self.to_delete, self.to_resize, self.to_sync,
+                   self.to_delete_cdn)
+        if not force and max(len(b) for b in batches) < REPAIR_BATCH_SIZE:
+            return
+
+        if self.options['repair']:
+            for path in self.to_delete:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if self.to_resize:
+                resize_image_batch.delay(self.to_resize)
+            if self.to_sync:
+                get_manifest().mark_pending(self.to_sync)
+            if self.to_delete_cdn:
+                failed = delete_keys(self.to_delete_cdn)
+                for key in failed:
+                    self.stderr.write("Failed to delete CDN copy: {}".format(
+                        key))
+
+        self.to_delete, self.to_resize = [], []
+        self.to_sync, self.to_delete_cdn = [], []
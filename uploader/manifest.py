@@ -0,0 +1,173 @@
+"""
+@date: 18/Oct/2026
+
+Local manifest of the files synced to the CDN.
+
+Each S3 key has one row with the size, modification time and MD5 checksum of
+the local file, and its upload state. The resize tasks record the new files
+as pending, the sync task uploads only the pending or changed ones and marks
+each of them as uploaded right after its upload, so a retried or restarted
+batch continues from where it stopped.
+
+The manifest is a SQLite file at `settings.CDN_SYNC_MANIFEST`, it should be
+local to the node running the resize and CDN sync workers.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+from django.conf import settings
+
+from .cdn import get_s3_key_name
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+
+_manifest = None
+_manifest_pid = None
+
+
+def get_manifest():
+    """
+    Manifest of the current process.
+    """
+    global _manifest, _manifest_pid
+
+    if _manifest is None or _manifest_pid != os.getpid() or \
+       _manifest.path != settings.CDN_SYNC_MANIFEST:
+        _manifest = SyncManifest(settings.CDN_SYNC_MANIFEST)
+        _manifest_pid = os.getpid()
+    return _manifest
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 2 ** 10), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class SyncManifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS manifest ("
+            " key TEXT PRIMARY KEY,"
+            " path TEXT NOT NULL,"
+            " size INTEGER,"
+            " mtime REAL,"
+            " checksum TEXT,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS manifest_state ON manifest (state)")
+
+    def mark_pending(self, paths):
+        """
+        Record the new local files, which are yet to be uploaded.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO manifest"
+                " (key, path, state, updated_at) VALUES (?, ?, ?, ?)",
+                [(get_s3_key_name(p), p, PENDING, now) for p in paths])
+
+    def get_changed(self, paths):
+        """
+        Filter the files which are not uploaded yet, or changed after their
+        upload. Those are recorded as pending with their current details.
+
+        A file with the same size and modification time as the uploaded one
+        is taken as unchanged, others are compared by checksum.
+
+        :return: List of paths to upload.
+        """
+        entries = self._get_entries([get_s3_key_name(p) for p in paths])
+        changed = []
+        now = time.time()
+
+        for path in paths:
+            key = get_s3_key_name(path)
+            stat = os.stat(path)
+            entry = entries.get(key)
+
+            if entry and entry['state'] == UPLOADED and \
+               entry['size'] == stat.st_size:
+                if entry['mtime'] == stat.st_mtime:
+                    continue
+                checksum = file_md5(path)
+                if entry['checksum'] == checksum:
+                    continue
+            else:
+                checksum = file_md5(path)
+
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO manifest (key, path, size, mtime,"
+                    " checksum, state, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, path, stat.st_size, stat.st_mtime, checksum,
+                     PENDING, now))
+            changed.append(path)
+
+        return changed
+
+    def forget(self, paths):
+        """
+        Drop the entries of the deleted files.
+        """
+        keys = [get_s3_key_name(p) for p in paths]
+        # Keep under the SQLite's bound parameter limit.
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM manifest WHERE key IN ({})".format(
+                        ",".join("?" * len(batch))), batch)
+
+    def mark_uploaded(self, path):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE manifest SET state = ?, updated_at = ? WHERE key = ?",
+                (UPLOADED, time.time(), get_s3_key_name(path)))
+
+    def iter_pending(self, batch_size=500):
+        """
+        Iterate over the local paths of all the pending files, in key order.
+        """
+        last_key = ''
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT key, path FROM manifest WHERE state = ?"
+                    " AND key > ? ORDER BY key LIMIT ?",
+                    (PENDING, last_key, batch_size)).fetchall()
+            if not rows:
+                break
+            for key, path in rows:
+                yield path
+            last_key = rows[-1][0]
+
+    def _get_entries(self, keys):
+        entries = {}
+        # Keep under the SQLite's bound parameter limit.
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT key, size, mtime, checksum, state FROM manifest"
+                    " WHERE key IN ({})".format(",".join("?" * len(batch))),
+                    batch).fetchall()
+            for key, size, mtime, checksum, state in rows:
+                entries[key] = {'size': size, 'mtime': mtime,
+                                'checksum': checksum, 'state': state}
+        return entries
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.db import models, migrations
+
+
+def fill_name_parts(apps, schema_editor):
+    Image = apps.get_model('uploader', 'Image')
+
+    for image in Image.objects.filter(base_name='').iterator():
+        image.name = os.path.basename(image.image.name)
+        image.base_name, _, image.ext = image.name.rpartition('.')
+        image.save(update_fields=['name', 'base_name', 'ext'])
+
+
+def noop(apps, schema_editor):
+    # Nothing to undo, the columns are dropped along with the fields.
+    # RunPython.noop of the later Django releases.
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploader', '0003_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='base_name',
+            field=models.CharField(default=b'', max_length=100, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='ext',
+            field=models.CharField(default=b'', max_length=10, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_name_parts, noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploader', '0006_image_user_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='deleted_at',
+            field=models.DateTimeField(null=True, db_index=True),
+            preserve_default=True,
+        ),
+    ]
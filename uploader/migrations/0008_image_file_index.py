@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import uploader.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploader', '0007_image_deleted_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='image',
+            field=models.ImageField(upload_to=uploader.models.get_file_name, db_index=True),
+            preserve_default=True,
+        ),
+    ]
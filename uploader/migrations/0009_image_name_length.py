@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import uploader.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploader', '0008_image_file_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='base_name',
+            field=models.CharField(default=b'', max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='image',
+            field=models.ImageField(max_length=255, upload_to=uploader.models.get_file_name, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='name',
+            field=models.CharField(max_length=255),
+            preserve_default=True,
+        ),
+    ]
@@ -5,35 +5,123 @@
 import os
 import re
 import time
+import hashlib
+import binascii
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.encoding import force_bytes, filepath_to_uri
+from django.utils.six.moves.urllib.parse import urljoin
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
 from django.conf import settings
+from .utils import token_cache
 
 
-def get_file_name(instance, filename):
+# Heirarchial storage of image, helps to manage the files in a directory
+# or migrate old files to systems with slower IO etc..
+UPLOAD_DIR_FORMAT = "images/%Y/%m/%d"
+
+# Longest part of the uploaded file name kept in the stored name, in UTF-8
+# bytes. Leaves room for the uid, the upload id and the variant labels within
+# the 255 bytes file name limit of the file systems.
+MAX_NAME_STEM_BYTES = 100
+
+
+def make_image_id():
+    """
+    Time ordered unique id of an upload, milliseconds since epoch followed by
+    48 random bits, in hex. Ids made on different servers in the same
+    millisecond still don't collide.
+    """
+    return "%012x%s" % (int(time.time() * 1000),
+                        binascii.hexlify(os.urandom(6)))
+
+
+def get_shard_path(directory, name):
+    """
+    Storage name of the file `name` under the date `directory`, spread over
+    `settings.IMAGE_DIR_SHARD_LEVELS` levels of sub directories by the hash
+    of the name. eg; images/2014/12/06/3f/me-1-<id>.jpg
+    """
+    levels = getattr(settings, 'IMAGE_DIR_SHARD_LEVELS', 0)
+    width = getattr(settings, 'IMAGE_DIR_SHARD_WIDTH', 2)
+
+    digest = hashlib.md5(force_bytes(name)).hexdigest()
+    shards = [digest[i * width:(i + 1) * width] for i in range(levels)]
+    return "/".join([directory] + shards + [name])
 
-    # Heirarchial storage of image, helps to manage the files in a directory
-    # or migrate old files to systems with slower IO etc..
-    path = time.strftime("images/%Y/%m/%d")
+
+def get_file_name(instance, filename):
     basename = os.path.basename(filename)
+    stem, ext = "".join(basename.split(".")[:-1]), basename.split(".")[-1]
+    stem = force_bytes(stem)[:MAX_NAME_STEM_BYTES].decode('utf-8', 'ignore')
 
-    # NOTE: Right now we are using Time based naming. A single user can upload
-    # 10^10 images per second. If we are using UUID this will be time agnostic
-    # and more precise, we don't need to worry much about sync server time.
-    name = "{name}-{uid}-{unixtime}.{ext}".format(
-        name="".join(basename.split(".")[:-1]),  # Remove the extension
-        uid=instance.user.id,
-        unixtime="".join(('%.10f' % time.time()).split(".")),
-        ext=basename.split(".")[-1]
-    )
+    name = "{name}-{uid}-{id}.{ext}".format(
+        name=stem, uid=instance.user.id, id=make_image_id(), ext=ext)
 
     # Keep the name of the Image object same as the newslc514461
     # filename.
     instance.name = name
+    instance.base_name, _, instance.ext = name.rpartition(".")
+
+    return get_shard_path(time.strftime(UPLOAD_DIR_FORMAT), name)
+
+
+# (IMAGE_VARIANTS, [(label, size, name infix)]), built once per variant
+# configuration.
+_variant_templates = (None, [])
+
+
+def get_variant_templates():
+    """
+    Precomputed table of the resized image names, a resized image name is
+    `base_name + infix + ext` of its original.
+
+    :return: List of (label, (width, height), infix)
+    """
+    global _variant_templates
 
-    fullpath = os.path.join(path, name)
-    return fullpath
+    variants = settings.IMAGE_VARIANTS
+    if _variant_templates[0] is not variants:
+        _variant_templates = (variants, [
+            (label, size, "-{}.".format(label))
+            for label, size, _ in variants])
+    return _variant_templates[1]
+
+
+def get_media_path(name):
+    """
+    Absolute path of `name` on the local MEDIA_ROOT, where the resized images
+    are written whatever the storage of the originals is.
+    """
+    return os.path.abspath(os.path.join(settings.MEDIA_ROOT, name))
+
+
+def get_resized_image_paths(image_name):
+    """
+    Resized images of the original stored as `image_name`, built from the
+    name alone so the workers don't need the database. Same as
+    :attr:`Image.resized_image_paths` without the original.
+
+    :param image_name: Storage name of the original, relative to MEDIA_ROOT.
+    :return: Map of image_label -> { size: (width, height),
+                                     path: absolute_image_path}
+    :rtype: dict
+    """
+    prefix, _, ext = get_media_path(image_name).rpartition(".")
+    return dict((label, {"path": prefix + infix + ext, "size": size})
+                for label, size, infix in get_variant_templates())
+
+
+class LiveImageManager(models.Manager):
+    """
+    Images which are not deleted.
+    """
+    def get_queryset(self):
+        return super(LiveImageManager, self).get_queryset().filter(
+            deleted_at__isnull=True)
 
 
 class Image(models.Model):
@@ -46,19 +134,58 @@ class Image(models.Model):
     # Original -> {name}-{uid}-{unixTime}.{ext}
     # Resized  -> {name}-{uid}-{unixTime}-{resize_lable}.{ext}
     #
+    # unixTime is the hex id of make_image_id() on the new uploads, digits
+    # of the upload time on the older ones.
+    #
     BASE_NAME = "{name}-{uid}-{unixTime}.{ext}"
-    BASE_NAME_PARSER = re.compile('([\w\W\d]+)\-([\d]+)\-([\d]+)\.([\w\W]+)')
+    BASE_NAME_PARSER = re.compile(
+        '([\w\W\d]+)\-([\d]+)\-([0-9a-f]+)\.([\w\W]+)')
 
     RESIZED_IMAGE_NAME = "{name}-{uid}-{unixtime}-{resized_label}.{ext}"
+    RESIZED_NAME_PARSER = re.compile(
+        '^([\w\W]+)\-([\d]+)\-([0-9a-f]+)\-([^\-\.]+)\.([^\.]+)$')
 
     # The image label given for the original uploaded image.
     IMG_LABEL = "original"
 
-    name = models.CharField(max_length=50)
+    name = models.CharField(max_length=255)
     created_at = models.DateTimeField(default=timezone.now)
-    image = models.ImageField(upload_to=get_file_name)
+    # Indexed for the rows sharing a stored file, and the sorted scans of
+    # `scan_media` command.
+    image = models.ImageField(upload_to=get_file_name, db_index=True,
+                              max_length=255)
     user = models.ForeignKey(User, related_name='uploaded_images')
 
+    # SHA-256 of the uploaded content. Uploads of the same bytes by the same
+    # user share the stored original and its resized variants.
+    digest = models.CharField(max_length=64, db_index=True, blank=True,
+                              default='')
+
+    # Components of the stored file name, {name}-{uid}-{unixTime} and {ext},
+    # so the resized image names are built without parsing it.
+    base_name = models.CharField(max_length=255, blank=True, default='')
+    ext = models.CharField(max_length=10, blank=True, default='')
+
+    # Details of the original image, captured from its header at upload.
+    width = models.PositiveIntegerField(null=True, db_index=True)
+    height = models.PositiveIntegerField(null=True, db_index=True)
+    format = models.CharField(max_length=10, blank=True, default='',
+                              db_index=True)
+    byte_size = models.BigIntegerField(null=True)
+    orientation = models.PositiveSmallIntegerField(null=True)
+
+    # Set by the delete API. The row and its files are removed later by the
+    # reaper, see uploader.cleanup.
+    deleted_at = models.DateTimeField(null=True, db_index=True)
+
+    objects = LiveImageManager()
+    # Deleted ones included.
+    all_objects = models.Manager()
+
+    class Meta:
+        # Keyset pagination of the listing API, see ImageListView.
+        index_together = [('user', 'created_at')]
+
     @property
     def resized_image_urls(self):
         """
@@ -72,15 +199,19 @@ class Image(models.Model):
         if hasattr(self, '_resized_image_urls'):
             return self._resized_image_urls
         else:
+            # Resized images are always on the local MEDIA_ROOT, and on the
+            # CDN under the same path, wherever the original is stored.
+            url = urljoin(settings.MEDIA_URL,
+                          filepath_to_uri(self.image.name))
+            prefix = url[:url.rfind("/") + 1] + self.name_parts[0]
+            ext = self.name_parts[1]
+
             image_urls = {
                 self.IMG_LABEL: self.image.url
             }
 
-            for resized in settings.IMAGE_VARIANTS:
-
-                image_urls[resized[0]] = os.path.join(
-                    os.path.dirname(self.image.url),
-                    self.get_resized_image_names(self.name, resized[0]))
+            for label, _, infix in get_variant_templates():
+                image_urls[label] = prefix + infix + ext
 
             self._resized_image_urls = image_urls
             return image_urls
@@ -100,24 +231,57 @@ class Image(models.Model):
         else:
             image_abs_paths = {
                 self.IMG_LABEL: {
-                    "size": (self.image.width, self.image.height),
-                    "path": self.image.path
+                    "size": self.dimensions,
+                    "path": get_media_path(self.image.name)
                 }
             }
 
-            for resized in settings.IMAGE_VARIANTS:
+            path = get_media_path(self.image.name)
+            prefix = path[:path.rfind(os.sep) + 1] + self.name_parts[0]
+            ext = self.name_parts[1]
+
+            for label, size, infix in get_variant_templates():
 
-                image_abs_paths[resized[0]] = {
-                    "path": os.path.join(
-                        os.path.dirname(self.image.path),
-                        self.get_resized_image_names(self.name, resized[0])
-                    ),
-                    "size": resized[1]
+                image_abs_paths[label] = {
+                    "path": prefix + infix + ext,
+                    "size": size
                 }
 
             self._resized_image_paths = image_abs_paths
             return image_abs_paths
 
+    @property
+    def dimensions(self):
+        """
+        (width, height) of the original image. Only rows stored before these
+        fields are filled need to read the image file.
+        """
+        if self.width is None or self.height is None:
+            self.width, self.height = self.image.width, self.image.height
+        return self.width, self.height
+
+    def set_image_meta(self, meta, byte_size=None):
+        """
+        :param meta: Details of the original, see
+                     :func:`~uploader.imaging.read_image_meta`.
+        """
+        self.width = meta['width']
+        self.height = meta['height']
+        self.format = meta['format'] or ''
+        self.orientation = meta['orientation']
+        self.byte_size = byte_size
+
+    @property
+    def name_parts(self):
+        """
+        :return: (base_name, ext) of the stored file name.
+        """
+        if not self.base_name:
+            # Rows stored before these fields.
+            self.base_name, _, self.ext = os.path.basename(
+                self.image.name).rpartition(".")
+        return self.base_name, self.ext
+
     @classmethod
     def get_resized_image_names(cls, org_name, label_name):
         """
@@ -132,8 +296,94 @@ class Image(models.Model):
             name=org_filename, uid=user_id, unixtime=timestamp,
             resized_label=label_name, ext=ext)
 
+    @classmethod
+    def parse_resized_image_name(cls, resized_name):
+        """
+        Reverse of :meth:`get_resized_image_names`.
+
+        :return: (Original image name, label), or None if the name isn't of a
+                 resized image.
+        """
+        parsed = cls.RESIZED_NAME_PARSER.findall(resized_name)
+        if not parsed:
+            return None
+
+        org_filename, user_id, timestamp, label, ext = parsed[0]
+        return "{}-{}-{}.{}".format(org_filename, user_id, timestamp,
+                                    ext), label
+
+    @classmethod
+    def get_stored_copy(cls, digest, user):
+        """
+        Find an image with the same content already uploaded by the user. The
+        stored file name carries the name and id of its uploader, it is never
+        shared across the users.
+
+        :param digest: Content digest of the new upload.
+        :param user: Uploader of the new upload.
+        :return: Oldest Image of the user having the same digest, or None.
+        """
+        if not digest:
+            return None
+        return cls.objects.filter(user=user, digest=digest).order_by(
+            'id').first()
+
+    @classmethod
+    def get_stored_copies(cls, digests, user):
+        """
+        Bulk version of :meth:`get_stored_copy`.
+
+        :param digests: Content digests of the new uploads.
+        :param user: Uploader of the new uploads.
+        :return: Map of digest -> oldest Image of the user having that
+                 digest.
+        :rtype: dict
+        """
+        stored_copies = {}
+        digests = set(d for d in digests if d)
+        if digests:
+            # Newest first, so the oldest one overwrites the others.
+            for image in cls.objects.filter(
+                    user=user, digest__in=digests).order_by('-id'):
+                stored_copies[image.digest] = image
+        return stored_copies
+
+    def save(self, *args, **kwargs):
+        # Store the file before the row, so the name fields filled by
+        # get_file_name are saved along with it.
+        if self.image and not self.image._committed:
+            self.image.save(self.image.name, self.image, save=False)
+        super(Image, self).save(*args, **kwargs)
+
     def delete(self):
-        # Remove the uploaded files from the disk also.
-        if os.path.exists(self.image.path):
-            os.remove(self.image.path)
+        # Imported here, cleanup module uses this one.
+        from .cleanup import remove_image_files
+
+        # Deduplicated uploads share the stored file, so remove it from the
+        # storage only along with the last row pointing to it.
+        shared = Image.objects.filter(image=self.image.name).exclude(
+            pk=self.pk).exists()
+
+        # CDN copies are removed only by the reaper, see `uploader.cleanup`,
+        # so deleting a row never waits on the CDN. The API soft deletes the
+        # rows for that, the copies of the ones deleted here are left as
+        # orphans for `scan_media --repair`.
+        if not shared:
+            remove_image_files([self.image.name], self.image.storage,
+                               cdn=False)
         super(Image, self).delete()
+
+
+class RevokedToken(models.Model):
+    """
+    Signed auth tokens revoked before their expiry. See
+    :mod:`uploader.tokens`.
+    """
+    token_id = models.CharField(max_length=32, unique=True)
+    expire_date = models.DateTimeField(db_index=True)
+
+
+@receiver(post_delete, sender=Session)
+def invalidate_cached_token(sender, instance, **kwargs):
+    # Auth tokens are session keys, a deleted session is a logged out token.
+    token_cache.invalidate(instance.session_key)
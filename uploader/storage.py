@@ -0,0 +1,319 @@
+"""
+@date: 18/Oct/2026
+
+Storage backends of the original images, set one as DEFAULT_FILE_STORAGE.
+
+django.core.files.storage.FileSystemStorage
+            - Local disk, or a network mount shared with the workers.
+uploader.storage.ObjectStorage
+            - S3 compatible object store, `settings.OBJECT_STORAGE_BUCKET`.
+              Honors the S3_* settings, so it works against a local stand-in
+              too.
+uploader.storage.TieredStorage
+            - Files are kept on the local disk while they are hot, and copied
+              to the object store on save. `evict_cold_files` command removes
+              the local copies of the cold ones, they are fetched back on
+              the next read.
+
+Resized images are always written to the local MEDIA_ROOT, only the
+originals go through the storage. Workers read the originals with
+:func:`get_local_path`, through a local read-through cache at
+`settings.STORAGE_CACHE_DIR` unless they are on the local disk already.
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+from boto.s3.key import Key
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import (Storage, FileSystemStorage,
+                                       default_storage)
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+from django.utils.six.moves.urllib.parse import urljoin
+
+from .cdn import get_bucket, delete_keys
+
+# Files bigger than this are spooled to the disk on read.
+SPOOL_MAX_SIZE = 8 * 2 ** 20
+
+_read_cache = None
+_read_cache_lock = threading.Lock()
+
+
+def _write_atomic(path, fp):
+    """
+    Copy the file object `fp` to `path`, readers see either no file or the
+    complete one.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.fetch-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(fp, f, 2 ** 20)
+        os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+@deconstructible
+class ObjectStorage(Storage):
+    """
+    Files stored as the keys of an S3 compatible bucket, the key name is the
+    storage name of the file.
+    """
+
+    def __init__(self, bucket_name=None, base_url=None):
+        self.bucket_name = bucket_name or settings.OBJECT_STORAGE_BUCKET
+        self.base_url = base_url or settings.OBJECT_STORAGE_URL or \
+            settings.MEDIA_URL
+
+    def _open(self, name, mode='rb'):
+        key = get_bucket(self.bucket_name).get_key(name)
+        if key is None:
+            raise IOError("No such file on the object store: {}".format(
+                name))
+
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        key.get_contents_to_file(f)
+        f.seek(0)
+        return File(f, name)
+
+    def _save(self, name, content):
+        key = Key(get_bucket(self.bucket_name), name)
+        if hasattr(content, 'temporary_file_path'):
+            key.set_contents_from_filename(content.temporary_file_path())
+        else:
+            content.seek(0)
+            key.set_contents_from_file(content)
+        return name
+
+    def upload(self, name, path):
+        """
+        Store the local file at `path` as `name`.
+        """
+        Key(get_bucket(self.bucket_name), name).set_contents_from_filename(
+            path)
+
+    def delete(self, name):
+        get_bucket(self.bucket_name).delete_key(name)
+
+    def delete_many(self, names):
+        """
+        Delete the files with multi-object deletes.
+
+        :return: List of the names failed to delete.
+        """
+        return delete_keys(list(names), get_bucket(self.bucket_name))
+
+    def read_head(self, name, size):
+        """
+        First `size` bytes of the file, with a ranged read.
+        """
+        key = get_bucket(self.bucket_name).get_key(name)
+        if key is None:
+            raise IOError("No such file on the object store: {}".format(
+                name))
+        return key.get_contents_as_string(
+            headers={'Range': 'bytes=0-{}'.format(size - 1)})
+
+    def exists(self, name):
+        return get_bucket(self.bucket_name).get_key(name) is not None
+
+    def size(self, name):
+        key = get_bucket(self.bucket_name).get_key(name)
+        if key is None:
+            raise OSError("No such file on the object store: {}".format(
+                name))
+        return key.size
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name))
+
+
+@deconstructible
+class TieredStorage(FileSystemStorage):
+    """
+    Local disk in front of an :class:`ObjectStorage`. Every file is on the
+    object store, the hot ones are on the local disk too.
+    """
+
+    def __init__(self, location=None, base_url=None, bucket_name=None,
+                 **kwargs):
+        super(TieredStorage, self).__init__(location, base_url, **kwargs)
+        self.cold = ObjectStorage(bucket_name)
+
+    def _save(self, name, content):
+        name = super(TieredStorage, self)._save(name, content)
+        self.cold.upload(name, self.path(name))
+        return name
+
+    def _open(self, name, mode='rb'):
+        self.ensure_local(name)
+        return super(TieredStorage, self)._open(name, mode)
+
+    def ensure_local(self, name):
+        """
+        Local path of the file, fetched back from the object store if it was
+        evicted.
+        """
+        path = self.path(name)
+        if not os.path.exists(path):
+            with self.cold.open(name) as f:
+                _write_atomic(path, f)
+        return path
+
+    def read_head(self, name, size):
+        """
+        First `size` bytes of the file, an evicted one isn't fetched back.
+        """
+        if super(TieredStorage, self).exists(name):
+            with super(TieredStorage, self)._open(name) as f:
+                return f.read(size)
+        return self.cold.read_head(name, size)
+
+    def evict(self, name):
+        """
+        Remove the local copy of the file, if it is on the object store.
+
+        :return: True if it is evicted.
+        """
+        path = self.path(name)
+        if os.path.exists(path) and self.cold.exists(name):
+            os.remove(path)
+            return True
+        return False
+
+    def delete(self, name):
+        super(TieredStorage, self).delete(name)
+        self.cold.delete(name)
+
+    def delete_many(self, names):
+        for name in names:
+            super(TieredStorage, self).delete(name)
+        return self.cold.delete_many(names)
+
+    def exists(self, name):
+        return super(TieredStorage, self).exists(name) or \
+            self.cold.exists(name)
+
+    def size(self, name):
+        if super(TieredStorage, self).exists(name):
+            return super(TieredStorage, self).size(name)
+        return self.cold.size(name)
+
+
+class ReadCache(object):
+    """
+    Local copies of the stored files, the least recently used ones are
+    removed once the cache goes over `max_bytes`.
+    """
+    # Recently used files are never trimmed, another process may be about to
+    # read them.
+    MIN_AGE = 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._added = 0
+
+    def fetch(self, name, storage):
+        """
+        :return: Local path of the stored file `name`.
+        """
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            # Mark it as recently used.
+            os.utime(path, None)
+            return path
+
+        with storage.open(name) as f:
+            _write_atomic(path, f)
+
+        # Trim once in a while, not on every fetch.
+        self._added += os.path.getsize(path)
+        if self._added > self.max_bytes // 10:
+            self._added = 0
+            self.trim()
+        return path
+
+    def trim(self):
+        files, total = [], 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        oldest = time.time() - self.MIN_AGE
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if mtime > oldest:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def get_read_cache():
+    global _read_cache
+
+    with _read_cache_lock:
+        if _read_cache is None or \
+           _read_cache.directory != settings.STORAGE_CACHE_DIR:
+            _read_cache = ReadCache(settings.STORAGE_CACHE_DIR,
+                                    settings.STORAGE_CACHE_MAX_BYTES)
+    return _read_cache
+
+
+def read_head(name, size, storage=None):
+    """
+    First `size` bytes of the stored file `name`, eg; to parse its header.
+    Only those are fetched from the object store.
+    """
+    storage = storage or default_storage
+    if hasattr(storage, 'read_head'):
+        return storage.read_head(name, size)
+    with storage.open(name) as f:
+        return f.read(size)
+
+
+def get_local_path(name, storage=None):
+    """
+    Local path of the stored file `name`, for reading it on the workers.
+
+    Files on the local disk are used in place. Others are read through the
+    local cache, so are the files on a shared mount when
+    `settings.STORAGE_READ_CACHE` is set.
+    """
+    storage = storage or default_storage
+
+    if isinstance(storage, TieredStorage):
+        return storage.ensure_local(name)
+
+    if isinstance(storage, FileSystemStorage) and \
+       not getattr(settings, 'STORAGE_READ_CACHE', False):
+        return storage.path(name)
+
+    return get_read_cache().fetch(name, storage)
@@ -14,16 +14,22 @@ All the asynchronous tasks takes a special argument 'async_operation', a
 boolean flag which further decides to spwan async or synchronous job.
 """
 from __future__ import absolute_import
-import re
 
 from celery import shared_task
-from PIL import Image
+from celery.signals import worker_process_init
+import os
 import logging
 import boto
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
 
 from django.conf import settings
+from .imaging import (save_variants, save_variants_in_pool,
+                      get_sibling_paths, limit_memory, ImageRejected)
+from .cdn import upload_files
+from .manifest import get_manifest
+from .models import get_resized_image_paths
+from .storage import get_local_path
+from .logship import ship_log, append_records
+from . import cleanup
 
 # Normal logger, can be used with all other moduels log in pythonic way.
 logger = logging.getLogger(__name__)
@@ -31,9 +37,117 @@ logger = logging.getLogger(__name__)
 # Custom logger for logging image operations specifically.
 img_logger = logging.getLogger("log_img_operations")
 
-# Used to extract Year, Month, day from the file name, so we can create S3 key
-# properly.
-FILE_PATH_PARSER = re.compile('^.*\/([0-9]{4})\/([0-9]{2})\/([0-9]{2})\/(.*)$')
+
+@worker_process_init.connect
+def limit_worker_memory(**kwargs):
+    """
+    Cap the address space of the worker processes, see
+    :func:`~uploader.imaging.limit_memory`.
+    """
+    limit_memory()
+
+
+def get_resize_queue(width, height, byte_size, interactive=False):
+    """
+    Resize queue of an image, as per its size. The large ones are kept away
+    from the rest, so they don't add to the wait of the typical uploads.
+
+    :param interactive: Single image upload, its user is waiting on it.
+    """
+    if (width or 0) * (height or 0) > settings.RESIZE_LARGE_PIXELS or \
+       (byte_size or 0) > settings.RESIZE_LARGE_BYTES:
+        return "resize_image_large"
+    return "resize_image_priority" if interactive else "resize_image"
+
+
+def queue_resize(images, interactive=False):
+    """
+    Queue the resize of the saved `images`, one message per resize queue.
+
+    :param images: List of :class:`~uploader.models.Image`.
+    """
+    queues = {}
+    for image in images:
+        queue = get_resize_queue(image.width, image.height, image.byte_size,
+                                 interactive)
+        queues.setdefault(queue, []).append(image.image.name)
+
+    for queue, names in queues.items():
+        if len(names) == 1:
+            resize_image.apply_async((names[0],), queue=queue,
+                                     routing_key=queue)
+        else:
+            resize_image_batch.apply_async((names,), queue=queue,
+                                           routing_key=queue)
+
+
+@shared_task(routing_key="resize_image")
+def resize_image(image_name, async_operation=True):
+    """
+    Generate the resized images of an uploaded image and push them to the
+    CDN.
+
+    The message carries only the storage name of the original, the workers
+    derive the rest from the shared settings.
+
+    :param image_name: Storage name of the original, relative to MEDIA_ROOT.
+    :param async_peration: Flag which to turn off any asynchronous operation
+                           done by this task. By default it is enabled.
+    """
+    resize_image_batch([image_name], async_operation)
+
+
+@shared_task(routing_key="resize_image")
+def resize_image_batch(image_names, async_operation=True):
+    """
+    Same as :func:`resize_image`, for all the images of a batch upload. The
+    whole batch is logged and synced with one message each.
+
+    :param image_names: Storage names of the originals, relative to
+                        MEDIA_ROOT.
+    """
+    paths, log_msgs = [], []
+    for image_name in image_names:
+        # Read through the local cache, not from the shared storage.
+        original = get_local_path(image_name)
+        image_map = get_resized_image_paths(image_name)
+
+        paths.append(original)
+        paths.extend(_resize(original, image_map, log_msgs, async_operation))
+
+    _finish(paths, log_msgs, async_operation)
+
+
+@shared_task(routing_key="resize_image_backfill")
+def render_variants(jobs, async_operation=True, done_path=None):
+    """
+    Render only the given variants of the images, see `backfill_variants`
+    command. Variants already there are overwritten.
+
+    :param jobs: List of (image_name, [labels]) pairs, image_name being the
+                 storage name of the original.
+    :param done_path: Optional file created once the task is over, whether
+                      all the variants got written or not.
+    """
+    try:
+        paths, log_msgs = [], []
+        for image_name, labels in jobs:
+            original = get_local_path(image_name)
+            image_map = get_resized_image_paths(image_name)
+            image_map = dict((label, image_map[label]) for label in labels
+                             if label in image_map)
+
+            paths.extend(_resize(original, image_map, log_msgs,
+                                 async_operation))
+
+        _finish(paths, log_msgs, async_operation)
+    finally:
+        if done_path:
+            try:
+                open(done_path, 'w').close()
+            except IOError:
+                # Backfill run is over, nobody is waiting on it.
+                pass
 
 
 @shared_task(routing_key="resize_image")
@@ -42,7 +156,8 @@ def resize_images(image_map, orginal_key, async_operation=True):
     Resize the given set of images into specified targets. Resize and save it
     on the disk.
 
-    Also log these resizing activity asynchronously.
+    Older message format, kept so the messages queued before
+    :func:`resize_image` are still processed.
 
     :param image_map: Return value from
                       class:~`uploader.models.Image.resized_image_paths`
@@ -54,31 +169,140 @@ def resize_images(image_map, orginal_key, async_operation=True):
                            done by this task. By default it is enabled.
 
     """
-    if image_map:
+    resize_images_batch([image_map], orginal_key, async_operation)
 
-        orginal_img_meta = image_map.pop(orginal_key)
-        orginal_img = Image.open(orginal_img_meta['path'])
 
-        for sub_imgs in image_map.values():
-            _copy_org_img = orginal_img.resize(sub_imgs['size'])
-            _copy_org_img.save(sub_imgs['path'])
+@shared_task(routing_key="resize_image")
+def resize_images_batch(image_maps, orginal_key, async_operation=True):
+    """
+    Older message format of :func:`resize_image_batch`.
 
-            # Log the action.
-            log_msg = ("New resized image with dimension: {size} - (wxh)"
-                       " At loc: {path} has been generated from: {org_img}")
+    :param image_maps: List of
+                       class:~`uploader.models.Image.resized_image_paths`
 
-            async_operation and logger_task.delay("INFO", log_msg.format(
-                size=sub_imgs['size'], path=sub_imgs['path'],
-                org_img=orginal_img_meta['path']))
+    :param orginal_key: Name of the key on the maps which hold the details of
+                        original image's size and absolute location.
+    """
+    paths, log_msgs = [], []
+    for image_map in image_maps:
+        if not image_map:
+            continue
+
+        original = image_map.pop(orginal_key)['path']
+        paths.append(original)
+        paths.extend(_resize(original, image_map, log_msgs, async_operation))
+
+    _finish(paths, log_msgs, async_operation)
+
+
+def _resize(original, image_map, log_msgs, async_operation):
+    """
+    Save the variants on `image_map` of the `original` image.
+
+    :return: Paths of the saved files, siblings included.
+    """
+    # These are rendered only when they are requested first time.
+    for label in getattr(settings, 'ON_DEMAND_IMAGE_VARIANTS', ()):
+        image_map.pop(label, None)
+
+    targets = [(label, sub_imgs['size'], sub_imgs['path'])
+               for label, sub_imgs in image_map.items()]
+
+    # Resized images are written locally, the directory of the day may not
+    # be there on this node yet.
+    for directory in set(os.path.dirname(t[2]) for t in targets):
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
 
-            not async_operation and logger_task("INFO", log_msg.format(
+    try:
+        if not targets:
+            saved = []
+        elif async_operation:
+            # Already on a worker process, decode the original only once and
+            # cascade down through variants.
+            saved = save_variants(original, targets)
+        else:
+            # Request thread is waiting on us, keep the decode off it.
+            saved = save_variants_in_pool(original, targets)
+    except ImageRejected as ex:
+        # Stored before the budgets got tighter, retrying won't help.
+        logger.warning("Skipped resizing {}: {}".format(original, ex))
+        saved = []
+
+    paths = []
+    for label in saved:
+        sub_imgs = image_map[label]
+
+        # WebP and other siblings go to the CDN along with the variant.
+        paths.append(sub_imgs['path'])
+        paths.extend(get_sibling_paths(label, sub_imgs['path']))
+
+        log_msgs.append(
+            "New resized image with dimension: {size} - (wxh)"
+            " At loc: {path} has been generated from: {org_img}".format(
                 size=sub_imgs['size'], path=sub_imgs['path'],
-                org_img=orginal_img_meta['path']))
+                org_img=original))
+    return paths
+
+
+def _finish(paths, log_msgs, async_operation):
+    # Shipped in batches along with the other uploads on this worker.
+    if log_msgs:
+        ship_log("INFO", log_msgs, async_operation)
+
+    if not paths:
+        return
+
+    # Push these images to CDN, from here itself if the sync is fused with
+    # the resize.
+    get_manifest().mark_pending(paths)
+    fused = getattr(settings, 'CDN_SYNC_IN_RESIZE_TASK', False)
+    if async_operation and not fused:
+        sync_images_to_cdn.delay([_get_name(path) for path in paths])
+    else:
+        sync_images_to_cdn(paths)
+
+
+def _get_name(path):
+    # Storage name of a local file, the name is same on every node.
+    for root in (settings.MEDIA_ROOT, settings.STORAGE_CACHE_DIR):
+        name = os.path.relpath(path, root)
+        if not name.startswith(os.pardir):
+            return name
+    return path
+
+
+def _get_path(name):
+    # Reverse of _get_name, the originals may have to be fetched from the
+    # storage.
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if os.path.isabs(name) or os.path.exists(path):
+        return path
+    return get_local_path(name)
+
+
+@shared_task(routing_key="logger")
+def ship_logs(records):
+    """
+    Aggregator of the log records shipped by the workers, see
+    :mod:`uploader.logship`.
 
-        # Push these images to CDN via background process.
-        image_map[orginal_key] = orginal_img_meta
-        async_operation and sync_images_to_cdn.delay(image_map)
-        not async_operation and sync_images_to_cdn(image_map)
+    :param records: List of (log_level, message, timestamp) tuples.
+    """
+    valid = []
+    for record in records:
+        if hasattr(img_logger, record[0].lower()):
+            valid.append(record)
+        else:
+            # Invalid log_level.
+            img_logger.warning(
+                "Log level given '{}' is invalid".format(record[0]))
+
+    append_records(valid)
 
 
 @shared_task(routing_key="logger")
@@ -88,13 +312,20 @@ def logger_task(log_level, message, async_operation=True):
     on different components of the system. All other components sends messages
     in standard format for logging.
 
+    Superseded by the batched :func:`ship_logs`, kept for the messages
+    queued before it.
+
     :param log_level: Logger level. eg; INFO, ERROR, WARNING
-    :param message: str, the message to be logged.
+    :param message: str, the message to be logged. Or a list of messages,
+                    logged in one go.
     :param async_peration: Flag which to turn off any asynchronous operation
                            done by this task. By default it is enabled.
     """
     if hasattr(img_logger, log_level.lower()):
-        getattr(img_logger, log_level.lower())(message)
+        log = getattr(img_logger, log_level.lower())
+        for msg in ([message] if isinstance(message, basestring)
+                    else message):
+            log(msg)
     else:
         # Invalid log_level.
         img_logger.warning("Log level given '{}' is invalid".format(log_level))
@@ -106,29 +337,23 @@ def sync_images_to_cdn(self, images):
     A background task which will push the locally saved images to cloud for
     reduendency and easy access via CDNs.
 
-    :param images: Return value from
-                    class:~`uploader.models.Image.resized_image_paths`
+    :param images: List of file paths, absolute or relative to MEDIA_ROOT.
+                   Older messages carry a map like
+                   class:~`uploader.models.Image.resized_image_paths`
 
     :param async_peration: Flag which to turn off any asynchronous operation
                            done by this task. By default it is enabled.
     """
     try:
-        conn = S3Connection(
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
+        # Only the files missing on the CDN or changed since, so a retry
+        # continues from where the last attempt stopped.
+        manifest = get_manifest()
+        if isinstance(images, dict):
+            images = [image['path'] for image in images.values()]
+        paths = manifest.get_changed([_get_path(name) for name in images])
 
-        bucket = conn.create_bucket(settings.S3_IMAGE_BUCKET_NAME)
-
-        for image in images.values():
-            key = Key(bucket)
-
-            # format: yyyy/mm/dd/<file-name>
-            key_name = "/".join(FILE_PATH_PARSER.findall(image['path'])[0])
-
-            key.name = key_name
-
-            key.set_contents_from_filename(image['path'])
+        # Pooled connection of this worker, files are sent concurrently.
+        upload_files(paths, on_uploaded=manifest.mark_uploaded)
 
     except (boto.exception.AWSConnectionError,
             boto.exception.BotoClientError,
@@ -143,3 +368,25 @@ def sync_images_to_cdn(self, images):
     except Exception:
         # Unknown error occurred, Could be due to MaxRetriesExceptionError.
         logger.exception("Unknown Error. Please check...")
+
+
+@shared_task(routing_key="cdn_sync", bind=True)
+def reap_deleted_images(self):
+    """
+    Remove the deleted images batch by batch, see :mod:`uploader.cleanup`.
+    Queued again until none are left, so a bulk delete is done by a few
+    tasks instead of one per image. Needs the database and S3 access.
+    """
+    try:
+        reaped = cleanup.reap_deleted_images()
+    except (IOError,
+            boto.exception.AWSConnectionError,
+            boto.exception.BotoClientError,
+            boto.exception.S3ResponseError) as ex:
+        logger.exception("Error while reaping the images.. retrying...")
+        raise self.retry(exc=ex,
+                         max_retries=settings.TASK_MAX_RETRIES,
+                         countdown=settings.TASK_RETRY_DELAY)
+
+    if reaped >= settings.IMAGE_REAP_BATCH_SIZE:
+        reap_deleted_images.delay()
@@ -14,23 +14,149 @@ All these test will run without Http Server or Celery.
 """
 import os
 import json
-
+import zlib
+import pickle
+import struct
+import resource
+import datetime
+import shutil
+import time
+import tempfile
+import threading
+
+from django.core import signing
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth import SESSION_KEY
 from django.utils.module_loading import import_string
 from django.utils import timezone
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import SkipFile
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.db import DatabaseError
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.sessions.models import Session
 from django.test import Client
-from boto.s3.connection import S3Connection
 from boto.s3.key import Key
+from boto.utils import ISO8601_MS
 from PIL import Image as PILImage
 
 
 from django.conf import settings
-from .models import Image
-from .tasks import FILE_PATH_PARSER
+from .models import (Image, RevokedToken, UPLOAD_DIR_FORMAT,
+                     MAX_NAME_STEM_BYTES, get_resized_image_paths,
+                     get_shard_path, make_image_id)
+from .views import _prepare_image
+from .cdn import (FILE_PATH_PARSER, get_connection, get_bucket,
+                  get_s3_key_name, upload_files, delete_keys)
+from .cleanup import get_variant_files
+from . import cleanup, cdn, imaging
+from .management.commands.scan_media import (iter_local_files,
+                                             iter_expected_files)
+from .management.commands import backfill_variants, scan_media
+from .management.commands.backfill_variants import get_variants_digest
+from .handlers import file_digest, StreamingUploadHandler
+from .utils import TokenCache, token_cache
+from .tokens import (RevocationList, revocation_list, revoke_signed_token,
+                     TOKEN_SALT)
+from .manifest import SyncManifest, get_manifest
+from .logship import LogShipper, append_records
+from .tasks import get_resize_queue, resize_image, render_variants
+from .cooperative import is_cooperative, run_blocking
+from .storage import (ObjectStorage, TieredStorage, ReadCache,
+                      get_local_path, read_head)
+from .imaging import (generate_variants, open_for_variants, save_variants,
+                      save_variants_in_pool, split_targets, render_variant,
+                      get_sibling_paths, webp_supported, get_resize_mode,
+                      get_frame_size, ImageRejected)
+
+
+def fits_variant(size, label, box):
+    """ Whether an image of `size` is a right sized variant `label`. """
+    if get_resize_mode(label) != 'fit':
+        return tuple(size) == tuple(box)
+    # Within the box, touching it on one side.
+    return size[0] <= box[0] and size[1] <= box[1] and \
+        (box[0] - size[0] <= 1 or box[1] - size[1] <= 1)
+
+
+def bomb_png(width=20000, height=20000):
+    """ PNG with only the header of a `width` x `height` image. """
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(
+            ">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(
+        ">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IEND", b"")
+
+
+class FakeKey(object):
+    """ Key of the `FakeBucket`, with the attributes boto listings give. """
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.last_modified = None
+
+    def set_contents_from_string(self, data):
+        self.contents = data
+        self.size = len(data)
+        self.last_modified = datetime.datetime.utcnow().strftime(ISO8601_MS)
+        self.bucket.keys[self.name] = self
+
+    def set_contents_from_filename(self, path):
+        with open(path, 'rb') as f:
+            self.set_contents_from_string(f.read())
+
+    def get_contents_as_string(self):
+        return self.contents
+
+
+class FakeBucket(object):
+    """
+    In-process stand-in of the image bucket. Between `start` and `stop` the
+    CDN helpers use it instead of S3, so the tests run without network.
+    """
+    class DeleteResult(object):
+        errors = []
+
+    def __init__(self):
+        self.keys = {}
+        self._patched = []
+
+    def start(self):
+        for module in (cdn, scan_media):
+            self._patched.append((module, module.get_bucket))
+            module.get_bucket = lambda bucket_name=None: self
+
+    def stop(self):
+        while self._patched:
+            module, get_bucket = self._patched.pop()
+            module.get_bucket = get_bucket
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def get_key(self, name):
+        return self.keys.get(name)
+
+    def list(self, prefix=''):
+        return [self.keys[name] for name in sorted(self.keys)
+                if name.startswith(prefix)]
+
+    def delete_key(self, name):
+        self.keys.pop(name, None)
+
+    def delete_keys(self, keys, quiet=False):
+        for name in keys:
+            self.delete_key(name)
+        return self.DeleteResult()
 
 
 class TestAuthAPI(TestCase):
@@ -73,6 +199,21 @@ class TestAuthAPI(TestCase):
 
         # Check auth_toekn is valid on backend itself.
 
+    def test_logout(self):
+        self._create_user()
+        auth_token = json.loads(self.client.post(
+            self.auth_url, data=self.auth_data).content)['auth_token']
+
+        response = json.loads(self.client.post(
+            reverse("logout"), data={'auth_token': auth_token}).content)
+        self.assertTrue(response['success'])
+        self.assertFalse(Session.objects.filter(
+            session_key=auth_token).exists())
+
+        response = json.loads(self.client.post(
+            reverse("logout"), data={'auth_token': auth_token}).content)
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+
     def test_api_with_junk_data(self):
         self._create_user()
         self.auth_data['username'] = 'haridas1'
@@ -87,6 +228,188 @@ class TestAuthAPI(TestCase):
         return u
 
 
+class TestAuthTokenCache(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.upload_url = reverse("upload_image")
+        self.auth_data = {
+            'username': 'haridas',
+            'password': 'haridas'
+        }
+        self.user = User(username=self.auth_data['username'])
+        self.user.set_password(self.auth_data['password'])
+        self.user.save()
+
+        response = self.client.post(reverse("authenticate"),
+                                    data=self.auth_data)
+        self.auth_token = json.loads(response.content)['auth_token']
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_cached_validation(self):
+        payload = {'auth_token': self.auth_token}
+        self.client.post(self.upload_url, data=payload)
+
+        # Token is validated without touching the database.
+        with self.assertNumQueries(0):
+            response = json.loads(
+                self.client.post(self.upload_url, data=payload).content)
+        self.assertEqual(response['error_msg'],
+                         "Attribute `image` doesn't exists.")
+
+    def test_logout(self):
+        payload = {'auth_token': self.auth_token}
+        self.client.post(self.upload_url, data=payload)
+
+        import_string(settings.SESSION_ENGINE).SessionStore(
+            self.auth_token).delete()
+
+        response = json.loads(
+            self.client.post(self.upload_url, data=payload).content)
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+
+    def test_expiry(self):
+        cache = TokenCache(10, 60)
+        cache.set('expired', self.user,
+                  timezone.now() - datetime.timedelta(seconds=1))
+        self.assertTrue(cache.get('expired') is None)
+
+    def test_logout_on_other_process(self):
+        shared = LocMemCache('auth-tokens', {})
+        this, other = (TokenCache(10, 60, shared, local_ttl=0),
+                       TokenCache(10, 60, shared, local_ttl=0))
+        this.set('token', self.user,
+                 timezone.now() + datetime.timedelta(days=1))
+        self.assertEqual(other.get('token').pk, self.user.pk)
+
+        # Not served from the local entry of the other process.
+        this.invalidate('token')
+        self.assertTrue(other.get('token') is None)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(2, 60)
+        expiry = timezone.now() + datetime.timedelta(days=1)
+        for token in ('a', 'b', 'c'):
+            cache.set(token, self.user, expiry)
+
+        self.assertTrue(cache.get('a') is None)
+        self.assertEqual(cache.get('c').pk, self.user.pk)
+
+
+@override_settings(AUTH_TOKEN_MODE='signed')
+class TestSignedAuthToken(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.upload_url = reverse("upload_image")
+        self.auth_data = {
+            'username': 'haridas',
+            'password': 'haridas'
+        }
+        self.user = User(username=self.auth_data['username'])
+        self.user.set_password(self.auth_data['password'])
+        self.user.save()
+
+    def test_stateless_token(self):
+        sessions = Session.objects.count()
+        auth_token = self._get_auth_token()
+        self.assertEqual(Session.objects.count(), sessions)
+
+        # Validation is DB free once the revocation list is loaded.
+        revocation_list.reload()
+        with self.assertNumQueries(0):
+            response = self._upload(auth_token)
+        self.assertEqual(response['error_msg'],
+                         "Attribute `image` doesn't exists.")
+
+    def test_tampered_token(self):
+        response = self._upload(self._get_auth_token() + 'x')
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+
+    def test_expired_token(self):
+        auth_token = self._get_auth_token()
+        with self.settings(AUTH_TOKEN_MAX_AGE=-1):
+            response = self._upload(auth_token)
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+
+    def test_revoked_token(self):
+        auth_token = self._get_auth_token()
+        other_token = self._get_auth_token()
+        self.assertTrue(revoke_signed_token(auth_token))
+
+        response = self._upload(auth_token)
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+        response = self._upload(other_token)
+        self.assertFalse(response['error_msg'].startswith("Auth Token"))
+
+    def test_logout(self):
+        auth_token = self._get_auth_token()
+        response = json.loads(self.client.post(
+            reverse("logout"), data={'auth_token': auth_token}).content)
+        self.assertTrue(response['success'])
+
+        response = self._upload(auth_token)
+        self.assertTrue(response['error_msg'].startswith("Auth Token"))
+
+    def test_background_refresh(self):
+        revocation_list.reload()
+        auth_token = self._get_auth_token()
+        # Revoked by another process.
+        RevokedToken.objects.create(
+            token_id=signing.loads(auth_token, salt=TOKEN_SALT)['j'],
+            expire_date=timezone.now() + datetime.timedelta(days=1))
+
+        # Noticed only on the next reload, none from the request itself.
+        with self.assertNumQueries(0):
+            self.assertFalse(self._upload(auth_token)['error_msg'].startswith(
+                "Auth Token"))
+        revocation_list.reload()
+        self.assertTrue(self._upload(auth_token)['error_msg'].startswith(
+            "Auth Token"))
+
+    def test_failed_first_load(self):
+        revocations = RevocationList()
+        revocations._refresh = lambda: None
+        reload, failures = revocations.reload, [DatabaseError()]
+
+        def _reload():
+            if failures:
+                raise failures.pop()
+            reload()
+        revocations.reload = _reload
+
+        self.assertRaises(DatabaseError, revocations.is_revoked, 'a')
+        self.assertTrue(revocations._refresher_pid is None)
+
+        # Retried on the next check.
+        RevokedToken.objects.create(
+            token_id='a',
+            expire_date=timezone.now() + datetime.timedelta(days=1))
+        self.assertTrue(revocations.is_revoked('a'))
+        self.assertEqual(revocations._refresher_pid, os.getpid())
+
+    def test_expired_rows_pruned(self):
+        RevokedToken.objects.create(
+            token_id='expired',
+            expire_date=timezone.now() - datetime.timedelta(seconds=1))
+        RevokedToken.objects.create(
+            token_id='live',
+            expire_date=timezone.now() + datetime.timedelta(days=1))
+
+        revocation_list.reload()
+        self.assertEqual(list(RevokedToken.objects.values_list(
+            'token_id', flat=True)), ['live'])
+
+    def _get_auth_token(self):
+        response = self.client.post(reverse("authenticate"),
+                                    data=self.auth_data)
+        return json.loads(response.content)['auth_token']
+
+    def _upload(self, auth_token):
+        return json.loads(self.client.post(
+            self.upload_url, data={'auth_token': auth_token}).content)
+
+
 class TestUploadAPI(TestCase):
     def setUp(self):
         self.upload_url = reverse("upload_image")
@@ -126,6 +449,70 @@ class TestUploadAPI(TestCase):
         self.assertFalse(response['success'])
         self.assertTrue(response['error_msg'])
 
+    def test_duplicate_upload(self):
+        """ Same bytes uploaded again should reuse the stored image. """
+        auth_token = self._get_auth_token()
+
+        stored = Image()
+        stored.user = User.objects.get(username=self.auth_data['username'])
+        stored.image = File(self.image)
+        stored.digest = file_digest(stored.image)
+        stored.save()
+        self.image.seek(0)
+
+        payload = {
+            'auth_token': auth_token,
+            'image': self.image
+        }
+        response = json.loads(
+            self.client.post(self.upload_url, data=payload).content)
+
+        self.assertTrue(response['success'])
+        self.assertEqual(response['image_urls'], stored.resized_image_urls)
+
+        duplicate = Image.objects.get(pk=response['id'])
+        self.assertEqual(duplicate.image.name, stored.image.name)
+        self.assertEqual(duplicate.digest, stored.digest)
+
+        # Stored file is still used by the other row.
+        duplicate.delete()
+        self.assertTrue(os.path.exists(stored.image.path))
+        stored.delete()
+        self.assertFalse(os.path.exists(stored.image.path))
+
+    def test_duplicate_of_other_user(self):
+        """ Same bytes of another user are stored under the uploader. """
+        other = User(username="other")
+        other.save()
+        stored = Image(user=other)
+        stored.image = File(self.image)
+        stored.digest = file_digest(stored.image)
+        stored.save()
+        self.image.seek(0)
+
+        payload = {
+            'auth_token': self._get_auth_token(),
+            'image': self.image,
+            'async_operation': 'false'
+        }
+        bucket = FakeBucket()
+        bucket.start()
+        try:
+            response = json.loads(
+                self.client.post(self.upload_url, data=payload).content)
+        finally:
+            bucket.stop()
+
+        self.assertTrue(response['success'])
+        uploaded = Image.objects.get(pk=response['id'])
+        self.assertNotEqual(uploaded.image.name, stored.image.name)
+        self.assertEqual(uploaded.name_parts[0].split("-")[-2],
+                         str(uploaded.user_id))
+        for url in response['image_urls'].values():
+            self.assertFalse(stored.base_name in url)
+        uploaded.delete()
+        stored.delete()
+
     def _get_auth_token(self):
         u = User(username=self.auth_data['username'])
         u.set_password(self.auth_data['password'])
@@ -137,6 +524,524 @@ class TestUploadAPI(TestCase):
         return auth_token
 
 
+class TestStreamingUploadHandler(TestCase):
+
+    def setUp(self):
+        self.user = User(username="haridas")
+        self.user.set_password("haridas")
+        self.user.save()
+
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+
+    def test_streamed_upload(self):
+        uploaded = self._stream_file(chunk_size=1024)
+
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(uploaded.digest, file_digest(File(f)))
+        self.assertEqual(uploaded.size, os.path.getsize(self.file_name))
+        self.assertEqual(uploaded.image_format, 'JPEG')
+        self.assertEqual(uploaded.image_size, (555, 555))
+
+        # Saving the image only moves the streamed file in place.
+        staged_path = uploaded.temporary_file_path()
+        img = Image()
+        img.user = self.user
+        img.image.save(uploaded.name, uploaded, save=False)
+        img.save()
+
+        self.assertFalse(os.path.exists(staged_path))
+        # Within the same day's directory, a shard of it.
+        self.assertTrue(img.image.path.startswith(
+            os.path.dirname(staged_path) + os.sep))
+        with open(self.file_name, 'rb') as f:
+            self.assertEqual(open(img.image.path, 'rb').read(), f.read())
+        img.delete()
+
+    def test_non_image_upload(self):
+        handler = StreamingUploadHandler()
+        uploaded = self._stream_file(chunk_size=1024, data="not an image",
+                                     handler=handler)
+        self.assertTrue(uploaded is None)
+        self.assertEqual(handler.rejected[0]['code'], 'invalid_image')
+
+    def test_rejected_before_write(self):
+        directory = os.path.join(settings.MEDIA_ROOT,
+                                 time.strftime(UPLOAD_DIR_FORMAT))
+        before = os.listdir(directory) if os.path.exists(directory) else []
+
+        for budget, code in (({'UPLOAD_MAX_PIXELS': 1000}, 'too_many_pixels'),
+                             ({'UPLOAD_ALLOWED_FORMATS': ('PNG',)},
+                              'format_not_allowed'),
+                             ({'UPLOAD_MAX_BYTES': 4096}, 'too_large')):
+            handler = StreamingUploadHandler()
+            with self.settings(**budget):
+                with self.assertRaises(SkipFile):
+                    self._stream_file(chunk_size=2048, handler=handler)
+
+            self.assertEqual(handler.rejected[0]['code'], code)
+            self.assertEqual(handler.rejected[0]['name'], 'me.jpg')
+            self.assertFalse(hasattr(handler, 'file'))
+
+        after = os.listdir(directory) if os.path.exists(directory) else []
+        self.assertEqual(after, before)
+
+    def test_rejected_upload_response(self):
+        token = json.loads(self.client.post(reverse("authenticate"), data={
+            'username': 'haridas', 'password': 'haridas'}).content)[
+                'auth_token']
+
+        with self.settings(UPLOAD_MAX_PIXELS=1000):
+            with open(self.file_name, 'rb') as f:
+                response = json.loads(self.client.post(
+                    reverse("upload_image"),
+                    data={'image': f, 'auth_token': token}).content)
+
+        self.assertFalse(response['success'])
+        self.assertEqual(response['error']['code'], 'too_many_pixels')
+        self.assertEqual(response['error']['limit'], 1000)
+        self.assertEqual(Image.objects.count(), 0)
+
+    def test_decompression_bomb_upload(self):
+        token = json.loads(self.client.post(reverse("authenticate"), data={
+            'username': 'haridas', 'password': 'haridas'}).content)[
+                'auth_token']
+
+        # Refused by Pillow itself, whatever the pixel budget.
+        with self.settings(UPLOAD_MAX_PIXELS=None):
+            response = json.loads(self.client.post(
+                reverse("upload_image"), data={
+                    'image': SimpleUploadedFile('bomb.png', bomb_png()),
+                    'auth_token': token}).content)
+
+            with self.assertRaises(ImageRejected) as cm:
+                _prepare_image(self.user, SimpleUploadedFile(
+                    'bomb.png', bomb_png()), "digest")
+
+        self.assertFalse(response['success'])
+        self.assertEqual(response['error']['code'], 'too_many_pixels')
+        self.assertEqual(cm.exception.code, 'too_many_pixels')
+        self.assertEqual(Image.objects.count(), 0)
+
+    def _stream_file(self, chunk_size, data=None, handler=None):
+        if data is None:
+            with open(self.file_name, 'rb') as f:
+                data = f.read()
+
+        handler = handler or StreamingUploadHandler()
+        handler.new_file('image', 'me.jpg', 'image/jpeg', len(data))
+        for start in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[start:start + chunk_size], start)
+        return handler.file_complete(len(data))
+
+
+class TestCooperative(TestCase):
+
+    def test_run_blocking(self):
+        # Called in place when not serving on gevent.
+        self.assertFalse(is_cooperative())
+        self.assertEqual(run_blocking(sorted, [2, 1], reverse=True), [2, 1])
+
+
+class TestBatchUploadAPI(TestCase):
+    def setUp(self):
+        self.batch_url = reverse("batch_upload_images")
+        self.client = Client()
+        self.auth_data = {
+            'username': 'haridas',
+            'password': 'haridas'
+        }
+        self.user = User(username=self.auth_data['username'])
+        self.user.set_password(self.auth_data['password'])
+        self.user.save()
+
+        response = self.client.post(reverse("authenticate"),
+                                    data=self.auth_data)
+        self.auth_token = json.loads(response.content)['auth_token']
+
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+
+    def test_batch_of_stored_copies(self):
+        stored = Image()
+        stored.user = self.user
+        stored.image = File(open(self.file_name, 'rb'))
+        stored.digest = file_digest(stored.image)
+        stored.save()
+
+        payload = {
+            'auth_token': self.auth_token,
+            'images': [open(self.file_name, 'rb'),
+                       open(self.file_name, 'rb')]
+        }
+        response = json.loads(
+            self.client.post(self.batch_url, data=payload).content)
+
+        self.assertTrue(response['success'])
+        self.assertEqual(len(response['images']), 2)
+
+        ids = [img['id'] for img in response['images']]
+        self.assertEqual(len(set(ids)), 2)
+        for img in response['images']:
+            self.assertEqual(img['name'], 'me.jpg')
+            self.assertEqual(img['image_urls'], stored.resized_image_urls)
+            self.assertEqual(Image.objects.get(pk=img['id']).image.name,
+                             stored.image.name)
+
+    def test_failed_batch_files_removed(self):
+        directory = os.path.join(settings.MEDIA_ROOT,
+                                 time.strftime(UPLOAD_DIR_FORMAT))
+        before = self._list_files(directory)
+
+        # Last row fails to insert, after all the files are stored.
+        save = Image.save
+        saved = []
+
+        def failing_save(image, *args, **kwargs):
+            saved.append(image)
+            if len(saved) == 2:
+                raise DatabaseError("insert failed")
+            save(image, *args, **kwargs)
+
+        Image.save = failing_save
+        try:
+            response = json.loads(self.client.post(self.batch_url, data={
+                'auth_token': self.auth_token,
+                'images': [open(self.file_name, 'rb'),
+                           SimpleUploadedFile('other.png', bomb_png(4, 4))]
+            }).content)
+        finally:
+            Image.save = save
+
+        self.assertFalse(response['success'])
+        self.assertEqual(Image.objects.count(), 0)
+        self.assertEqual(self._list_files(directory), before)
+
+    def test_rejected_batch_files_removed(self):
+        directory = os.path.join(settings.MEDIA_ROOT,
+                                 time.strftime(UPLOAD_DIR_FORMAT))
+        before = self._list_files(directory)
+
+        # Checked on the view, after the first file is stored, without the
+        # streaming handler.
+        handlers = ('django.core.files.uploadhandler.'
+                    'TemporaryFileUploadHandler',)
+        with self.settings(UPLOAD_MAX_PIXELS=1000,
+                           FILE_UPLOAD_HANDLERS=handlers):
+            response = json.loads(self.client.post(self.batch_url, data={
+                'auth_token': self.auth_token,
+                'images': [SimpleUploadedFile('small.png', bomb_png(4, 4)),
+                           open(self.file_name, 'rb')]
+            }).content)
+
+        self.assertFalse(response['success'])
+        self.assertEqual(self._list_files(directory), before)
+
+    def _list_files(self, directory):
+        return sorted(os.path.join(root, name)
+                      for root, _, names in os.walk(directory)
+                      for name in names)
+
+    def test_missing_images(self):
+        response = json.loads(self.client.post(
+            self.batch_url, data={'auth_token': self.auth_token}).content)
+        self.assertFalse(response['success'])
+        self.assertTrue(response['error_msg'])
+
+    def test_too_many_images(self):
+        payload = {
+            'auth_token': self.auth_token,
+            'images': [open(self.file_name, 'rb'),
+                       open(self.file_name, 'rb')]
+        }
+        with self.settings(BATCH_UPLOAD_MAX_FILES=1):
+            response = json.loads(
+                self.client.post(self.batch_url, data=payload).content)
+        self.assertFalse(response['success'])
+        self.assertEqual(Image.objects.count(), 0)
+
+
+class TestDeleteAPI(TestCase):
+    def setUp(self):
+        self.client = Client()
+
+        self.bucket = FakeBucket()
+        self.bucket.start()
+        self.addCleanup(self.bucket.stop)
+        self.auth_data = {
+            'username': 'haridas',
+            'password': 'haridas'
+        }
+        self.user = User(username=self.auth_data['username'])
+        self.user.set_password(self.auth_data['password'])
+        self.user.save()
+
+        response = self.client.post(reverse("authenticate"),
+                                    data=self.auth_data)
+        self.auth_token = json.loads(response.content)['auth_token']
+
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+
+    def test_delete_with_files(self):
+        image = self._create_image()
+        save_variants(image.image.path, [
+            (label, v['size'], v['path'])
+            for label, v in get_resized_image_paths(image.image.name).items()])
+        paths = get_variant_files(image.image.name)
+        other = self._create_image()
+
+        response = self._delete(ids=image.id, async_operation='false')
+        self.assertTrue(response['success'])
+        self.assertEqual(response['deleted'], 1)
+
+        self.assertFalse(Image.all_objects.filter(pk=image.pk).exists())
+        self.assertFalse(os.path.exists(image.image.path))
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(list(Image.objects.all()), [other])
+        other.delete()
+
+    def test_soft_delete_all(self):
+        images = [self._create_image() for _ in range(3)]
+
+        # Reaped later on, only hidden for now.
+        with self.settings(IMAGE_REAP_BATCH_SIZE=2):
+            Image.objects.filter(user=self.user).update(
+                deleted_at=timezone.now())
+            self.assertEqual(Image.objects.count(), 0)
+            self.assertEqual(Image.all_objects.count(), 3)
+
+            self.assertEqual(cleanup.reap_deleted_images(), 2)
+            self.assertEqual(cleanup.reap_deleted_images(), 1)
+            self.assertEqual(cleanup.reap_deleted_images(), 0)
+
+        for image in images:
+            self.assertFalse(os.path.exists(image.image.path))
+
+    def test_shared_file_kept(self):
+        image = self._create_image()
+        copy = Image(user=self.user, name=image.name, image=image.image.name)
+        copy.save()
+
+        response = self._delete(ids=image.id, async_operation='false')
+        self.assertEqual(response['deleted'], 1)
+        self.assertTrue(os.path.exists(image.image.path))
+        copy.delete()
+        self.assertFalse(os.path.exists(image.image.path))
+
+    def test_model_delete_leaves_cdn(self):
+        image = self._create_image()
+
+        # CDN copies are left to the reaper.
+        calls = []
+        delete_keys = cleanup.delete_keys
+        cleanup.delete_keys = lambda keys, bucket=None: calls.append(keys)
+        try:
+            image.delete()
+        finally:
+            cleanup.delete_keys = delete_keys
+
+        self.assertFalse(os.path.exists(image.image.path))
+        self.assertEqual(calls, [])
+
+    def test_invalid_ids(self):
+        self.assertFalse(self._delete(ids="x")['success'])
+        self.assertFalse(self._delete()['success'])
+
+    def _delete(self, **params):
+        params['auth_token'] = self.auth_token
+        url = "{}?{}".format(reverse("upload_image"), "&".join(
+            "{}={}".format(k, v) for k, v in params.items()))
+        return json.loads(self.client.delete(url).content)
+
+    def _create_image(self):
+        image = Image(user=self.user)
+        image.image = File(open(self.file_name, 'rb'))
+        image.save()
+        return image
+
+
+class TestImageListAPI(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.list_url = reverse("list_images")
+        self.auth_data = {
+            'username': 'haridas',
+            'password': 'haridas'
+        }
+        self.user = User(username=self.auth_data['username'])
+        self.user.set_password(self.auth_data['password'])
+        self.user.save()
+
+        response = self.client.post(reverse("authenticate"),
+                                    data=self.auth_data)
+        self.auth_token = json.loads(response.content)['auth_token']
+
+        # Two images share the same created_at.
+        now = timezone.now()
+        self.ids = []
+        for i, seconds in enumerate([50, 40, 40, 30, 20]):
+            base_name = "img{}-{}-{}".format(i, self.user.id, i)
+            image = Image(user=self.user, name=base_name + ".jpg",
+                          base_name=base_name, ext="jpg", width=10,
+                          height=10, created_at=now - datetime.timedelta(
+                              seconds=seconds))
+            image.image = "images/2014/12/06/{}.jpg".format(base_name)
+            image.save()
+            self.ids.append(image.id)
+
+        other = User(username="other")
+        other.save()
+        Image(user=other, name="x-2-1.jpg", base_name="x-2-1", ext="jpg",
+              image="images/2014/12/06/x-2-1.jpg").save()
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_keyset_pagination(self):
+        listed, cursor = [], None
+        self._list()
+
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+
+            # Just the page query, nothing per row.
+            with self.assertNumQueries(1):
+                response = json.loads(self._list(**params).content)
+
+            self.assertTrue(response['success'])
+            listed.extend(img['id'] for img in response['images'])
+            cursor = response['next_cursor']
+            if not cursor:
+                break
+
+        # Newest first, ties broken by id.
+        self.assertEqual(listed, [self.ids[4], self.ids[3], self.ids[2],
+                                  self.ids[1], self.ids[0]])
+
+    def test_not_modified(self):
+        response = self._list()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['images']), 5)
+
+        response = self._list(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self._list(HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_by_delete(self):
+        response = self._list()
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # No date on the page changes, the content does.
+        Image.objects.filter(pk=self.ids[2]).update(deleted_at=timezone.now())
+        response = self._list(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['images']), 4)
+
+    def test_invalid_cursor(self):
+        for cursor in ("junk", "9" * 30 + "-1", "1-" + "9" * 30):
+            response = self._list(cursor=cursor)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content)['error_msg'],
+                             "Invalid `cursor` or `limit`.")
+
+    def _list(self, **params):
+        headers = dict((k, params.pop(k)) for k in list(params)
+                       if k.startswith('HTTP_'))
+        params['auth_token'] = self.auth_token
+        return self.client.get(self.list_url, params, **headers)
+
+
+class TestImageVariantView(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User(username="haridas")
+        self.user.set_password("haridas")
+        self.user.save()
+
+        self.img = Image()
+        self.img.user = self.user
+        self.img.image = File(open(os.path.join(
+            os.path.dirname(__file__), "fixtures/images/me.jpg"), 'rb'))
+        self.img.save()
+
+    def tearDown(self):
+        token_cache.clear()
+        for label, variant in self.img.resized_image_paths.items():
+            for path in [variant['path']] + get_sibling_paths(
+                    label, variant['path']):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def test_render_on_demand(self):
+        variant = self.img.resized_image_paths['medium']
+        self.assertFalse(os.path.exists(variant['path']))
+
+        url = self._listed_urls()['medium']
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(fits_variant(PILImage.open(variant['path']).size,
+                                     'medium', variant['size']))
+
+        # Served from the disk afterwards.
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_unknown_variant(self):
+        url = self._listed_urls()['medium'].replace('-medium.', '-huge.')
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_deleted_image(self):
+        urls = self._listed_urls()
+        Image.objects.filter(pk=self.img.pk).update(
+            deleted_at=timezone.now())
+
+        # Neither rendered nor served, until the reaper removes the files.
+        self.assertEqual(self.client.get(urls['medium']).status_code, 404)
+        self.assertFalse(os.path.exists(
+            self.img.resized_image_paths['medium']['path']))
+        self.assertEqual(self.client.get(urls[Image.IMG_LABEL]).status_code,
+                         404)
+
+    def test_unicode_lock_path(self):
+        with imaging._render_lock(u"/tmp/caf\xe9-medium.jpg"):
+            pass
+
+    def _listed_urls(self):
+        """ Image URLs of the image as the listing API gives them. """
+        response = self.client.post(reverse("authenticate"), data={
+            'username': 'haridas', 'password': 'haridas'})
+        auth_token = json.loads(response.content)['auth_token']
+        response = json.loads(self.client.get(reverse("list_images"), {
+            'auth_token': auth_token}).content)
+        return response['images'][0]['image_urls']
+
+    def test_concurrent_renders(self):
+        variant = self.img.resized_image_paths['large']
+        results = []
+
+        def render():
+            results.append(render_variant(self.img.image.path,
+                                          variant['size'], variant['path'],
+                                          'large'))
+
+        threads = [threading.Thread(target=render) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len([r for r in results if r]), 1)
+        self.assertTrue(fits_variant(PILImage.open(variant['path']).size,
+                                     'large', variant['size']))
+
+
 class TestImageModel(TestCase):
 
     def setUp(self):
@@ -146,6 +1051,10 @@ class TestImageModel(TestCase):
         self.user.set_password("haridas")
         self.user.save()
 
+        self.bucket = FakeBucket()
+        self.bucket.start()
+        self.addCleanup(self.bucket.stop)
+
         self.file_name = os.path.join(os.path.dirname(__file__),
                                       "fixtures/images/me.jpg")
 
@@ -172,6 +1081,164 @@ class TestImageModel(TestCase):
 
         img.delete()
 
+    @override_settings(MEDIA_URL="/media/")
+    def test_object_storage_urls(self):
+        img = Image(user=self.user, name="me-1-1.jpg", base_name="me-1-1",
+                    ext="jpg", image="images/2014/12/06/3f/me-1-1.jpg")
+        img.image.storage = ObjectStorage(
+            base_url="https://originals.example.com/")
+
+        urls = img.resized_image_urls
+        self.assertEqual(urls[Image.IMG_LABEL],
+                         "https://originals.example.com/images/2014/12/06/"
+                         "3f/me-1-1.jpg")
+        self.assertEqual(urls['medium'], "/media/images/2014/12/06/3f/" +
+                         Image.get_resized_image_names("me-1-1.jpg",
+                                                       'medium'))
+
+    def test_stored_name_parts(self):
+        """ Name fields are saved and give the same resized names. """
+        img = self._create_new_img()
+        stored = Image.objects.get(pk=img.pk)
+
+        self.assertEqual(stored.name, os.path.basename(img.image.name))
+        self.assertEqual("{}.{}".format(stored.base_name, stored.ext),
+                         stored.name)
+        for label, url in stored.resized_image_urls.items():
+            if label != Image.IMG_LABEL:
+                self.assertEqual(os.path.basename(url),
+                                 Image.get_resized_image_names(stored.name,
+                                                               label))
+        img.delete()
+
+    def test_resized_paths_from_name(self):
+        """ Workers get the same paths from the storage name alone. """
+        img = self._create_new_img()
+        paths = dict(img.resized_image_paths)
+        paths.pop(Image.IMG_LABEL)
+
+        self.assertEqual(get_resized_image_paths(img.image.name), paths)
+        img.delete()
+
+    def test_sharded_name(self):
+        """ Unique, time ordered ids under the hash sharded directories. """
+        ids = [make_image_id() for _ in range(1000)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(ids[0][:12] <= ids[-1][:12])
+
+        img = self._create_new_img()
+        directory = time.strftime(UPLOAD_DIR_FORMAT)
+        self.assertEqual(img.image.name, get_shard_path(directory, img.name))
+        self.assertEqual(len(img.image.name.split("/")),
+                         len(directory.split("/")) +
+                         settings.IMAGE_DIR_SHARD_LEVELS + 1)
+
+        parsed = Image.BASE_NAME_PARSER.findall(img.name)[0]
+        self.assertEqual(parsed[0], "me")
+        self.assertEqual(parsed[1], str(self.user.id))
+        self.assertEqual(Image.parse_resized_image_name(
+            Image.get_resized_image_names(img.name, "medium")),
+            (img.name, "medium"))
+        img.delete()
+
+    def test_long_file_name(self):
+        """ Long upload names are kept, up to MAX_NAME_STEM_BYTES. """
+        img = Image(user=self.user)
+        img.image = SimpleUploadedFile("a" * 200 + ".jpg",
+                                       open(self.file_name, 'rb').read())
+        img.save()
+
+        stored = Image.objects.get(pk=img.pk)
+        self.assertEqual(stored.image.name, img.image.name)
+        self.assertEqual(stored.name, os.path.basename(img.image.name))
+        self.assertTrue(stored.name.startswith("a" * MAX_NAME_STEM_BYTES +
+                                               "-"))
+        self.assertTrue(os.path.exists(stored.image.path))
+        # SQLite doesn't enforce the lengths, the other databases do.
+        for field, value in (('name', stored.name),
+                             ('image', stored.image.name),
+                             ('base_name', stored.base_name)):
+            self.assertTrue(
+                len(value) <= Image._meta.get_field(field).max_length)
+        for label, variant in stored.resized_image_paths.items():
+            self.assertTrue(len(os.path.basename(variant['path'])) <= 255)
+        stored.delete()
+
+    def test_relocate_images(self):
+        """ Images of the flat layout are moved to the sharded one. """
+        with override_settings(IMAGE_DIR_SHARD_LEVELS=0):
+            img = self._create_new_img()
+        flat_name = img.image.name
+        self.assertEqual(os.path.dirname(flat_name),
+                         time.strftime(UPLOAD_DIR_FORMAT))
+
+        variant = get_resized_image_paths(flat_name)['medium']['path']
+        with open(variant, 'wb') as f:
+            f.write(b"variant")
+
+        old_paths = [img.image.path, variant]
+        out_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(CDN_SYNC_MANIFEST=os.path.join(
+                    out_dir, "m.sqlite3")):
+                upload_files(old_paths)
+                get_manifest().mark_pending(old_paths)
+                call_command('relocate_images', stdout=StringIO())
+                self.assertEqual(list(get_manifest().iter_pending()), [])
+                self.assertEqual(get_manifest()._get_entries(
+                    [get_s3_key_name(p) for p in old_paths]), {})
+        finally:
+            shutil.rmtree(out_dir)
+
+        stored = Image.objects.get(pk=img.pk)
+        # Old CDN keys are replaced by the new ones.
+        for path in old_paths:
+            self.assertTrue(
+                self.bucket.get_key(get_s3_key_name(path)) is None)
+        self.assertTrue(self.bucket.get_key(get_s3_key_name(
+            stored.image.path)) is not None)
+        self.assertEqual(stored.image.name, get_shard_path(
+            time.strftime(UPLOAD_DIR_FORMAT), img.name))
+        self.assertFalse(os.path.exists(img.image.path))
+        self.assertTrue(os.path.exists(stored.image.path))
+
+        self.assertFalse(os.path.exists(variant))
+        new_variant = get_resized_image_paths(
+            stored.image.name)['medium']['path']
+        self.assertEqual(open(new_variant, 'rb').read(), b"variant")
+
+        os.remove(new_variant)
+        stored.delete()
+
+    def test_image_meta(self):
+        """ Details of the original are stored and used without the file. """
+        uploaded = SimpleUploadedFile(
+            "me.jpg", open(self.file_name, 'rb').read(), "image/jpeg")
+        img = _prepare_image(self.user, uploaded, "digest")
+        img.save()
+
+        stored = Image.objects.get(pk=img.pk)
+        self.assertEqual((stored.width, stored.height, stored.format,
+                          stored.byte_size),
+                         (555, 555, 'JPEG', os.path.getsize(self.file_name)))
+
+        # Without touching the file.
+        stored.image.name = "images/2014/12/06/missing-1-1.jpg"
+        self.assertEqual(stored.resized_image_paths[Image.IMG_LABEL]['size'],
+                         (555, 555))
+        img.delete()
+
+    def test_backfill_image_meta(self):
+        img = self._create_new_img()
+        self.assertTrue(Image.objects.get(pk=img.pk).width is None)
+
+        call_command('backfill_image_meta', stdout=StringIO())
+
+        stored = Image.objects.get(pk=img.pk)
+        self.assertEqual((stored.width, stored.height, stored.format),
+                         (555, 555, 'JPEG'))
+        img.delete()
+
     def test_resized_image_path(self):
         """ Check all image paths exists """
         img = self._create_new_img()
@@ -184,6 +1251,27 @@ class TestImageModel(TestCase):
         img = self._create_new_img()
         img.delete()
 
+    def test_sync_resize_over_budget(self):
+        """ Stored images out of a tighter budget are skipped, not hung. """
+        img = self._create_new_img()
+        out_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(UPLOAD_MAX_PIXELS=10, RESIZE_POOL_PROCESSES=2,
+                               CDN_SYNC_MANIFEST=os.path.join(
+                                   out_dir, "m.sqlite3")):
+                # Workers are forked with the settings above.
+                imaging._resize_pool = None
+                resize_image(img.image.name, async_operation=False)
+        finally:
+            if imaging._resize_pool is not None:
+                imaging._resize_pool.terminate()
+            imaging._resize_pool = None
+            shutil.rmtree(out_dir)
+
+        for variant in get_resized_image_paths(img.image.name).values():
+            self.assertFalse(os.path.exists(variant['path']))
+        img.delete()
+
     def _create_new_img(self):
         img = Image()
         img.name = "test1.png"
@@ -193,12 +1281,576 @@ class TestImageModel(TestCase):
         return img
 
 
+class TestResizeEngine(TestCase):
+
+    def setUp(self):
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+        self.targets = [(v[0], v[1]) for v in settings.IMAGE_VARIANTS]
+
+    def test_variant_sizes(self):
+        variants = dict(generate_variants(self.file_name, self.targets))
+
+        self.assertEqual(set(variants), set(dict(self.targets)))
+        for label, size in self.targets:
+            self.assertTrue(fits_variant(variants[label].size, label, size))
+
+    def test_largest_variant_first(self):
+        labels = [label for label, _ in generate_variants(self.file_name,
+                                                          self.targets)]
+        # Compared by the size the whole image is scaled to for each.
+        frames = [get_frame_size((555, 555), dict(self.targets)[l],
+                                 get_resize_mode(l)) for l in labels]
+        areas = [w * h for w, h in frames]
+        self.assertEqual(areas, sorted(areas, reverse=True))
+
+    def test_resize_modes(self):
+        out_dir = tempfile.mkdtemp()
+        path = os.path.join(out_dir, "wide.png")
+
+        # Flat image with all the details on its right end.
+        img = PILImage.new('L', (300, 100), 255)
+        for x in range(200, 300, 20):
+            for y in range(0, 100, 20):
+                img.paste(0, (x, y + x % 40, x + 10, y + x % 40 + 10))
+        img.save(path)
+
+        variants = [('a', (50, 50), 'fit'), ('b', (50, 50), 'cover'),
+                    ('c', (50, 50), 'smart'), ('d', (50, 50), 'stretch')]
+        try:
+            with self.settings(IMAGE_VARIANTS=variants):
+                images = dict(generate_variants(
+                    path, [(v[0], v[1]) for v in variants]))
+
+            self.assertEqual(images['a'].size, (50, 17))
+            for label in 'bcd':
+                self.assertEqual(images[label].size, (50, 50))
+
+            # Center crop is flat, smart crop found the stripes.
+            self.assertEqual(images['b'].getextrema(), (255, 255))
+            self.assertTrue(images['c'].getextrema()[0] < 128)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_legacy_variant_flags(self):
+        with self.settings(IMAGE_VARIANTS=[('a', (1, 1), True),
+                                           ('b', (1, 1), False),
+                                           ('c', (1, 1))]):
+            self.assertEqual([get_resize_mode(l) for l in 'abc'],
+                             ['cover', 'fit', 'fit'])
+
+    def test_decode_budget(self):
+        with self.settings(UPLOAD_MAX_PIXELS=1000):
+            with self.assertRaises(ImageRejected):
+                open_for_variants(self.file_name, [(100, 60)])
+
+    def test_rejection_pickled(self):
+        """ Rejections raised on the pool workers reach the caller. """
+        ex = pickle.loads(pickle.dumps(ImageRejected(
+            'too_many_pixels', "Image is over 10 pixels.", limit=10)))
+        self.assertEqual(ex.as_dict(), {'code': 'too_many_pixels',
+                                        'message': "Image is over 10 pixels.",
+                                        'limit': 10})
+        self.assertEqual(str(ex), "Image is over 10 pixels.")
+
+    def test_draft_decode(self):
+        """ JPEG originals shouldn't be decoded at full resolution. """
+        img = open_for_variants(self.file_name, [(100, 60)])
+        self.assertTrue(img.size[0] < 555 and img.size[0] >= 100)
+
+    def test_resize_in_pool(self):
+        out_dir = tempfile.mkdtemp()
+        targets = [(label, size, os.path.join(out_dir, label + ".jpg"))
+                   for label, size in self.targets]
+        try:
+            # Split over as many workers as there are variants.
+            with self.settings(RESIZE_POOL_PROCESSES=len(targets)):
+                saved = save_variants_in_pool(self.file_name, targets)
+
+            self.assertEqual(set(saved), set(dict(self.targets)))
+            for label, size, path in targets:
+                self.assertTrue(fits_variant(PILImage.open(path).size,
+                                             label, size))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_split_targets(self):
+        targets = [(label, size, label + ".jpg")
+                   for label, size in self.targets]
+        groups = split_targets(targets, 3)
+
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(t for group in groups for t in group),
+                         sorted(targets))
+        # Largest variants first, each group a run of the cascade.
+        areas = [t[1][0] * t[1][1] for group in groups for t in group]
+        self.assertEqual(areas, sorted(areas, reverse=True))
+        self.assertEqual(split_targets(targets, 10), [[t] for t in sorted(
+            targets, key=lambda t: t[1][0] * t[1][1], reverse=True)])
+
+    def test_pool_created_once(self):
+        pool = imaging._resize_pool
+        imaging._resize_pool = None
+        pools = []
+        try:
+            with self.settings(RESIZE_POOL_PROCESSES=1):
+                threads = [threading.Thread(
+                    target=lambda: pools.append(imaging.get_resize_pool()))
+                    for _ in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len(set(map(id, pools))), 1)
+        finally:
+            imaging._resize_pool.terminate()
+            imaging._resize_pool = pool
+
+    def test_pool_memory_limit(self):
+        pool = imaging._resize_pool
+        imaging._resize_pool = None
+        try:
+            with self.settings(RESIZE_POOL_PROCESSES=1,
+                               RESIZE_WORKER_MAX_MEMORY=2 ** 33):
+                limit = imaging.get_resize_pool().apply(
+                    resource.getrlimit, (resource.RLIMIT_AS,))
+            self.assertEqual(limit, (2 ** 33, 2 ** 33))
+        finally:
+            imaging._resize_pool.terminate()
+            imaging._resize_pool = pool
+
+    def test_encoding_profiles(self):
+        out_dir = tempfile.mkdtemp()
+        targets = [(label, size, os.path.join(out_dir, label + ".jpg"))
+                   for label, size in self.targets]
+        try:
+            with self.settings(IMAGE_VARIANT_PROFILES={'large': 'plain'},
+                               IMAGE_ENCODING_PROFILES={
+                                   'default': {'progressive': True,
+                                               'webp': True},
+                                   'plain': {'progressive': False,
+                                             'webp': False}}):
+                save_variants(self.file_name, targets)
+
+                for label, size, path in targets:
+                    img = PILImage.open(path)
+                    self.assertTrue(fits_variant(img.size, label, size))
+                    self.assertEqual('progressive' in img.info,
+                                     label != 'large')
+                    self.assertFalse('exif' in img.info)
+
+                    siblings = get_sibling_paths(label, path)
+                    if label == 'large' or not webp_supported():
+                        self.assertEqual(siblings, [])
+                        continue
+                    webp = PILImage.open(siblings[0])
+                    self.assertEqual((webp.format, webp.size),
+                                     ('WEBP', img.size))
+        finally:
+            shutil.rmtree(out_dir)
+
+
+class TestResizeRouting(TestCase):
+
+    def test_resize_queue(self):
+        with self.settings(RESIZE_LARGE_PIXELS=10 ** 6,
+                           RESIZE_LARGE_BYTES=10 ** 6):
+            self.assertEqual(get_resize_queue(100, 100, 1000),
+                             "resize_image")
+            self.assertEqual(get_resize_queue(100, 100, 1000, True),
+                             "resize_image_priority")
+            self.assertEqual(get_resize_queue(2000, 1000, 1000, True),
+                             "resize_image_large")
+            self.assertEqual(get_resize_queue(100, 100, 2 * 10 ** 6),
+                             "resize_image_large")
+            # Details not known.
+            self.assertEqual(get_resize_queue(None, None, None),
+                             "resize_image")
+
+    def test_lane_queues(self):
+        for lane in settings.RESIZE_WORKER_LANES.values():
+            for queue in lane['queues']:
+                self.assertTrue(queue in settings.CELERY_QUEUES)
+
+
+class TestLogShipper(TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.shipper = LogShipper(self.batches.append, 3, 0.05)
+
+    def test_ship_by_size(self):
+        self.shipper.add([("INFO", str(i), 0) for i in range(4)])
+        self.shipper.add([("INFO", "5", 0)])
+
+        self.assertEqual([len(b) for b in self.batches], [4])
+        self.shipper.flush()
+        self.assertEqual([len(b) for b in self.batches], [4, 1])
+
+    def test_ship_by_interval(self):
+        self.shipper.add([("INFO", "1", 0)])
+        self.assertEqual(self.batches, [])
+
+        time.sleep(0.2)
+        self.assertEqual(self.batches, [[("INFO", "1", 0)]])
+
+    def test_append_and_rotate(self):
+        out_dir = tempfile.mkdtemp()
+        path = os.path.join(out_dir, "image_resize.log")
+        try:
+            for i in range(4):
+                append_records([("INFO", "line-{}".format(i), 0)], path,
+                               max_bytes=10, backup_count=2)
+
+            self.assertEqual(open(path).read(), "line-3\n")
+            self.assertEqual(open(path + ".1").read(), "line-2\n")
+            self.assertEqual(open(path + ".2").read(), "line-1\n")
+            self.assertFalse(os.path.exists(path + ".3"))
+        finally:
+            shutil.rmtree(out_dir)
+
+
+class TestReadCache(TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(os.path.join(self.out_dir, "store"))
+        for name in ("a.jpg", "b.jpg"):
+            self.storage.save("images/2014/12/06/" + name,
+                              ContentFile("x" * 100))
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_read_through(self):
+        cache = ReadCache(os.path.join(self.out_dir, "cache"), 10 ** 6)
+        path = cache.fetch("images/2014/12/06/a.jpg", self.storage)
+
+        self.assertEqual(open(path).read(), "x" * 100)
+        self.assertNotEqual(path, self.storage.path("images/2014/12/06/a.jpg"))
+
+        # Served from the cache afterwards.
+        self.storage.delete("images/2014/12/06/a.jpg")
+        self.assertEqual(cache.fetch("images/2014/12/06/a.jpg",
+                                     self.storage), path)
+
+    def test_trim(self):
+        cache = ReadCache(os.path.join(self.out_dir, "cache"), 150)
+        cache.MIN_AGE = 0
+        first = cache.fetch("images/2014/12/06/a.jpg", self.storage)
+        os.utime(first, (0, 0))
+        second = cache.fetch("images/2014/12/06/b.jpg", self.storage)
+
+        # Least recently used one is removed.
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_local_storage_in_place(self):
+        name = "images/2014/12/06/a.jpg"
+        self.assertEqual(get_local_path(name, self.storage),
+                         self.storage.path(name))
+
+
+class TestS3KeyName(TestCase):
+
+    def test_key_name(self):
+        self.assertEqual(
+            get_s3_key_name("/media/images/2014/12/06/me-1-1417.jpg"),
+            "2014/12/06/me-1-1417.jpg")
+
+    def test_sharded_key_name(self):
+        self.assertEqual(
+            get_s3_key_name("/media/images/2014/12/06/3f/me-1-149c2.jpg"),
+            "2014/12/06/3f/me-1-149c2.jpg")
+        self.assertEqual(
+            get_s3_key_name("images/2014/12/06/3f/a0/me-1-149c2-small.jpg"),
+            "2014/12/06/3f/a0/me-1-149c2-small.jpg")
+
+
+class TestSyncManifest(TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.manifest = SyncManifest(os.path.join(self.out_dir, "m.sqlite3"))
+
+        directory = os.path.join(self.out_dir, "images/2014/12/06")
+        os.makedirs(directory)
+        self.paths = []
+        for name in ("a.jpg", "b.jpg"):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(name)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_skip_uploaded(self):
+        self.manifest.mark_pending(self.paths)
+        self.assertEqual(list(self.manifest.iter_pending()), self.paths)
+
+        self.assertEqual(self.manifest.get_changed(self.paths), self.paths)
+        self.manifest.mark_uploaded(self.paths[0])
+
+        # Partially synced batch continues with the rest.
+        self.assertEqual(self.manifest.get_changed(self.paths),
+                         self.paths[1:])
+        self.assertEqual(list(self.manifest.iter_pending()), self.paths[1:])
+
+    def test_changed_file(self):
+        self.manifest.get_changed(self.paths)
+        for path in self.paths:
+            self.manifest.mark_uploaded(path)
+
+        # Touched but same content.
+        os.utime(self.paths[0], (0, 0))
+        with open(self.paths[1], 'wb') as f:
+            f.write("changed")
+
+        self.assertEqual(self.manifest.get_changed(self.paths),
+                         self.paths[1:])
+
+
+class TestScanMedia(TestCase):
+    def setUp(self):
+        self.user = User(username="haridas")
+        self.user.set_password("haridas")
+        self.user.save()
+
+        self.bucket = FakeBucket()
+        self.bucket.start()
+        self.addCleanup(self.bucket.stop)
+
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_sorted_streams(self):
+        directory = os.path.join(self.out_dir, "images/2014/12/06")
+        for name in ("3f/b-1-2.jpg", "a-1-1.jpg", "a/c.jpg", "a.jpg"):
+            path = os.path.join(directory, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+
+        names = list(iter_local_files(self.out_dir, "images"))
+        self.assertEqual(len(names), 4)
+        self.assertEqual(names, sorted(names))
+
+        rows = [("images/2014/12/06/3f/b-1-2.jpg", True),
+                ("images/2014/12/06/a-1-1.jpg", True),
+                ("images/2014/12/06/a-1-10.png", True),
+                ("images/2014/12/07/c-1-3.jpg", False)]
+        expected = [e[0] for e in iter_expected_files(rows, True)]
+        self.assertEqual(expected, sorted(expected))
+        self.assertEqual(len(expected), len(set(expected)))
+
+    def test_scan_and_repair(self):
+        synced = self._create_image(render=True)
+        unrendered = self._create_image(render=False)
+
+        orphan = os.path.join(os.path.dirname(synced.image.path),
+                              "orphan-1-1.jpg")
+        open(orphan, 'wb').close()
+        os.utime(orphan, (0, 0))
+        self.bucket.new_key("2014/12/06/orphan-cdn.jpg").\
+            set_contents_from_string("x")
+        # Not a copy of an image, never touched.
+        self.bucket.new_key("backups/2014.tar").set_contents_from_string("x")
+
+        with self.settings(CDN_SYNC_MANIFEST=os.path.join(self.out_dir,
+                                                          "m.sqlite3")):
+            out = StringIO()
+            call_command('scan_media', stdout=out)
+            lines = out.getvalue().splitlines()
+
+            self.assertIn("orphan_local " + os.path.relpath(
+                orphan, settings.MEDIA_ROOT), lines)
+            self.assertIn("orphan_cdn images/2014/12/06/orphan-cdn.jpg",
+                          lines)
+            self.assertIn("missing_variant " + os.path.dirname(
+                unrendered.image.name) + "/" + Image.get_resized_image_names(
+                    unrendered.name, "medium"), lines)
+            self.assertIn("unsynced " + unrendered.image.name, lines)
+            self.assertFalse([l for l in lines if synced.base_name in l])
+            self.assertFalse([l for l in lines if "backups" in l])
+
+            # Nothing to resize, the repair stays off the broker.
+            unrendered.delete()
+            call_command('scan_media', repair=True, stdout=StringIO())
+            self.assertFalse(os.path.exists(orphan))
+            # Too young, could be of an upload in progress.
+            self.assertTrue(self.bucket.get_key("2014/12/06/orphan-cdn.jpg")
+                            is not None)
+
+            call_command('scan_media', repair=True, min_age=0,
+                         stdout=StringIO())
+
+        self.assertTrue(self.bucket.get_key("2014/12/06/orphan-cdn.jpg")
+                        is None)
+        self.assertTrue(self.bucket.get_key("backups/2014.tar") is not None)
+        self.assertTrue(os.path.exists(synced.image.path))
+        synced.delete()
+
+    def _create_image(self, render):
+        image = Image(user=self.user)
+        image.image = File(open(self.file_name, 'rb'))
+        image.save()
+
+        paths = [image.image.path]
+        if render:
+            targets = [(label, v['size'], v['path']) for label, v in
+                       get_resized_image_paths(image.image.name).items()]
+            save_variants(image.image.path, targets)
+            for label, _, path in targets:
+                paths.append(path)
+                paths.extend(get_sibling_paths(label, path))
+            upload_files(paths)
+        return image
+
+
+class TestBackfillVariants(TestCase):
+    def setUp(self):
+        self.user = User(username="haridas")
+        self.user.set_password("haridas")
+        self.user.save()
+
+        self.bucket = FakeBucket()
+        self.bucket.start()
+        self.addCleanup(self.bucket.stop)
+
+        self.file_name = os.path.join(os.path.dirname(__file__),
+                                      "fixtures/images/me.jpg")
+        self.out_dir = tempfile.mkdtemp()
+
+        self.image = Image(user=self.user)
+        self.image.image = File(open(self.file_name, 'rb'))
+        self.image.save()
+
+        self.variants = get_resized_image_paths(self.image.image.name)
+        save_variants(self.image.image.path, [
+            (label, v['size'], v['path'])
+            for label, v in self.variants.items()])
+
+        # A new variant, and one of which the size is changed.
+        os.remove(self.variants['medium']['path'])
+        PILImage.new('RGB', (5, 5)).save(self.variants['small']['path'])
+
+    def tearDown(self):
+        self.image.delete()
+        shutil.rmtree(self.out_dir)
+
+    def test_dry_run(self):
+        out = StringIO()
+        with self._settings():
+            call_command('backfill_variants', dry_run=True, stdout=out)
+        self.assertIn("Images: 1, missing variants: 1, stale variants: 1",
+                      out.getvalue())
+        self.assertIn("Estimated render time", out.getvalue())
+        self.assertFalse(os.path.exists(self.variants['medium']['path']))
+
+    def test_backfill(self):
+        with self._settings():
+            call_command('backfill_variants', stdout=StringIO())
+
+        for label in ('medium', 'small'):
+            size = PILImage.open(self.variants[label]['path']).size
+            self.assertTrue(fits_variant(size, label,
+                                         self.variants[label]['size']))
+
+        # Nothing left to do.
+        out = StringIO()
+        with self._settings():
+            call_command('backfill_variants', dry_run=True, restart=True,
+                         stdout=out)
+        self.assertIn("Images: 0", out.getvalue())
+
+    def test_checkpoint(self):
+        with self._settings():
+            with open(settings.VARIANT_BACKFILL_CHECKPOINT, 'w') as f:
+                json.dump({'last_id': self.image.id,
+                           'variants': get_variants_digest()}, f)
+
+            out = StringIO()
+            call_command('backfill_variants', dry_run=True, stdout=out)
+            self.assertIn("Images: 0", out.getvalue())
+
+            # Made for another configuration.
+            with self.settings(IMAGE_VARIANTS=settings.IMAGE_VARIANTS[:-1]):
+                out = StringIO()
+                call_command('backfill_variants', dry_run=True, stdout=out)
+                self.assertIn("Images: 1", out.getvalue())
+
+    def test_async_checkpoint(self):
+        # Queued tasks are only recorded, the broker isn't there.
+        queued = []
+        apply_async = backfill_variants.render_variants.apply_async
+        get_queue_depth = backfill_variants.get_queue_depth
+        backfill_variants.render_variants.apply_async = \
+            lambda args, **kwargs: queued.append(args[0])
+        backfill_variants.get_queue_depth = lambda queue: None
+        try:
+            with self._settings():
+                out = StringIO()
+                call_command('backfill_variants', async_operation=True,
+                             stdout=out)
+                self.assertIn("1 tasks not completed yet", out.getvalue())
+                self.assertFalse(os.path.exists(
+                    settings.VARIANT_BACKFILL_CHECKPOINT))
+
+                # Completed by the workers, recorded on the next run.
+                render_variants(queued[0], async_operation=False)
+                call_command('backfill_variants', async_operation=True,
+                             stdout=StringIO())
+                with open(settings.VARIANT_BACKFILL_CHECKPOINT) as f:
+                    self.assertEqual(json.load(f)['last_id'], self.image.id)
+        finally:
+            backfill_variants.render_variants.apply_async = apply_async
+            backfill_variants.get_queue_depth = get_queue_depth
+        self.assertEqual(len(queued), 1)
+
+    def test_failed_task(self):
+        # Run by the workers right away, the original is out of the budget.
+        apply_async = backfill_variants.render_variants.apply_async
+        get_queue_depth = backfill_variants.get_queue_depth
+        backfill_variants.render_variants.apply_async = \
+            lambda args, kwargs, **options: render_variants(
+                args[0], async_operation=False, **kwargs)
+        backfill_variants.get_queue_depth = lambda queue: None
+        try:
+            with self._settings():
+                out, err = StringIO(), StringIO()
+                # Inline, the pool workers are forked with the old budget.
+                with self.settings(UPLOAD_MAX_PIXELS=10,
+                                   RESIZE_POOL_PROCESSES=0):
+                    call_command('backfill_variants', async_operation=True,
+                                 max_queued=1, stdout=out, stderr=err)
+                with open(settings.VARIANT_BACKFILL_CHECKPOINT) as f:
+                    checkpoint = json.load(f)
+        finally:
+            backfill_variants.render_variants.apply_async = apply_async
+            backfill_variants.get_queue_depth = get_queue_depth
+
+        # Passed over, not waited on.
+        self.assertEqual(checkpoint['last_id'], self.image.id)
+        self.assertEqual(checkpoint['failed'], [self.image.image.name])
+        self.assertIn("Failed to render " + self.image.image.name,
+                      err.getvalue())
+        self.assertIn("Failed images: 1", out.getvalue())
+
+    def _settings(self):
+        return self.settings(
+            CDN_SYNC_MANIFEST=os.path.join(self.out_dir, "m.sqlite3"),
+            VARIANT_BACKFILL_CHECKPOINT=os.path.join(self.out_dir,
+                                                     "backfill.json"))
+
+
 class AwsS3Tests(TestCase):
     def setUp(self):
-        self.conn = S3Connection(
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
+        self.conn = get_connection()
         self.bucket_name = settings.S3_IMAGE_BUCKET_NAME
         self.filename = os.path.join(os.path.dirname(__file__),
                                      "fixtures/images/me.jpg")
@@ -219,6 +1871,109 @@ class AwsS3Tests(TestCase):
 
         self.assertTrue(key.key in keys)
 
+    def test_object_storage(self):
+        storage = ObjectStorage(self.bucket_name)
+        with open(self.filename, 'rb') as f:
+            name = storage.save("images/2014/12/06/me.jpg", File(f))
+
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.size(name), os.path.getsize(self.filename))
+        with storage.open(name) as f:
+            self.assertEqual(f.read(), open(self.filename, 'rb').read())
+        # Header only, with a ranged read.
+        self.assertEqual(read_head(name, 100, storage),
+                         open(self.filename, 'rb').read(100))
+
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_tiered_storage(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            storage = TieredStorage(out_dir, bucket_name=self.bucket_name)
+            with open(self.filename, 'rb') as f:
+                name = storage.save("images/2014/12/06/tiered.jpg", File(f))
+            path = storage.path(name)
+
+            # Cold copy is kept, the local one is fetched back on read.
+            self.assertTrue(storage.evict(name))
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(storage.exists(name))
+            self.assertEqual(read_head(name, 100, storage),
+                             open(self.filename, 'rb').read(100))
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(get_local_path(name, storage), path)
+            self.assertEqual(open(path, 'rb').read(),
+                             open(self.filename, 'rb').read())
+
+            storage.delete(name)
+            self.assertFalse(storage.exists(name))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_upload_files(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            # Two small ones and a multipart upload of three parts.
+            paths = [self._make_file(out_dir, "a.jpg", 1024),
+                     self._make_file(out_dir, "b.jpg", 1024),
+                     self._make_file(out_dir, "c.jpg", 11 * 2 ** 20)]
+
+            with self.settings(S3_MULTIPART_THRESHOLD=5 * 2 ** 20,
+                               S3_MULTIPART_CHUNK_SIZE=5 * 2 ** 20):
+                upload_files(paths)
+
+            bucket = get_bucket()
+            for path in paths:
+                key = bucket.get_key(get_s3_key_name(path))
+                self.assertEqual(key.size, os.path.getsize(path))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_upload_files_failure(self):
+        out_dir = tempfile.mkdtemp()
+        paths = [self._make_file(out_dir, "{}.jpg".format(i), 1024)
+                 for i in range(4)]
+
+        def upload_file(path):
+            if path == paths[0]:
+                raise IOError("upload failed")
+            upload(path)
+
+        # Rest of the files are still uploaded.
+        uploaded = []
+        upload, cdn.upload_file = cdn.upload_file, upload_file
+        try:
+            with self.assertRaises(IOError):
+                upload_files(paths, on_uploaded=uploaded.append)
+        finally:
+            cdn.upload_file = upload
+            shutil.rmtree(out_dir)
+        self.assertEqual(sorted(uploaded), paths[1:])
+
+    def test_delete_keys(self):
+        bucket = get_bucket()
+        keys = ["2014/12/06/delete-{}.jpg".format(i) for i in range(5)]
+        for key in keys:
+            Key(bucket, key).set_contents_from_string("x")
+
+        batch_size, cdn.S3_DELETE_BATCH_SIZE = cdn.S3_DELETE_BATCH_SIZE, 2
+        try:
+            self.assertEqual(delete_keys(keys + ["2014/12/06/none.jpg"]), [])
+        finally:
+            cdn.S3_DELETE_BATCH_SIZE = batch_size
+        for key in keys:
+            self.assertTrue(bucket.get_key(key) is None)
+
+    def _make_file(self, out_dir, name, size):
+        directory = os.path.join(out_dir, "images/2014/12/06")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        return path
+
 
 #
 # Kinda full integration test to cover all the components of the system.
@@ -240,10 +1995,7 @@ class FullIntegrationTest(TestCase):
         self.image = open(self.filename, 'rb')
 
         # S3 Configurations Details.
-        self.conn = S3Connection(
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        )
+        self.conn = get_connection()
         self.bucket_name = settings.S3_IMAGE_BUCKET_NAME
 
     def test_upload_api_and_cloud_syncing(self):
@@ -277,16 +2029,19 @@ class FullIntegrationTest(TestCase):
 
     def _check_image_resize_operation(self, response):
         for name, img in response['image_urls'].iteritems():
-            img_file = os.path.join(settings.MEDIA_ROOT, img)
+            # The API hands out URLs under MEDIA_URL.
+            self.assertTrue(img.startswith(settings.MEDIA_URL))
+            img_file = os.path.join(
+                settings.MEDIA_ROOT, img[len(settings.MEDIA_URL):])
 
             # File exists or not test
             self.assertTrue(os.path.exists(img_file))
 
             # Check the resize operation was done properly.
             if name != Image.IMG_LABEL:
-                self.assertTrue(
-                    PILImage.open(img_file).size == self.image_variants.get(
-                        name))
+                self.assertTrue(fits_variant(
+                    PILImage.open(img_file).size, name,
+                    self.image_variants.get(name)))
 
     def _check_image_logger_operation(self, response):
         curr_size = os.path.getsize(os.path.join(
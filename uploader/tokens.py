@@ -0,0 +1,161 @@
+"""
+@date: 18/Oct/2026
+
+Stateless auth tokens.
+
+When `settings.AUTH_TOKEN_MODE` is 'signed', the AuthView issues HMAC signed
+and timestamped tokens carrying the user details, instead of session keys.
+Validating them needs only the SECRET_KEY, no database read. Revoked tokens,
+see the LogoutView, are kept on the database but their ids are cached in
+memory, and the list is checked only when it is not empty.
+"""
+import os
+import time
+import uuid
+import logging
+import datetime
+import threading
+
+from django.apps import apps
+from django.core import signing
+from django.db import connection, DatabaseError
+from django.utils import timezone
+from django.conf import settings
+
+TOKEN_SALT = "uploader.auth_token"
+
+logger = logging.getLogger(__name__)
+
+
+def get_token_max_age():
+    return getattr(settings, 'AUTH_TOKEN_MAX_AGE', settings.SESSION_COOKIE_AGE)
+
+
+def make_signed_token(user):
+    """
+    Generate a signed auth token for the user.
+
+    :return: URL safe token string.
+    """
+    payload = {
+        'u': user.pk,
+        'n': user.username,
+        'j': uuid.uuid4().hex[:16]   # Token id, used for the revocation.
+    }
+    return signing.dumps(payload, salt=TOKEN_SALT, compress=True)
+
+
+def read_signed_token(token):
+    """
+    Check the signature, age and revocation of the token.
+
+    :return: Token payload dict, or None if the token is invalid, expired or
+             revoked.
+    """
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT,
+                                max_age=get_token_max_age())
+    except signing.BadSignature:
+        # SignatureExpired is a BadSignature too.
+        return None
+
+    if revocation_list.is_revoked(payload.get('j')):
+        return None
+    return payload
+
+
+def revoke_signed_token(token):
+    """
+    Revoke a valid signed token before its expiry.
+
+    :return: True if the token got revoked.
+    """
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT,
+                                max_age=get_token_max_age())
+    except signing.BadSignature:
+        return False
+
+    # Token can't live longer than the max age from now, so don't keep the
+    # revocation beyond that.
+    revocation_list.revoke(payload['j'], timezone.now() + datetime.timedelta(
+        seconds=get_token_max_age()))
+    return True
+
+
+class RevocationList(object):
+    """
+    In-memory snapshot of the unexpired rows of
+    :class:`~uploader.models.RevokedToken`. Loaded on the first check in a
+    process, then reloaded every `settings.AUTH_TOKEN_REVOCATION_REFRESH`
+    seconds by a background thread, so no request waits on the database for
+    it. Tokens revoked on other processes are noticed after the next reload.
+    """
+
+    def __init__(self):
+        self._token_ids = frozenset()
+        self._loaded_at = None
+        self._refresher_pid = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def is_revoked(self, token_id):
+        # Threads don't survive a fork, each worker process needs its own.
+        if self._refresher_pid != os.getpid():
+            self._start_refresher()
+
+        # Nothing to look into on the common case.
+        if not self._token_ids:
+            return False
+        return token_id in self._token_ids
+
+    def revoke(self, token_id, expire_date):
+        RevokedToken = apps.get_model('uploader', 'RevokedToken')
+        RevokedToken.objects.get_or_create(
+            token_id=token_id, defaults={'expire_date': expire_date})
+
+        with self._lock:
+            self._token_ids = self._token_ids | frozenset([token_id])
+
+    def reload(self):
+        RevokedToken = apps.get_model('uploader', 'RevokedToken')
+        now = timezone.now()
+        # Expired tokens fail on their signature alone, the rows are of no
+        # use anymore.
+        RevokedToken.objects.filter(expire_date__lte=now).delete()
+        token_ids = frozenset(RevokedToken.objects.filter(
+            expire_date__gt=now).values_list('token_id', flat=True))
+        with self._lock:
+            self._token_ids = token_ids
+            self._loaded_at = time.time()
+
+    def _start_refresher(self):
+        with self._start_lock:
+            if self._refresher_pid == os.getpid():
+                return
+
+            if self._loaded_at is None:
+                # Nothing to check the tokens against until the first load.
+                # A failed one leaves the refresher unstarted, the next check
+                # tries again.
+                self.reload()
+
+            thread = threading.Thread(target=self._refresh,
+                                      name="token-revocation-refresh")
+            thread.daemon = True
+            thread.start()
+            self._refresher_pid = os.getpid()
+
+    def _refresh(self):
+        while True:
+            time.sleep(getattr(settings, 'AUTH_TOKEN_REVOCATION_REFRESH', 60))
+            try:
+                self.reload()
+            except DatabaseError:
+                # Previous snapshot is kept until the next round.
+                logger.exception("Failed to reload the revoked tokens.")
+            finally:
+                # Not to hold a connection idle between the reloads.
+                connection.close()
+
+revocation_list = RevocationList()
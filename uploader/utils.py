@@ -3,23 +3,155 @@
 @author: Haridas N<haridas.nss@gmail.com>
 """
 import json
+import datetime
 import functools
+import threading
+from collections import OrderedDict
 
 from django.utils import timezone
 from django.http import HttpResponse
 from django.utils.module_loading import import_string
 from django.contrib.auth.models import User
 from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
 from django.conf import settings
+from .tokens import read_signed_token
+
+
+def _make_user(user_id, username):
+    # Only the primary key is needed by the views, avoid holding or pickling
+    # full user rows.
+    user = User(pk=user_id, username=username)
+    user._state.adding = False
+    return user
+
+
+class TokenCache(object):
+    """
+    In-process LRU cache of the validated auth tokens, optionally backed by a
+    shared cache so the other processes can skip the session lookup too.
+
+    Each entry maps auth_token -> (user_id, username, expiry). An entry is
+    never served beyond the token's own expiry and is kept at most `ttl`
+    seconds, which bounds how long a session change made outside of
+    :meth:`invalidate` goes unnoticed.
+
+    :meth:`invalidate` reaches only the local entries of this process and
+    the shared cache, the local ones are kept at most `local_ttl` seconds
+    so a logout handled by another process is noticed within that window.
+    """
+    KEY_PREFIX = "auth_token:"
+
+    def __init__(self, max_size, ttl, shared_cache=None, local_ttl=None):
+        self.max_size = max_size
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.local_ttl = datetime.timedelta(
+            seconds=ttl if local_ttl is None else min(ttl, local_ttl))
+        self.shared_cache = shared_cache
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """
+        :return: Lightweight User object of the token, or None.
+        """
+        now = timezone.now()
+
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is not None and entry[1] > now:
+                # Move to the most recently used end.
+                self._entries[token] = entry
+                return entry[0]
+
+        if self.shared_cache is not None:
+            value = self.shared_cache.get(self.KEY_PREFIX + token)
+            if value is not None and value[2] > now:
+                user = _make_user(value[0], value[1])
+                self._set_local(token, user, value[2])
+                return user
+        return None
+
+    def set(self, token, user, expiry):
+        """
+        Cache a validated token.
+
+        :param user: User owning the token.
+        :param expiry: Expiry date of the token.
+        """
+        user = _make_user(user.pk, user.username)
+        self._set_local(token, user, expiry)
+
+        if self.shared_cache is not None:
+            timeout = int(min(expiry - timezone.now(),
+                              self.ttl).total_seconds())
+            if timeout > 0:
+                self.shared_cache.set(self.KEY_PREFIX + token,
+                                      (user.pk, user.username, expiry),
+                                      timeout)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+        if self.shared_cache is not None:
+            self.shared_cache.delete(self.KEY_PREFIX + token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _set_local(self, token, user, expiry):
+        valid_until = min(expiry, timezone.now() + self.local_ttl)
+
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (user, valid_until)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _get_token_cache():
+    shared_alias = getattr(settings, 'AUTH_TOKEN_SHARED_CACHE', None)
+    return TokenCache(getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000),
+                      getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60),
+                      caches[shared_alias] if shared_alias else None,
+                      getattr(settings, 'AUTH_TOKEN_LOCAL_CACHE_TTL', 5))
+
+token_cache = _get_token_cache()
+
+
+def get_auth_token_mode():
+    """
+    Kind of auth tokens issued by the AuthView.
+
+    'session' - Session keys from `settings.SESSION_ENGINE`.
+    'signed'  - Stateless signed tokens, see :mod:`uploader.tokens`.
+    """
+    return getattr(settings, 'AUTH_TOKEN_MODE', 'session')
 
 
 def validate_auth_token(view):
 
     def _check_token(self, request, *args, **kwargs):
 
-        auth_token = request.POST.get('auth_token')
+        # Read APIs take it as a query parameter.
+        auth_token = request.POST.get('auth_token') or \
+            request.GET.get('auth_token')
+
+        if auth_token and get_auth_token_mode() == 'signed':
+            payload = read_signed_token(auth_token)
+            if payload is not None:
+                request.user = _make_user(payload['u'], payload['n'])
+                return view(self, request, *args, **kwargs)
+
+        elif auth_token:
+            user = token_cache.get(auth_token)
+            if user is not None:
+                request.user = user
+                return view(self, request, *args, **kwargs)
 
-        if auth_token:
             session = import_string(settings.SESSION_ENGINE).SessionStore(
                 auth_token)
 
@@ -29,6 +161,8 @@ def validate_auth_token(view):
 
                 # Keep the user object on request.
                 request.user = User.objects.get(pk=session[SESSION_KEY])
+                token_cache.set(auth_token, request.user,
+                                session.get_expiry_date())
                 return view(self, request, *args, **kwargs)
 
         # All other cases means the auth token expired or invalid.
@@ -3,25 +3,86 @@
 @author: Haridas N<haridas.nss@gmail.com>
 """
 
+import os
 import json
-import tempfile
+import posixpath
+import hashlib
 import logging
+import calendar
+import datetime
 
 from django.views.generic import View
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.views.static import serve
 from django.contrib.auth.models import User
-from django.core.files import File
 from django.utils.module_loading import import_string
 from django.contrib.auth import SESSION_KEY, HASH_SESSION_KEY
-from django.db import DatabaseError
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.conf import settings
-from .utils import validate_auth_token
+from django.core.files.storage import default_storage
+from .utils import validate_auth_token, get_auth_token_mode, token_cache
+from .tokens import make_signed_token, revoke_signed_token
+from .handlers import file_digest
 from .models import Image
-from .tasks import resize_images
+from .tasks import (resize_image, resize_image_batch, queue_resize,
+                    reap_deleted_images)
+from . import cleanup
+from .imaging import (render_variant, read_image_meta, check_image_budget,
+                      open_image, ImageRejected)
+from .manifest import get_manifest
+from .cooperative import run_blocking
+from .storage import get_local_path
 
 logger = logging.getLogger(__name__)
 
 
+def _prepare_image(user, uploaded, digest, stored_copy=None):
+    """
+    Build a new, unsaved Image for the uploaded file.
+
+    :param uploaded: The uploaded file.
+    :param digest: Content digest of the uploaded file.
+    :param stored_copy: Already stored Image with the same content. The new
+                        image points to its stored original and variants.
+    :rtype: :class:`~uploader.models.Image`
+    :raises ImageRejected: If the upload is out of the budgets, nothing is
+                           stored then.
+    """
+    image = Image()
+    image.user = user
+    image.digest = digest
+
+    if stored_copy:
+        # Same bytes are uploaded before, point to the stored copy.
+        image.name = os.path.basename(stored_copy.image.name)
+        image.image = stored_copy.image.name
+        image.base_name, image.ext = stored_copy.name_parts
+        image.width, image.height = stored_copy.dimensions
+        image.format = stored_copy.format
+        image.orientation = stored_copy.orientation
+        image.byte_size = stored_copy.byte_size
+    else:
+        # Streamed uploads have the header parsed already.
+        if hasattr(uploaded, 'image_meta'):
+            meta = uploaded.image_meta
+        else:
+            try:
+                meta = read_image_meta(open_image(uploaded))
+            except IOError:
+                meta = None
+            uploaded.seek(0)
+
+        check_image_budget(meta, uploaded.size)
+        image.set_image_meta(meta, uploaded.size)
+
+        # Storage moves the streamed upload to its final name, no copy of the
+        # content is made.
+        run_blocking(image.image.save, uploaded.name, uploaded, save=False)
+    return image
+
+
 class AuthView(View):
     """
     Exposes a token based Authentication system to make it fully stateless
@@ -59,17 +120,7 @@ class AuthView(View):
             if user.check_password(password):
 
                 # Generate A token for this user.
-                session_key = request.POST.get('auth_token', None)
-
-                session = import_string(settings.SESSION_ENGINE).SessionStore(
-                    session_key)
-
-                session[SESSION_KEY] = user.pk
-                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
-                session.save()
-                result['auth_token'] = session.session_key
-
-                # TODO: Add proper cleanup operations of stale tokens.
+                result['auth_token'] = self._generate_token(request, user)
 
             else:
                 result['success'] = False
@@ -82,8 +133,47 @@ class AuthView(View):
         return HttpResponse(json.dumps(result),
                             content_type="application/json")
 
-    def _generate_token(self):
-        pass
+    def _generate_token(self, request, user):
+        if get_auth_token_mode() == 'signed':
+            # Nothing to store, the token itself carries the user details.
+            return make_signed_token(user)
+
+        session_key = request.POST.get('auth_token', None)
+
+        session = import_string(settings.SESSION_ENGINE).SessionStore(
+            session_key)
+
+        session[SESSION_KEY] = user.pk
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+
+        # TODO: Add proper cleanup operations of stale tokens.
+        return session.session_key
+
+
+class LogoutView(View):
+    """
+    Revokes the auth token of the request, no API accepts it after this.
+    """
+    @validate_auth_token
+    def post(self, request, *args, **kwargs):
+        """
+        post_params = {
+            'auth_token': <str>
+        }
+        """
+        auth_token = request.POST['auth_token']
+
+        if get_auth_token_mode() == 'signed':
+            revoke_signed_token(auth_token)
+        else:
+            import_string(settings.SESSION_ENGINE).SessionStore(
+                auth_token).delete()
+            # Not every session engine sends the delete signal.
+            token_cache.invalidate(auth_token)
+
+        return HttpResponse(json.dumps({'success': True, 'error_msg': None}),
+                            content_type="application/json")
 
 
 class UploaderView(View):
@@ -118,24 +208,23 @@ class UploaderView(View):
             async_operation = json.loads(request.POST.get('async_operation',
                                                           'true'))
         except KeyError:
-            data['error_msg'] = "Attribute `image` doesn't exists."
+            rejected = getattr(request, 'rejected_uploads', None)
+            if rejected:
+                # Skipped by the upload handler, while being received.
+                data['error_msg'] = rejected[0]['message']
+                data['error'] = rejected[0]
+            else:
+                data['error_msg'] = "Attribute `image` doesn't exists."
             return HttpResponse(content=json.dumps(data),
                                 content_type="application/json")
         else:
-            if im.multiple_chunks():
-                # preserve the original name.
-                name = im.name
-                full_im = self._save_file_on_temp_loc(im)
-                im = File(full_im)
-                im.name = name
-            else:
-                im = File(im)
+            # Streamed uploads are hashed already while being received.
+            digest = getattr(im, 'digest', None) or file_digest(im)
 
         # Create new Image object.
         try:
-            image = Image()
-            image.image = im
-            image.user = request.user
+            stored_copy = Image.get_stored_copy(digest, request.user)
+            image = _prepare_image(request.user, im, digest, stored_copy)
             image.save()
 
             # All looks fine.. prepare correct set of data.
@@ -143,30 +232,339 @@ class UploaderView(View):
             data['id'] = image.id
             data['success'] = True
 
-            # place the image resize job background using celery tasks.
-            async_operation and resize_images.delay(
-                image.resized_image_paths, image.IMG_LABEL)
+            # Variants and CDN copies of a stored copy are already there.
+            if not stored_copy:
+                # place the image resize job background using celery tasks.
+                # Routed by the size of the image.
+                async_operation and queue_resize([image], interactive=True)
+
+                # Do all operation synchronously.
+                not async_operation and resize_image(image.image.name,
+                                                     async_operation)
+
+        except DatabaseError as ex:
+            data['error_msg'] = ("Error while saving on the Database "
+                                 " - {}".format(ex.message))
+        except ImageRejected as ex:
+            data['error_msg'] = ex.message
+            data['error'] = ex.as_dict()
+
+        return HttpResponse(content=json.dumps(data),
+                            content_type="application/json")
+
+    @validate_auth_token
+    def delete(self, request, *args, **kwargs):
+        """
+        Handles the HTTP DELETE request. Images are gone from the APIs right
+        away, their files are removed in the background.
+
+        query_params = {
+            'auth_token': <str>,
+            'ids': <str> Comma separated ids of the images,
+            'all': true/false, all the images of the user (Default: false)
+            'async_operation': True/False (Default: True)
+        }
+        """
+        data = {
+            'success': False,
+            'error_msg': None,
+            'deleted': 0
+        }
+
+        try:
+            delete_all = json.loads(request.GET.get('all', 'false'))
+            async_operation = json.loads(request.GET.get('async_operation',
+                                                         'true'))
+            ids = [int(pk) for pk in request.GET.get('ids', '').split(',')
+                   if pk.strip()]
+        except ValueError:
+            data['error_msg'] = "Invalid `ids`, `all` or `async_operation`."
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+
+        if not ids and not delete_all:
+            data['error_msg'] = "Give the `ids` of the images, or `all`."
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+
+        images = Image.objects.filter(user=request.user)
+        if not delete_all:
+            images = images.filter(id__in=ids)
+
+        try:
+            data['deleted'] = images.update(deleted_at=timezone.now())
+            data['success'] = True
+        except DatabaseError as ex:
+            data['error_msg'] = ("Error while saving on the Database "
+                                 " - {}".format(ex.message))
+
+        if data['deleted']:
+            async_operation and reap_deleted_images.delay()
+            if not async_operation:
+                while cleanup.reap_deleted_images():
+                    pass
+
+        return HttpResponse(content=json.dumps(data),
+                            content_type="application/json")
+
+
+class BatchUploaderView(View):
+    """
+    Upload many images on one request. All the images share one auth check,
+    one DB transaction and one resize message.
+    """
+    @validate_auth_token
+    def post(self, request, *args, **kwargs):
+        """
+        Handles the HTTP POST request.
+
+        payload_format = {
+            'images': [<fileobject>, ...],
+            'auth_token': <str>,
+            'async_operation': True/False (Default: True)
+        }
+
+        Response has one entry per uploaded file on `images`, in the same
+        order, each with its `id`, `name` and `image_urls`. Files skipped
+        while being received are listed on `rejected` with their errors.
+        """
+        data = {
+            'success': False,
+            'error_msg': None,
+            'images': []
+        }
+
+        uploads = request.FILES.getlist('images')
+        async_operation = json.loads(request.POST.get('async_operation',
+                                                      'true'))
+        data['rejected'] = getattr(request, 'rejected_uploads', [])
 
-            # Do all operation synchronously.
-            not async_operation and resize_images(
-                image.resized_image_paths, image.IMG_LABEL, async_operation)
+        if not uploads:
+            data['error_msg'] = "Attribute `images` doesn't exists."
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+
+        if len(uploads) > settings.BATCH_UPLOAD_MAX_FILES:
+            data['error_msg'] = ("Too many images, maximum {} images are "
+                                 "allowed per batch.".format(
+                                     settings.BATCH_UPLOAD_MAX_FILES))
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
 
+        try:
+            images, resize_jobs = self._create_images(request.user, uploads)
         except DatabaseError as ex:
             data['error_msg'] = ("Error while saving on the Database "
                                  " - {}".format(ex.message))
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+        except ImageRejected as ex:
+            data['error_msg'] = ex.message
+            data['error'] = ex.as_dict()
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+
+        for uploaded, image in zip(uploads, images):
+            data['images'].append({
+                'id': image.id,
+                'name': uploaded.name,
+                'image_urls': image.resized_image_urls
+            })
+        data['success'] = True
+
+        # One resize message for the whole batch, per resize queue.
+        if resize_jobs:
+            async_operation and queue_resize(resize_jobs)
+
+            not async_operation and resize_image_batch(
+                [image.image.name for image in resize_jobs], async_operation)
 
         return HttpResponse(content=json.dumps(data),
                             content_type="application/json")
 
-    def _save_file_on_temp_loc(self, image):
-        tp = tempfile.NamedTemporaryFile()
-        for chunk in image.chunks():
-            tp.write(chunk)
-        return tp
+    def _create_images(self, user, uploads):
+        """
+        Store the uploaded files and insert their Image rows, all of them or
+        none. Files stored by a failed batch are removed.
+
+        :return: (List of saved images, new originals to be resized)
+        """
+        digests = [getattr(im, 'digest', None) or file_digest(im)
+                   for im in uploads]
+        stored_copies = Image.get_stored_copies(digests, user)
+
+        images = []
+        resize_jobs = []
+        created_at = timezone.now()
+        done = False
+
+        try:
+            for uploaded, digest in zip(uploads, digests):
+                image = _prepare_image(user, uploaded, digest,
+                                       stored_copies.get(digest))
+                image.created_at = created_at
+
+                if digest not in stored_copies:
+                    # Later duplicates in the same batch share this one.
+                    stored_copies[digest] = image
+                    resize_jobs.append(image)
+                images.append(image)
+
+            with transaction.atomic():
+                # One insert per row, the id comes back on every database
+                # backend. Files are stored already, only the rows are saved.
+                for image in images:
+                    image.save()
+            done = True
+        finally:
+            if not done:
+                # No row refers to them, only the new ones are this batch's.
+                self._remove_files(resize_jobs)
+
+        return images, resize_jobs
+
+    @staticmethod
+    def _remove_files(images):
+        for image in images:
+            try:
+                image.image.storage.delete(image.image.name)
+            except Exception:
+                logger.exception("Failed to remove {} of a failed "
+                                 "batch".format(image.image.name))
+
+
+class ImageListView(View):
+    """
+    Lists the images of the user, newest first. Uses keyset pagination on
+    (created_at, id), so any page costs the same however deep it is.
+    """
+    @validate_auth_token
+    def get(self, request, *args, **kwargs):
+        """
+        Handles the HTTP GET request.
 
-    def delete(self, request):
-        # TODO
-        pass
+        query_params = {
+            'auth_token': <str>,
+            'cursor': <str> `next_cursor` of the previous page (Optional),
+            'limit': <int> (Default: IMAGE_LIST_PAGE_SIZE)
+        }
+
+        Pages which didn't change since the `ETag` sent on their last
+        response are answered with 304. No `Last-Modified` is sent, a
+        deleted image changes the page without changing any date on it.
+        """
+        data = {
+            'success': False,
+            'error_msg': None,
+            'images': [],
+            'next_cursor': None
+        }
+
+        try:
+            limit = min(int(request.GET.get('limit',
+                                            settings.IMAGE_LIST_PAGE_SIZE)),
+                        settings.IMAGE_LIST_MAX_PAGE_SIZE)
+            cursor = request.GET.get('cursor')
+            cursor = cursor and self._decode_cursor(cursor)
+            if limit < 1:
+                raise ValueError
+        except (ValueError, OverflowError):
+            # Out of the range of the datetime or the integer columns.
+            data['error_msg'] = "Invalid `cursor` or `limit`."
+            return HttpResponse(content=json.dumps(data),
+                                content_type="application/json")
+
+        images = Image.objects.filter(user=request.user)
+        if cursor:
+            created_at, pk = cursor
+            images = images.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=pk))
+
+        # One more row to know whether there is a next page.
+        images = list(images.order_by('-created_at', '-id')[:limit + 1])
+        if len(images) > limit:
+            images = images[:limit]
+            data['next_cursor'] = self._encode_cursor(images[-1])
+
+        for image in images:
+            data['images'].append({
+                'id': image.id,
+                'created_at': image.created_at.isoformat(),
+                'width': image.width,
+                'height': image.height,
+                'image_urls': image.resized_image_urls
+            })
+        data['success'] = True
+
+        content = json.dumps(data)
+        etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+
+        if self._not_modified(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content=content,
+                                    content_type="application/json")
+
+        response['ETag'] = etag
+        return response
+
+    def _not_modified(self, request, etag):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        return etag in [e.strip() for e in if_none_match.split(',')]
+
+    @staticmethod
+    def _encode_cursor(image):
+        # Microseconds since epoch and id of the last image on the page.
+        created_at = image.created_at
+        return "{}-{}".format(
+            calendar.timegm(created_at.utctimetuple()) * 10 ** 6 +
+            created_at.microsecond, image.id)
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        timestamp, pk = [int(v) for v in cursor.split('-')]
+        if pk >= 2 ** 63:
+            raise OverflowError("Cursor id is out of range.")
+        created_at = datetime.datetime.utcfromtimestamp(
+            timestamp // 10 ** 6).replace(microsecond=timestamp % 10 ** 6,
+                                          tzinfo=timezone.utc)
+        return created_at, pk
+
+
+class ImageVariantView(View):
+    """
+    Serves the stored images. A resized image which isn't there yet, is
+    rendered from its original right away, saved and then served.
+    """
+    def get(self, request, path):
+        full_path = os.path.join(settings.MEDIA_ROOT, path)
+        parsed = Image.parse_resized_image_name(os.path.basename(path))
+        name = posixpath.join(posixpath.dirname(path), parsed[0]) \
+            if parsed else None
+
+        # Files of the deleted images are left to the reaper, they are gone
+        # for the clients already.
+        if not Image.objects.filter(image__in=[path, name]).exists():
+            raise Http404("Image doesn't exists.")
+
+        if not os.path.exists(full_path):
+            variants = dict((v[0], v[1]) for v in settings.IMAGE_VARIANTS)
+
+            if parsed is None or parsed[1] not in variants:
+                raise Http404("Image doesn't exists.")
+
+            if not default_storage.exists(name):
+                raise Http404("Image doesn't exists.")
+
+            original = get_local_path(name)
+            rendered = render_variant(original, variants[parsed[1]],
+                                      full_path, parsed[1])
+            if rendered:
+                # CDN sync picks them up from the manifest.
+                get_manifest().mark_pending(rendered)
+
+        return serve(request, path, document_root=settings.MEDIA_ROOT)
 
 
 class CatchAllView(View):